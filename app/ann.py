@@ -0,0 +1,399 @@
+"""
+    This module contains the optional approximate nearest-neighbour mode for very
+    large galleries. It is an IVF (inverted file) index: a k-means coarse quantizer
+    splits the gallery into lists, and a query is only compared exactly against the
+    samples in the few lists whose centroids are closest to it.
+    The index only keeps the centroids and the grouped sample ids; candidates are
+    compared using the rows of the user's cached ranking engine, so the gallery matrix
+    isn't held a second time.
+    Each user's index is persisted in their data directory and rebuilt in a background
+    thread once enough samples have been added or removed since it was built.
+"""
+
+import os
+import threading
+import traceback
+from typing import Optional
+import numpy as np
+
+from .main import settings
+from .ranking import RankingEngine, select_top_k
+
+
+INDEX_FILENAME = "ivf.npz"
+
+# Number of rows compared against the centroids at once while training/assigning
+CHUNK_ROWS = 8192
+
+DEFAULT_CONFIG = {
+    "enabled": False,
+    "min_gallery_size": 50000,
+    "nlist": None,
+    "nprobe": 8,
+    "rebuild_after": 2000,
+}
+
+
+# Settings for the ANN mode, with defaults filled in
+def get_ann_config() -> dict:
+    conf = {**DEFAULT_CONFIG, **settings.get("ann", {})}
+    if conf["nprobe"] < 1:
+        raise ValueError(f"ann.nprobe must be at least 1, not {conf['nprobe']}")
+
+    return conf
+
+
+# Default number of lists for a gallery of the given size
+def default_nlist(size: int) -> int:
+    return max(1, min(size, int(4 * np.sqrt(size))))
+
+
+# Index of the nearest centroid for each row, computed in chunks to bound memory
+def nearest_centroid(matrix: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    c_sq = np.einsum("ij,ij->i", centroids, centroids)
+    assign = np.empty(len(matrix), dtype=np.int64)
+    for start in range(0, len(matrix), CHUNK_ROWS):
+        chunk = matrix[start : start + CHUNK_ROWS]
+        # ||x||^2 is the same for every centroid, so it doesn't affect the argmin
+        assign[start : start + CHUNK_ROWS] = np.argmin(
+            c_sq - 2.0 * chunk @ centroids.T, axis=1
+        )
+
+    return assign
+
+
+# Lloyd's k-means, trained on a random sample of at most sample_per_list * nlist rows
+def train_kmeans(
+    matrix: np.ndarray,
+    nlist: int,
+    iterations: int = 10,
+    sample_per_list: int = 64,
+    seed: int = 0,
+) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    train = matrix
+    if len(matrix) > sample_per_list * nlist:
+        train = matrix[rng.choice(len(matrix), sample_per_list * nlist, replace=False)]
+
+    centroids = train[rng.choice(len(train), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assign = nearest_centroid(train, centroids)
+        counts = np.bincount(assign, minlength=nlist)
+        nonempty = counts > 0
+
+        # Sum the members of each list in one pass over the rows sorted by list
+        order = np.argsort(assign, kind="stable")
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[nonempty]
+        sums = np.add.reduceat(train[order], starts, axis=0)
+        centroids[nonempty] = sums / counts[nonempty, None]
+
+        # Reseed empty lists with random rows so they can still pick up members
+        empty = np.flatnonzero(~nonempty)
+        if len(empty) > 0:
+            centroids[empty] = train[rng.choice(len(train), len(empty))]
+
+    return centroids
+
+
+class IVFIndex:
+    """
+    Inverted file index over a gallery. The sample ids are stored grouped by list, so
+    that the members of list i are ids[offsets[i]:offsets[i + 1]]. Their fingerprints
+    are looked up in the engine that is searched.
+    model_version is the version of the model that computed the fingerprints.
+    """
+
+    def __init__(
+        self,
+        centroids: np.ndarray,
+        offsets: np.ndarray,
+        ids: np.ndarray,
+        metric: str,
+        model_version: Optional[str] = None,
+    ):
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.metric = metric
+        self.model_version = model_version
+
+    @property
+    def nlist(self) -> int:
+        return len(self.centroids)
+
+    @property
+    def dim(self) -> int:
+        return self.centroids.shape[1]
+
+    # Approximate memory held by the index's arrays
+    @property
+    def nbytes(self) -> int:
+        return self.centroids.nbytes + self.offsets.nbytes + self.ids.nbytes
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def build(
+        cls,
+        engine: RankingEngine,
+        nlist: Optional[int] = None,
+        seed: int = 0,
+        model_version: Optional[str] = None,
+    ) -> "IVFIndex":
+        nlist = min(nlist or default_nlist(len(engine)), len(engine))
+        if nlist < 1:
+            raise ValueError("Can't build an index over an empty gallery")
+
+        vectors = cls._quantizer_space(engine.matrix, engine.metric)
+        centroids = train_kmeans(vectors, nlist, seed=seed)
+        assign = nearest_centroid(vectors, centroids)
+
+        order = np.argsort(assign, kind="stable")
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(assign, minlength=nlist))))
+        return cls(centroids, offsets, engine.ids[order], engine.metric, model_version)
+
+    # The coarse quantizer works on unit vectors for the cosine metric
+    @staticmethod
+    def _quantizer_space(matrix: np.ndarray, metric: str) -> np.ndarray:
+        if metric != "cosine":
+            return matrix
+
+        norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+        return matrix / np.where(norms > 0, norms, 1.0)
+
+    # Row of the engine holding each indexed id, or -1 where the engine no longer has it
+    def rows_in(self, engine: RankingEngine) -> np.ndarray:
+        if len(engine) == 0:
+            return np.full(len(self.ids), -1, dtype=np.int64)
+
+        sorter = np.argsort(engine.ids, kind="stable")
+        found = np.searchsorted(engine.ids, self.ids, sorter=sorter)
+        rows = sorter[np.minimum(found, len(engine) - 1)]
+        return np.where(engine.ids[rows] == self.ids, rows, -1)
+
+    # Candidate ids and their exact distances from the nprobe lists closest to the
+    # query. rows is rows_in(engine), which can be passed in when searching repeatedly.
+    def search(
+        self,
+        engine: RankingEngine,
+        query,
+        nprobe: int,
+        rows: Optional[np.ndarray] = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        if rows is None:
+            rows = self.rows_in(engine)
+
+        query = np.asarray(query, dtype=np.float32).ravel()
+        coarse_query = self._quantizer_space(query, self.metric)
+        coarse = np.einsum("ij,ij->i", self.centroids, self.centroids)
+        coarse -= 2.0 * self.centroids @ coarse_query
+
+        if nprobe < self.nlist:
+            probe = np.argpartition(coarse, nprobe - 1)[:nprobe]
+        else:
+            probe = np.arange(self.nlist)
+
+        candidates = np.concatenate(
+            [rows[self.offsets[i] : self.offsets[i + 1]] for i in probe]
+        )
+        candidates = candidates[candidates >= 0]
+        return engine.ids[candidates], engine.distances(query, candidates)
+
+    def save(self, path: str) -> None:
+        # Write to a temporary file first so a reader never sees a partial index
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as store_to:
+            np.savez(
+                store_to,
+                centroids=self.centroids,
+                offsets=self.offsets,
+                ids=self.ids,
+                metric=np.array(self.metric),
+                model_version=np.array(self.model_version or ""),
+            )
+
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "IVFIndex":
+        with np.load(path) as data:
+            # Indexes saved before model versions were recorded have none
+            model_version = None
+            if "model_version" in data.files:
+                model_version = str(data["model_version"]) or None
+
+            return cls(
+                data["centroids"],
+                data["offsets"],
+                data["ids"],
+                str(data["metric"]),
+                model_version,
+            )
+
+
+class AnnManager:
+    """
+    Keeps each user's IVF index, and works out which samples have been added to or
+    removed from their gallery since the index was built. Added samples are compared
+    exactly and removed ones are filtered out, so results stay correct between rebuilds.
+    An index built from fingerprints of another model version, or of another
+    dimension, is thrown away and rebuilt.
+    """
+
+    def __init__(self, data_path: str):
+        self.data_path = data_path
+        self.lock = threading.Lock()
+        self.indexes: dict[int, IVFIndex] = {}
+        self.deltas: dict[int, tuple] = {}
+        self.building: set[int] = set()
+
+    def index_path(self, user_id: int) -> str:
+        return os.path.join(self.data_path, str(user_id), INDEX_FILENAME)
+
+    # Whether a gallery is large enough for the ANN mode to be used
+    def applies(self, engine: RankingEngine, k: Optional[int]) -> bool:
+        conf = get_ann_config()
+        return (
+            conf["enabled"]
+            and k is not None
+            and len(engine) >= conf["min_gallery_size"]
+        )
+
+    # Rank the gallery approximately. Falls back to an exact scan while there is
+    # no usable index yet. model_version is the version of the engine's fingerprints.
+    def top_k(
+        self,
+        user_id: int,
+        engine: RankingEngine,
+        query,
+        k: int,
+        model_version: Optional[str] = None,
+    ) -> list[tuple[int, float]]:
+        conf = get_ann_config()
+        index = self._get_index(user_id, engine, model_version)
+        if index is None:
+            self.schedule_build(user_id, engine, model_version)
+            return engine.top_k(query, k)
+
+        (rows, added_rows, removed) = self._delta(user_id, index, engine)
+        if len(added_rows) + removed >= conf["rebuild_after"]:
+            self.schedule_build(user_id, engine, model_version)
+
+        # Removed samples have no row in the engine, so they are never candidates
+        ids, dists = index.search(engine, query, conf["nprobe"], rows)
+        if len(added_rows) > 0:
+            ids = np.concatenate((ids, engine.ids[added_rows]))
+            dists = np.concatenate((dists, engine.distances(query, added_rows)))
+
+        return select_top_k(ids, dists, k)
+
+    # Build a new index from the given engine in a background thread, unless one is
+    # already being built for this user
+    def schedule_build(
+        self, user_id: int, engine: RankingEngine, model_version: Optional[str] = None
+    ) -> None:
+        with self.lock:
+            if user_id in self.building:
+                return
+
+            self.building.add(user_id)
+
+        thread = threading.Thread(
+            target=self._build, args=(user_id, engine, model_version), daemon=True
+        )
+        thread.start()
+
+    def _build(
+        self, user_id: int, engine: RankingEngine, model_version: Optional[str]
+    ) -> None:
+        try:
+            index = IVFIndex.build(
+                engine, get_ann_config()["nlist"], model_version=model_version
+            )
+            os.makedirs(os.path.dirname(self.index_path(user_id)), exist_ok=True)
+            index.save(self.index_path(user_id))
+            with self.lock:
+                self.indexes[user_id] = index
+                self.deltas.pop(user_id, None)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            with self.lock:
+                self.building.discard(user_id)
+
+    def _get_index(
+        self, user_id: int, engine: RankingEngine, model_version: Optional[str]
+    ) -> Optional[IVFIndex]:
+        with self.lock:
+            index = self.indexes.get(user_id)
+
+        if index is None:
+            path = self.index_path(user_id)
+            if not os.path.exists(path):
+                return None
+
+            try:
+                index = IVFIndex.load(path)
+            except Exception:
+                traceback.print_exc()
+                return None
+
+        # Comparing ids can't tell that the fingerprints behind them were replaced
+        if not self._matches(index, engine, model_version):
+            self.forget(user_id)
+            return None
+
+        with self.lock:
+            self.indexes[user_id] = index
+
+        return index
+
+    # Whether an index was built from fingerprints like the engine's
+    @staticmethod
+    def _matches(
+        index: IVFIndex, engine: RankingEngine, model_version: Optional[str]
+    ) -> bool:
+        if index.metric != engine.metric:
+            return False
+
+        if len(engine) > 0 and index.dim != engine.matrix.shape[1]:
+            return False
+
+        return index.model_version == model_version
+
+    # The engine's row for each indexed id, the rows of the engine missing from the
+    # index, and the number of indexed ids missing from the engine. Engines are never
+    # modified in place, so this is cached per engine.
+    def _delta(
+        self, user_id: int, index: IVFIndex, engine: RankingEngine
+    ) -> tuple[np.ndarray, np.ndarray, int]:
+        with self.lock:
+            cached = self.deltas.get(user_id)
+
+        if cached is not None and cached[0] is index and cached[1] is engine:
+            return cached[2]
+
+        rows = index.rows_in(engine)
+        indexed = np.zeros(len(engine), dtype=bool)
+        indexed[rows[rows >= 0]] = True
+        delta = (rows, np.flatnonzero(~indexed), int(np.count_nonzero(rows < 0)))
+        with self.lock:
+            self.deltas[user_id] = (index, engine, delta)
+
+        return delta
+
+    # Drop a user's index, in memory and on disk, e.g. after their fingerprints
+    # were replaced. The next query schedules a rebuild.
+    def forget(self, user_id: int) -> None:
+        with self.lock:
+            self.indexes.pop(user_id, None)
+            self.deltas.pop(user_id, None)
+
+        try:
+            os.remove(self.index_path(user_id))
+        except FileNotFoundError:
+            pass
+
+
+ann_manager = AnnManager(settings["datadir"])
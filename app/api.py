@@ -0,0 +1,319 @@
+"""
+    This module contains the JSON API, for clients that aren't browsers. It is
+    mounted under /api/v1 and covers the same operations as the evaluation views:
+
+        POST   /query              rank an unlabelled image against the gallery
+        GET    /samples            list the labelled samples, newest first
+        POST   /samples            add a labelled sample
+        GET    /samples/<id>       one labelled sample
+        DELETE /samples/<id>       delete a labelled sample
+        POST   /batch              start ranking many unlabelled images
+        GET    /batch/<id>         progress of a batch, and its result URLs
+
+    Clients log in through /users/login and keep the session cookie. Requests that
+    change anything must also send an X-Requested-With header: browsers only send
+    custom headers cross-site after a CORS preflight, which this app never allows,
+    so another site can't make a logged-in browser call the API. No templates
+    are rendered, and only the columns a response needs are loaded, so a query on a
+    warm gallery costs the ranking plus one small SELECT.
+"""
+
+from collections import defaultdict
+import json
+import traceback
+import zipfile
+from typing import Optional
+from flask import Blueprint, Response, request, url_for
+from flask_login import current_user
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from .backfill import user_model_version
+from .batch import (
+    TooManyImages,
+    batch_progress,
+    create_batch,
+    get_own_batch,
+    iter_batch_items,
+    parse_k,
+)
+from .evaluation import (
+    add_sample,
+    delete_sample,
+    fingerprint_upload,
+    get_sample_labels,
+)
+from .forms import image_extensions
+from .gallery import rank_gallery
+from .main import settings
+from .metrics import stage_timer
+from .models import BatchQuery, SampleEval
+from .pagination import page_samples
+from .querycount import query_budget
+from .supervisor import ModelUnavailable
+from .uploads import ImageTooLarge
+
+
+apiviews = Blueprint("apiviews", __name__)
+
+DEFAULT_CONFIG = {
+    "default_k": 10,
+    "max_k": 1000,
+}
+
+# Decimal places kept in the distances sent back
+DISTANCE_DIGITS = 6
+
+# Header that requests with these methods must carry, as protection against CSRF
+CSRF_HEADER = "X-Requested-With"
+UNSAFE_METHODS = ("POST", "PUT", "PATCH", "DELETE")
+
+
+def get_api_config() -> dict:
+    return {**DEFAULT_CONFIG, **settings.get("api", {})}
+
+
+# A JSON response with no whitespace between tokens
+def json_response(data, status: int = 200) -> Response:
+    return Response(
+        json.dumps(data, separators=(",", ":")),
+        status=status,
+        mimetype="application/json",
+    )
+
+
+def json_error(message: str, status: int) -> Response:
+    return json_response({"error": message}, status)
+
+
+# Clients get a 401 rather than the login page
+@apiviews.before_request
+def require_login() -> Optional[Response]:
+    if not current_user.is_authenticated:
+        return json_error("Log in first", 401)
+
+    return None
+
+
+# The session cookie is sent with cross-site requests too, so it alone doesn't
+# show that the request came from a client of ours
+@apiviews.before_request
+def require_csrf_header() -> Optional[Response]:
+    if request.method in UNSAFE_METHODS and not request.headers.get(CSRF_HEADER):
+        return json_error(f"Send an {CSRF_HEADER} header with this request", 403)
+
+    return None
+
+
+# Uploads over the size limits are refused while the request is being read
+@apiviews.errorhandler(RequestEntityTooLarge)
+def too_large(error: RequestEntityTooLarge) -> Response:
+    return json_error(error.description, 413)
+
+
+# The uploaded image in the "attachment" field, or an error response
+def get_upload():
+    upload = request.files.get("attachment")
+    if upload is None or not upload.filename:
+        return None, json_error("An image upload is required", 400)
+
+    extension = upload.filename.rsplit(".", 1)[-1].lower()
+    if extension not in image_extensions:
+        return None, json_error("Only PNG and JPEG files are allowed", 415)
+
+    return upload, None
+
+
+def sample_json(sample: SampleEval) -> dict:
+    return {
+        "id": sample.id,
+        "image_id": sample.image_id,
+        "name": sample.name,
+        "timestamp": sample.timestamp.isoformat() if sample.timestamp else None,
+        "image_url": url_for("mainviews.get_image", image_id=sample.image_id),
+    }
+
+
+# Group the candidates by author, best match first. Each author gets their closest
+# distance, their mean distance and how many of the candidates are theirs.
+def aggregate_authors(candidates: list[dict]) -> list[dict]:
+    distances = defaultdict(list)
+    for candidate in candidates:
+        distances[candidate["name"]].append(candidate["distance"])
+
+    authors = [
+        {
+            "name": name,
+            "distance": min(dists),
+            "mean_distance": round(sum(dists) / len(dists), DISTANCE_DIGITS),
+            "samples": len(dists),
+        }
+        for (name, dists) in distances.items()
+    ]
+    authors.sort(key=lambda author: (author["distance"], -author["samples"]))
+    return authors
+
+
+# Rank an unlabelled image. Takes k, the number of candidates, and authors=1 to also
+# get the candidates grouped by author.
+@apiviews.route("/query", methods=["POST"])
+@query_budget(6)
+def query() -> Response:
+    conf = get_api_config()
+    k = request.args.get("k", conf["default_k"], type=int)
+    if k is None or not 0 < k <= conf["max_k"]:
+        return json_error(f"k must be between 1 and {conf['max_k']}", 400)
+
+    upload, error = get_upload()
+    if error is not None:
+        return error
+
+    try:
+        fingerprint, _ = fingerprint_upload(upload, user_model_version(current_user))
+        with stage_timer("ranking"):
+            ranked = rank_gallery(current_user.id, fingerprint, k)
+    except ImageTooLarge as e:
+        return json_error(str(e), 413)
+    except ModelUnavailable as e:
+        return json_error(f"The ID model isn't available right now. {e}", 503)
+    except Exception:
+        traceback.print_exc()
+        return json_error("The ID model returned an invalid response", 502)
+
+    # Samples deleted since the gallery was loaded are left out
+    labels = get_sample_labels(current_user.id, [i for (i, _) in ranked])
+    candidates = [
+        {
+            "id": sample_id,
+            "image_id": labels[sample_id][0],
+            "name": labels[sample_id][1],
+            "distance": round(distance, DISTANCE_DIGITS),
+        }
+        for (sample_id, distance) in ranked
+        if sample_id in labels
+    ]
+
+    data = {"k": k, "candidates": candidates}
+    if request.args.get("authors", 0, type=int):
+        data["authors"] = aggregate_authors(candidates)
+
+    return json_response(data)
+
+
+# One page of the labelled samples. The "next" cursor goes in ?after= for the page
+# after, and is null on the last page.
+@apiviews.route("/samples", methods=["GET"])
+@query_budget(2)
+def list_samples() -> Response:
+    limit = request.args.get("limit", type=int)
+    if limit is not None and limit <= 0:
+        return json_error("limit must be positive", 400)
+
+    samples, next_cursor = page_samples(
+        current_user, request.args.get("after"), page_size=limit
+    )
+    return json_response(
+        {"samples": [sample_json(sample) for sample in samples], "next": next_cursor}
+    )
+
+
+@apiviews.route("/samples", methods=["POST"])
+@query_budget(16)
+def create_sample() -> Response:
+    name = (request.form.get("name") or "").strip()
+    if not name:
+        return json_error("A name is required", 400)
+
+    upload, error = get_upload()
+    if error is not None:
+        return error
+
+    try:
+        sample = add_sample(current_user, upload, name)
+    except ImageTooLarge as e:
+        return json_error(str(e), 413)
+    except ModelUnavailable as e:
+        return json_error(f"The ID model isn't available right now. {e}", 503)
+    except Exception:
+        traceback.print_exc()
+        return json_error("The ID model returned an invalid response", 502)
+
+    return json_response(sample_json(sample), 201)
+
+
+# A sample of the current user's, or None. Other users' samples are reported as
+# missing, so their ids can't be probed.
+def get_own_sample(sample_id: int) -> Optional[SampleEval]:
+    sample = SampleEval.query.get(sample_id)
+    if sample is None or sample.user_id != current_user.id:
+        return None
+
+    return sample
+
+
+@apiviews.route("/samples/<int:sample_id>", methods=["GET"])
+@query_budget(1)
+def get_sample(sample_id: int) -> Response:
+    sample = get_own_sample(sample_id)
+    if sample is None:
+        return json_error("No such sample", 404)
+
+    return json_response(sample_json(sample))
+
+
+@apiviews.route("/samples/<int:sample_id>", methods=["DELETE"])
+@query_budget(12)
+def remove_sample(sample_id: int) -> Response:
+    sample = get_own_sample(sample_id)
+    if sample is None:
+        return json_error("No such sample", 404)
+
+    delete_sample(current_user, sample)
+    return Response(status=204)
+
+
+def batch_json(batch: BatchQuery) -> dict:
+    data = batch_progress(batch)
+    data["url"] = url_for(".get_batch", batch_id=batch.id)
+    if data["status"] == "done":
+        data["results"] = {
+            fmt: url_for("evalviews.batch_download", batch_id=batch.id, fmt=fmt)
+            for fmt in ("csv", "json")
+        }
+
+    return data
+
+
+# Start a batch query over a zip archive in "archive", or the images in
+# "attachments". Takes k, the number of candidates per image.
+@apiviews.route("/batch", methods=["POST"])
+@query_budget(6)
+def start_batch() -> Response:
+    k = parse_k(request.args.get("k", type=int))
+    if k is None:
+        return json_error("k is out of range", 400)
+
+    archive = request.files.get("archive")
+    uploads = [
+        upload for upload in request.files.getlist("attachments") if upload.filename
+    ]
+    if not archive and not uploads:
+        return json_error("Upload a zip archive or some images", 400)
+
+    try:
+        batch = create_batch(current_user, iter_batch_items(archive, uploads), k)
+    except zipfile.BadZipFile:
+        return json_error("This isn't a valid zip archive", 400)
+    except TooManyImages as e:
+        return json_error(str(e), 413)
+
+    return json_response(batch_json(batch), 202)
+
+
+@apiviews.route("/batch/<int:batch_id>", methods=["GET"])
+@query_budget(2)
+def get_batch(batch_id: int) -> Response:
+    batch = get_own_batch(current_user, batch_id)
+    if batch is None:
+        return json_error("No such batch", 404)
+
+    return json_response(batch_json(batch))
@@ -0,0 +1,291 @@
+"""
+    This module contains the per-author summaries of each user's gallery, and the
+    two-stage author ranking built on them. An author's summary holds their number of
+    samples, the centroid of their fingerprints and the spread of the fingerprints
+    around it. It is updated with Welford's method in the same transaction as every
+    sample that is added or deleted, so it never needs a full scan to stay current.
+    When author ranking is enabled, a query is first compared with the centroids,
+    which there are far fewer of than samples, and only the samples of the closest
+    few authors are then ranked exactly.
+"""
+
+import itertools
+from typing import Optional
+import numpy as np
+
+from .fingerprints import decode_fingerprint
+from .gallery import DEFAULT_BUDGET, GalleryCache
+from .main import settings
+from .models import AuthorSummary, SampleEval, db
+from .ranking import RankingEngine, select_top_k
+
+
+DEFAULT_CONFIG = {
+    "enabled": False,
+    "min_gallery_size": 5000,
+    "candidates": 20,
+}
+
+# Keep IN (...) lists well under SQLite's bound parameter limit
+MAX_IN_PARAMS = 500
+
+
+def get_author_config() -> dict:
+    return {**DEFAULT_CONFIG, **settings.get("author_ranking", {})}
+
+
+# Welford's update of a count, mean and sum of squared distances from the mean for
+# one more value
+def welford_add(
+    count: int, mean: np.ndarray, sum_sq: float, x: np.ndarray
+) -> tuple[int, np.ndarray, float]:
+    count += 1
+    delta = x - mean
+    new_mean = mean + delta / count
+    return count, new_mean, sum_sq + float(delta @ (x - new_mean))
+
+
+# The same, for one value fewer. count must be at least 2.
+def welford_remove(
+    count: int, mean: np.ndarray, sum_sq: float, x: np.ndarray
+) -> tuple[int, np.ndarray, float]:
+    new_mean = (count * mean - x) / (count - 1)
+    return count - 1, new_mean, max(sum_sq - float((x - mean) @ (x - new_mean)), 0.0)
+
+
+# Add a sample to its author's summary, as part of the caller's transaction
+def add_to_summary(user_id: int, name: str, fingerprint) -> None:
+    x = np.asarray(fingerprint, dtype=np.float64).ravel()
+    summary = AuthorSummary.query.get((user_id, name))
+    if summary is None:
+        summary = AuthorSummary(user_id=user_id, name=name, count=0)
+        db.session.add(summary)
+
+    if summary.count == 0:
+        summary.count = 1
+        summary.centroid = x
+        summary.sum_sq = 0.0
+        return
+
+    if summary.dim != x.shape[0]:
+        # The sample must already be in the session for this to count it
+        rebuild_summary(user_id, name)
+        return
+
+    summary.count, summary.centroid, summary.sum_sq = welford_add(
+        summary.count, summary.centroid, summary.sum_sq, x
+    )
+
+
+# Take a deleted sample out of its author's summary, as part of the caller's
+# transaction. The summary is deleted along with the author's last sample.
+def remove_from_summary(user_id: int, name: str, fingerprint) -> None:
+    summary = AuthorSummary.query.get((user_id, name))
+    if summary is None:
+        return
+
+    x = np.asarray(fingerprint, dtype=np.float64).ravel()
+    if summary.count <= 1 or summary.dim != x.shape[0]:
+        if summary.count <= 1:
+            db.session.delete(summary)
+        else:
+            # Can't be undone exactly, so rebuild this author from their samples
+            rebuild_summary(user_id, name)
+
+        return
+
+    summary.count, summary.centroid, summary.sum_sq = welford_remove(
+        summary.count, summary.centroid, summary.sum_sq, x
+    )
+
+
+# Count, centroid and sum of squared distances from it of a stack of fingerprints
+def summarize(matrix: np.ndarray) -> tuple[int, np.ndarray, float]:
+    matrix = np.asarray(matrix, dtype=np.float64)
+    mean = matrix.mean(axis=0)
+    return len(matrix), mean, float(((matrix - mean) ** 2).sum())
+
+
+# Recompute one author's summary from scratch
+def rebuild_summary(user_id: int, name: str) -> None:
+    samples = SampleEval.query.filter_by(user_id=user_id, name=name).all()
+    summary = AuthorSummary.query.get((user_id, name))
+    fingerprints = [sample.fingerprint for sample in samples]
+    dims = {len(fingerprint) for fingerprint in fingerprints}
+    if not fingerprints or len(dims) > 1:
+        if summary is not None:
+            db.session.delete(summary)
+
+        return
+
+    if summary is None:
+        summary = AuthorSummary(user_id=user_id, name=name)
+        db.session.add(summary)
+
+    summary.count, summary.centroid, summary.sum_sq = summarize(np.stack(fingerprints))
+
+
+# Recompute all of a user's summaries, e.g. after their fingerprints were replaced
+# by a backfill. Loads only the name and fingerprint columns.
+def rebuild_user_summaries(user_id: int) -> None:
+    AuthorSummary.query.filter_by(user_id=user_id).delete()
+    rows = (
+        db.session.query(
+            SampleEval.name,
+            SampleEval.fingerprint_blob,
+            SampleEval.fingerprint_dim,
+            SampleEval.fingerprint_dtype,
+            SampleEval.fingerprint_json,
+        )
+        .filter_by(user_id=user_id)
+        .order_by(SampleEval.name)
+    )
+    for (name, group) in itertools.groupby(rows, key=lambda row: row[0]):
+        fingerprints = [decode_fingerprint(*row[1:]) for row in group]
+        if len({len(fingerprint) for fingerprint in fingerprints}) > 1:
+            continue
+
+        summary = AuthorSummary(user_id=user_id, name=name)
+        summary.count, summary.centroid, summary.sum_sq = summarize(
+            np.stack(fingerprints)
+        )
+        db.session.add(summary)
+
+
+class AuthorGallery:
+    """
+    A user's author centroids stacked into a ranking engine, whose ids are indexes
+    into the list of names.
+    """
+
+    def __init__(self, names: list[str], engine: RankingEngine, counts, spreads):
+        self.names = names
+        self.engine = engine
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.spreads = np.asarray(spreads, dtype=np.float32)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    @property
+    def nbytes(self) -> int:
+        return self.engine.nbytes + self.counts.nbytes + self.spreads.nbytes
+
+    @classmethod
+    def from_summaries(
+        cls, summaries: list[AuthorSummary], metric: str
+    ) -> "AuthorGallery":
+        dims = {summary.dim for summary in summaries}
+        if len(dims) > 1:
+            # Only compare against the authors in the most common dimension
+            dim = max(dims, key=lambda d: sum(s.dim == d for s in summaries))
+            summaries = [summary for summary in summaries if summary.dim == dim]
+
+        if not summaries:
+            return cls([], RankingEngine([], [], metric=metric), [], [])
+
+        matrix = np.stack([summary.centroid for summary in summaries])
+        engine = RankingEngine.from_arrays(
+            np.arange(len(summaries)), matrix, metric=metric
+        )
+        return cls(
+            [summary.name for summary in summaries],
+            engine,
+            [summary.count for summary in summaries],
+            [summary.spread for summary in summaries],
+        )
+
+    # Names of the n authors whose centroids are closest to the query. Given k, the
+    # next closest are added too until the authors have k samples between them.
+    def closest(self, query, n: int, k: Optional[int] = None) -> list[str]:
+        ranked = self.engine.top_k(query, n if k is None else None)
+        take = min(n, len(ranked))
+        if k is not None:
+            covered = np.cumsum(self.counts[[i for (i, _) in ranked]])
+            take = max(take, int(np.searchsorted(covered, k)) + 1)
+
+        return [self.names[i] for (i, _) in ranked[:take]]
+
+
+def load_author_gallery(user_id: int, metric: Optional[str] = None) -> AuthorGallery:
+    metric = metric or settings.get("distance_metric", "euclidean")
+    summaries = (
+        AuthorSummary.query.filter_by(user_id=user_id)
+        .filter(AuthorSummary.count > 0)
+        .order_by(AuthorSummary.name)
+        .all()
+    )
+    return AuthorGallery.from_summaries(summaries, metric)
+
+
+# Rows of the engine holding the given sample ids. The engine's ids are in
+# ascending order, as galleries are loaded in id order and new samples go last.
+def rows_for_ids(engine: RankingEngine, sample_ids) -> np.ndarray:
+    sample_ids = np.asarray(sample_ids, dtype=np.int64)
+    rows = np.searchsorted(engine.ids, sample_ids)
+    rows = rows[rows < len(engine)]
+    return rows[np.isin(engine.ids[rows], sample_ids)]
+
+
+# Ids of a user's samples by the given authors
+def sample_ids_for(user_id: int, names: list[str]) -> list[int]:
+    ids = []
+    for start in range(0, len(names), MAX_IN_PARAMS):
+        ids.extend(
+            sample_id
+            for (sample_id,) in db.session.query(SampleEval.id).filter(
+                SampleEval.user_id == user_id,
+                SampleEval.name.in_(names[start : start + MAX_IN_PARAMS]),
+            )
+        )
+
+    return ids
+
+
+class AuthorRanking:
+    """
+    Ranks a gallery in two stages: first the author centroids, then the samples of
+    the closest authors. Each user's centroids are cached until their samples change.
+    """
+
+    def __init__(self, budget_bytes: int = DEFAULT_BUDGET):
+        self.cache = GalleryCache(budget_bytes, name="authors")
+
+    # Whether a gallery is large enough for the two stages to be worth it. Queries
+    # for every sample (k is None) need the exact scan anyway.
+    def applies(self, engine: RankingEngine, k: Optional[int]) -> bool:
+        conf = get_author_config()
+        return (
+            conf["enabled"]
+            and k is not None
+            and len(engine) >= conf["min_gallery_size"]
+        )
+
+    def get_authors(self, user_id: int, version: int, metric: str) -> AuthorGallery:
+        return self.cache.get(
+            user_id, version, lambda: load_author_gallery(user_id, metric)
+        )
+
+    def top_k(
+        self,
+        user_id: int,
+        version: int,
+        engine: RankingEngine,
+        query,
+        k: Optional[int],
+    ) -> list[tuple[int, float]]:
+        authors = self.get_authors(user_id, version, engine.metric)
+        if len(authors) == 0:
+            return engine.top_k(query, k)
+
+        names = authors.closest(query, get_author_config()["candidates"], k)
+        rows = rows_for_ids(engine, sample_ids_for(user_id, names))
+        if k is None or len(rows) < k:
+            # Even all of the authors don't have k samples between them, e.g. when
+            # some summaries are in another dimension
+            return engine.top_k(query, k)
+
+        return select_top_k(engine.ids[rows], engine.distances(query, rows), k)
+
+
+author_ranking = AuthorRanking(settings.get("gallery_cache_bytes", DEFAULT_BUDGET))
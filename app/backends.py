@@ -0,0 +1,255 @@
+"""
+    This module contains the fingerprint backends, which turn an image into its
+    fingerprint. The views only use the FingerprintBackend interface, and the backend
+    is chosen with "kind" in the "fingerprint_backend" block of the config:
+
+        http     the author-id-model server (the default), optionally micro-batched
+        process  a pool of local worker processes, each of which loads the model
+                 callable named by "model" (which must be set) once and gets image
+                 bytes through shared memory, with no HTTP or JSON in between
+        stub     deterministic fingerprints computed in-process, for tests and demos
+"""
+
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+import importlib
+import multiprocessing
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+import os
+import threading
+from typing import BinaryIO, Callable, Optional
+
+from .batching import FingerprintBatcher
+from .modelclient import ModelClient, ModelServerError, validate_fingerprint
+from .stubserver import DEFAULT_DIM, stub_fingerprint
+from .supervisor import ModelSupervisor, model_supervisor
+
+
+DEFAULT_CONFIG = {
+    "kind": "http",
+    "model": None,
+    "workers": 2,
+    "timeout": 60.0,
+    "stub_dim": DEFAULT_DIM,
+}
+
+COPY_CHUNK = 1024 * 1024
+
+
+def get_backend_config(settings: dict) -> dict:
+    return {**DEFAULT_CONFIG, **settings.get("fingerprint_backend", {})}
+
+
+# Read a whole upload, from the start
+def read_image(image_fp: BinaryIO) -> bytes:
+    image_fp.seek(0)
+    return image_fp.read()
+
+
+class FingerprintBackend:
+    """
+    Computes fingerprints for images. Subclasses implement fingerprint().
+    """
+
+    kind = "abstract"
+
+    def fingerprint(self, image_fp: BinaryIO) -> list[float]:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class HTTPBackend(FingerprintBackend):
+    """
+    Sends each image to the model server, through the micro-batcher if there is one.
+    If the model server is supervised, calls fail at once while it isn't ready.
+    """
+
+    kind = "http"
+
+    def __init__(
+        self,
+        client: ModelClient,
+        batcher: Optional[FingerprintBatcher] = None,
+        supervisor: Optional[ModelSupervisor] = None,
+    ):
+        self.client = client
+        self.batcher = batcher
+        self.supervisor = supervisor
+
+    @classmethod
+    def from_settings(cls, settings: dict) -> "HTTPBackend":
+        client = ModelClient.from_settings(settings)
+        batcher = None
+        if settings.get("batching", {}).get("enabled"):
+            batcher = FingerprintBatcher.from_settings(client, settings)
+
+        return cls(client, batcher, model_supervisor)
+
+    def fingerprint(self, image_fp: BinaryIO) -> list[float]:
+        if self.supervisor is not None:
+            self.supervisor.check()
+
+        if self.batcher is not None:
+            return self.batcher.fingerprint(image_fp)
+
+        return self.client.fingerprint(image_fp)
+
+
+class StubBackend(FingerprintBackend):
+    """
+    The stub model server's deterministic fingerprints, without the server.
+    """
+
+    kind = "stub"
+
+    def __init__(self, dim: int = DEFAULT_DIM, expected_dim: Optional[int] = None):
+        self.dim = dim
+        self.expected_dim = expected_dim
+
+    def fingerprint(self, image_fp: BinaryIO) -> list[float]:
+        return validate_fingerprint(
+            stub_fingerprint(read_image(image_fp), self.dim), self.expected_dim
+        )
+
+
+# The model callable in each worker process of a ProcessBackend
+_worker_model: Optional[Callable] = None
+
+
+# Import a callable given as "package.module:name"
+def load_callable(spec: str) -> Callable:
+    module_name, _, name = spec.partition(":")
+    if not name:
+        raise ValueError(f"Expected module:callable, got {spec!r}")
+
+    return getattr(importlib.import_module(module_name), name)
+
+
+def _init_worker(spec: str) -> None:
+    global _worker_model
+    _worker_model = load_callable(spec)
+
+
+# Runs in a worker: fingerprint the image in a shared memory block. The block
+# belongs to the parent, which unlinks it, so it isn't tracked here as well.
+def _fingerprint_shared(name: str, size: int) -> list[float]:
+    block = SharedMemory(name=name)
+    resource_tracker.unregister(block._name, "shared_memory")
+    try:
+        data = bytes(block.buf[:size])
+    finally:
+        block.close()
+
+    return [float(x) for x in _worker_model(data)]
+
+
+class ProcessBackend(FingerprintBackend):
+    """
+    Runs the model in a pool of local processes. The model callable takes the image
+    bytes and returns the fingerprint; each worker imports it once at startup. The
+    pool is started on first use, and again after a fork or if a worker dies.
+    """
+
+    kind = "process"
+
+    def __init__(
+        self,
+        model: str,
+        workers: int = DEFAULT_CONFIG["workers"],
+        timeout: float = DEFAULT_CONFIG["timeout"],
+        expected_dim: Optional[int] = None,
+    ):
+        self.model = model
+        self.workers = workers
+        self.timeout = timeout
+        self.expected_dim = expected_dim
+        self.lock = threading.Lock()
+        self.pool: Optional[ProcessPoolExecutor] = None
+        self.pool_pid: Optional[int] = None
+
+    def get_pool(self) -> ProcessPoolExecutor:
+        with self.lock:
+            if self.pool is None or self.pool_pid != os.getpid():
+                # Spawn rather than fork, as the app has threads running
+                self.pool = ProcessPoolExecutor(
+                    self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(self.model,),
+                )
+                self.pool_pid = os.getpid()
+
+            return self.pool
+
+    def _reset_pool(self, pool: ProcessPoolExecutor) -> None:
+        with self.lock:
+            if self.pool is pool:
+                self.pool = None
+
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def fingerprint(self, image_fp: BinaryIO) -> list[float]:
+        image_fp.seek(0, os.SEEK_END)
+        size = image_fp.tell()
+        image_fp.seek(0)
+
+        # Copy the upload straight into shared memory, a chunk at a time
+        block = SharedMemory(create=True, size=max(size, 1))
+        try:
+            offset = 0
+            for chunk in iter(lambda: image_fp.read(COPY_CHUNK), b""):
+                block.buf[offset : offset + len(chunk)] = chunk
+                offset += len(chunk)
+
+            pool = self.get_pool()
+            try:
+                future = pool.submit(_fingerprint_shared, block.name, offset)
+                data = future.result(timeout=self.timeout)
+            except BrokenProcessPool as e:
+                self._reset_pool(pool)
+                raise ModelServerError("A fingerprint worker process died") from e
+            except FutureTimeout as e:
+                future.cancel()
+                raise ModelServerError(
+                    f"The model didn't answer within {self.timeout:g}s"
+                ) from e
+        finally:
+            block.close()
+            block.unlink()
+
+        return validate_fingerprint(data, self.expected_dim)
+
+    def close(self) -> None:
+        with self.lock:
+            pool, self.pool = self.pool, None
+
+        if pool is not None:
+            pool.shutdown()
+
+
+# Create the backend chosen in the settings
+def backend_from_settings(settings: dict) -> FingerprintBackend:
+    conf = get_backend_config(settings)
+    expected_dim = settings.get("fingerprint_dim")
+    if conf["kind"] == "http":
+        return HTTPBackend.from_settings(settings)
+
+    if conf["kind"] == "process":
+        # No default, so a missing setting can't quietly serve stub fingerprints
+        if not conf["model"]:
+            raise ValueError(
+                'The "process" fingerprint backend needs "model" set to the model '
+                'callable, as "package.module:name"'
+            )
+
+        return ProcessBackend(
+            conf["model"], conf["workers"], conf["timeout"], expected_dim
+        )
+
+    if conf["kind"] == "stub":
+        return StubBackend(conf["stub_dim"], expected_dim)
+
+    raise ValueError(f"Unknown fingerprint backend: {conf['kind']}")
@@ -0,0 +1,383 @@
+"""
+    This module contains the backfill that moves users onto a new model version.
+    Every fingerprint is tagged with the version of the model that computed it, and
+    so is every user. When a new checkpoint is deployed, the backfill reads each
+    user's stored images back from their image_path, fingerprints them with the new
+    model on a thread pool, and writes the results to the pending_fingerprint table
+    in one transaction per batch. That table is also the checkpoint: a backfill that
+    is interrupted picks up from the samples that don't have a pending fingerprint
+    yet. Once all of a user's samples have one, they replace the user's fingerprints
+    in a single transaction and the user moves to the new version, and their IVF
+    index, if they have one, is dropped to be rebuilt. Until then their
+    queries are fingerprinted by the previous model, which is kept running at
+    previous_model_url. Samples whose image is missing can't be re-fingerprinted, so
+    they keep their user on the old version until they are deleted; the backfill
+    reports them, and deletes them itself with --drop-missing. Usage:
+
+        python -m app.backfill --workers 8 --batch-size 100
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import logging
+import os
+import threading
+import time
+from typing import Optional
+import numpy as np
+from sqlalchemy import and_, exists, or_, text
+
+from .ann import ann_manager
+from .backends import FingerprintBackend, HTTPBackend, backend_from_settings
+from .fingerprints import pack_fingerprint
+from .fpcache import fingerprint_cache, get_model_version
+from .main import settings
+from .modelclient import ModelClient
+from .models import PendingFingerprint, SampleEval, User, UserImage, db
+from .supervisor import ModelUnavailable
+
+
+DEFAULT_CONFIG = {
+    "workers": 4,
+    "batch_size": 50,
+    "previous_model_version": None,
+    "previous_model_url": None,
+}
+
+logger = logging.getLogger(__name__)
+
+_previous_backends: dict[str, FingerprintBackend] = {}
+_previous_lock = threading.Lock()
+
+
+def get_backfill_config() -> dict:
+    return {**DEFAULT_CONFIG, **settings.get("backfill", {})}
+
+
+# The model version a user's fingerprints, and so their queries, belong to
+def user_model_version(user: User) -> str:
+    return user.model_version or get_model_version()
+
+
+# The backend for a model version other than the current one. Only the previous
+# version is kept running, for the users that haven't been backfilled yet.
+def previous_backend(version: str) -> FingerprintBackend:
+    conf = get_backfill_config()
+    if version != conf["previous_model_version"] or not conf["previous_model_url"]:
+        raise ModelUnavailable(f"No model server computes {version} fingerprints")
+
+    with _previous_lock:
+        if version not in _previous_backends:
+            client = ModelClient(
+                conf["previous_model_url"],
+                expected_dim=settings.get("fingerprint_dim"),
+            )
+            _previous_backends[version] = HTTPBackend(client)
+
+        return _previous_backends[version]
+
+
+# Filter for the samples that still need a fingerprint of the given version
+def outstanding(version: str):
+    has_pending = exists().where(
+        and_(
+            PendingFingerprint.sample_id == SampleEval.id,
+            PendingFingerprint.model_version == version,
+        )
+    )
+    return and_(
+        or_(SampleEval.model_version.is_(None), SampleEval.model_version != version),
+        ~has_pending,
+    )
+
+
+# Users with samples that aren't at the given version yet, or who haven't been
+# moved to it
+def users_to_backfill(version: str) -> list[int]:
+    behind = db.session.query(SampleEval.user_id).filter(outstanding(version))
+    users = db.session.query(User.id).filter(
+        or_(
+            User.model_version.is_(None),
+            User.model_version != version,
+            User.id.in_(behind),
+        )
+    )
+    return [user_id for (user_id,) in users.order_by(User.id)]
+
+
+# Runs on the pool, so it mustn't touch the database
+def fingerprint_file(backend: FingerprintBackend, image_path: str) -> np.ndarray:
+    with open(image_path, "rb") as image_fp:
+        return np.asarray(backend.fingerprint(image_fp), dtype=np.float32)
+
+
+class Backfill:
+    """
+    Backfills users onto one model version, batch_size samples per transaction and
+    with up to workers images being fingerprinted at once. If drop_missing is set,
+    samples whose image is missing are deleted so that their user can move.
+    """
+
+    def __init__(
+        self,
+        backend: FingerprintBackend,
+        version: Optional[str] = None,
+        workers: Optional[int] = None,
+        batch_size: Optional[int] = None,
+        pause: float = 0.0,
+        drop_missing: bool = False,
+    ):
+        conf = get_backfill_config()
+        self.backend = backend
+        self.version = version or get_model_version()
+        self.workers = workers or conf["workers"]
+        self.batch_size = batch_size or conf["batch_size"]
+        self.pause = pause
+        self.drop_missing = drop_missing
+
+    # Backfill the given users, or everyone who needs it. Returns a report for
+    # each user.
+    def run(self, user_ids: Optional[list[int]] = None) -> list[dict]:
+        if user_ids is None:
+            user_ids = users_to_backfill(self.version)
+
+        reports = []
+        with ThreadPoolExecutor(self.workers) as pool:
+            for user_id in user_ids:
+                reports.append(self.backfill_user(pool, user_id))
+
+        return reports
+
+    def backfill_user(self, pool: ThreadPoolExecutor, user_id: int) -> dict:
+        report = {
+            "user_id": user_id,
+            "computed": 0,
+            "cached": 0,
+            "failed": 0,
+            "missing": [],
+        }
+        last_id = 0
+        while True:
+            rows = (
+                db.session.query(SampleEval.id, UserImage.digest, UserImage.image_path)
+                .join(UserImage, SampleEval.image_id == UserImage.id)
+                .filter(
+                    SampleEval.user_id == user_id,
+                    SampleEval.id > last_id,
+                    outstanding(self.version),
+                )
+                .order_by(SampleEval.id)
+                .limit(self.batch_size)
+                .all()
+            )
+            if not rows:
+                break
+
+            self.backfill_batch(pool, user_id, rows, report)
+            last_id = rows[-1][0]
+            if self.pause > 0:
+                time.sleep(self.pause)
+
+        if report["missing"]:
+            if self.drop_missing:
+                drop_samples(user_id, report["missing"])
+                logger.warning(
+                    "User %d: deleted %d samples whose image is missing: %s",
+                    user_id,
+                    len(report["missing"]),
+                    report["missing"],
+                )
+            else:
+                logger.warning(
+                    "User %d can't move until %d samples whose image is missing "
+                    "are deleted (or run with --drop-missing): %s",
+                    user_id,
+                    len(report["missing"]),
+                    report["missing"],
+                )
+
+        report["swapped"] = swap_user(user_id, self.version)
+        return report
+
+    # Fingerprint one batch of samples and save the results as pending. Cache
+    # lookups and all database writes stay on this thread.
+    def backfill_batch(
+        self, pool: ThreadPoolExecutor, user_id: int, rows: list, report: dict
+    ) -> None:
+        futures = {}
+        for (sample_id, digest, image_path) in rows:
+            cached = None
+            if digest is not None:
+                cached = fingerprint_cache.get(digest, self.version)
+
+            if cached is not None:
+                self.add_pending(user_id, sample_id, cached)
+                report["cached"] += 1
+            elif image_path is None or not os.path.exists(image_path):
+                report["missing"].append(sample_id)
+            else:
+                future = pool.submit(fingerprint_file, self.backend, image_path)
+                futures[future] = (sample_id, digest)
+
+        try:
+            for future in as_completed(futures):
+                (sample_id, digest) = futures[future]
+                try:
+                    fingerprint = future.result()
+                except ModelUnavailable:
+                    # Stop here; the next run carries on from this batch
+                    raise
+                except Exception:
+                    logger.exception("Couldn't fingerprint sample %d", sample_id)
+                    report["failed"] += 1
+                    continue
+
+                self.add_pending(user_id, sample_id, fingerprint)
+                if digest is not None:
+                    fingerprint_cache.put(
+                        digest, fingerprint, self.version, commit=False
+                    )
+
+                report["computed"] += 1
+        finally:
+            # Whatever finished is kept, even if the model went away mid-batch
+            db.session.commit()
+
+    def add_pending(self, user_id: int, sample_id: int, fingerprint) -> None:
+        blob, dim, dtype = pack_fingerprint(fingerprint)
+        db.session.merge(
+            PendingFingerprint(
+                sample_id=sample_id,
+                model_version=self.version,
+                user_id=user_id,
+                fingerprint_blob=blob,
+                fingerprint_dim=dim,
+                fingerprint_dtype=dtype,
+            )
+        )
+
+
+# Delete some of a user's samples, the same way the user would
+def drop_samples(user_id: int, sample_ids: list[int]) -> None:
+    from .evaluation import delete_sample
+
+    user = db.session.get(User, user_id)
+    for sample_id in sample_ids:
+        sample = db.session.get(SampleEval, sample_id)
+        if sample is not None and sample.user_id == user_id:
+            delete_sample(user, sample)
+
+
+# Move a user to a model version if all of their samples have a fingerprint of it,
+# replacing the old fingerprints in one transaction. Returns whether they moved.
+def swap_user(user_id: int, version: str) -> bool:
+    from .authors import rebuild_user_summaries
+
+    # Writing first takes the database's write lock, so no sample can be added
+    # between the check and the swap
+    User.query.filter_by(id=user_id).update(
+        {User.samples_version: User.samples_version + 1},
+        synchronize_session=False,
+    )
+    missing = SampleEval.query.filter(
+        SampleEval.user_id == user_id, outstanding(version)
+    ).count()
+    if missing:
+        db.session.rollback()
+        return False
+
+    pending = PendingFingerprint.query.filter_by(
+        user_id=user_id, model_version=version
+    ).all()
+    if pending:
+        db.session.execute(
+            text(
+                "UPDATE sample SET fingerprint_blob = :blob, fingerprint_dim = :dim, "
+                "fingerprint_dtype = :dtype, fingerprint = '', model_version = :version "
+                "WHERE id = :id AND user_id = :user_id"
+            ),
+            [
+                {
+                    "id": row.sample_id,
+                    "user_id": user_id,
+                    "blob": row.fingerprint_blob,
+                    "dim": row.fingerprint_dim,
+                    "dtype": row.fingerprint_dtype,
+                    "version": version,
+                }
+                for row in pending
+            ],
+        )
+
+    PendingFingerprint.query.filter_by(user_id=user_id).delete(
+        synchronize_session=False
+    )
+    User.query.filter_by(id=user_id).update(
+        {User.model_version: version}, synchronize_session=False
+    )
+    db.session.expire_all()
+    rebuild_user_summaries(user_id)
+    db.session.commit()
+
+    # The user's IVF index holds the old fingerprints
+    ann_manager.forget(user_id)
+    return True
+
+
+if __name__ == "__main__":
+    from .main import create_app
+    from .migrate import upgrade_schema
+
+    conf = get_backfill_config()
+    parser = argparse.ArgumentParser(
+        description="Re-fingerprint stored images with a new model version."
+    )
+    parser.add_argument("--version", help="Defaults to model_version in the config")
+    parser.add_argument(
+        "--model-url",
+        help="Model server for the new version, if not the configured one",
+    )
+    parser.add_argument("--workers", type=int, default=conf["workers"])
+    parser.add_argument("--batch-size", type=int, default=conf["batch_size"])
+    parser.add_argument("--pause", type=float, default=0.05)
+    parser.add_argument("--user", type=int, action="append", dest="user_ids")
+    parser.add_argument(
+        "--drop-missing",
+        action="store_true",
+        help="Delete samples whose image is missing, so their users can move",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+
+    create_app()
+    db.create_all()
+    upgrade_schema(db)
+
+    if args.model_url:
+        backend = HTTPBackend(
+            ModelClient(args.model_url, expected_dim=settings.get("fingerprint_dim"))
+        )
+    else:
+        backend = backend_from_settings(settings)
+
+    backfill = Backfill(
+        backend,
+        args.version,
+        args.workers,
+        args.batch_size,
+        args.pause,
+        args.drop_missing,
+    )
+    try:
+        for report in backfill.run(args.user_ids):
+            logger.info(
+                "User %d: %d computed, %d cached, %d failed, %d missing, %s",
+                report["user_id"],
+                report["computed"],
+                report["cached"],
+                report["failed"],
+                len(report["missing"]),
+                "moved" if report["swapped"] else "not moved yet",
+            )
+    finally:
+        backend.close()
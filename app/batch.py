@@ -0,0 +1,371 @@
+"""
+    This module contains batch queries, which rank many unlabelled images against a
+    user's gallery at once. The uploads are spooled to the temp directory and a
+    batch_query job is enqueued, so the request returns straight away. The job
+    fingerprints the images on a thread pool, then ranks all of them together as one
+    query-by-gallery distance matrix (see RankingEngine.top_k_many), so the gallery
+    is loaded and scanned once however many images there are. Progress is saved as
+    it goes, and a job that is retried picks up from the images it hadn't finished.
+    The results can be downloaded as CSV or JSON.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import csv
+from datetime import datetime
+import io
+import os
+import traceback
+from typing import Iterator, Optional
+import numpy as np
+
+from .backfill import user_model_version
+from .fpcache import fingerprint_cache
+from .gallery import get_engine, get_gallery_versions
+from .ingest import (
+    IMAGE_EXTENSIONS,
+    IngestItem,
+    get_ingest_config,
+    iter_upload_items,
+    iter_zip_items,
+)
+from .jobs import enqueue, job_handler, job_queue, spool_upload
+from .main import settings
+from .models import BatchQuery, BatchQueryItem, User, db, image_digest
+from .ranking import DEFAULT_CHUNK_BYTES
+from .supervisor import ModelUnavailable
+from .uploads import ImageTooLarge, check_image
+
+
+DEFAULT_CONFIG = {
+    "workers": 4,
+    "default_k": 10,
+    "max_k": 1000,
+    "max_images": 1000,
+    "chunk_bytes": DEFAULT_CHUNK_BYTES,
+    "progress_every": 10,
+}
+
+CSV_COLUMNS = ["position", "filename", "rank", "sample_id", "name", "distance", "error"]
+
+
+def get_batch_config() -> dict:
+    return {**DEFAULT_CONFIG, **settings.get("batch_query", {})}
+
+
+class TooManyImages(ValueError):
+    pass
+
+
+# The images of a batch, from a zip archive or else from uploaded files. Images
+# with more than max_pixels pixels fail here, before anything decodes them.
+def iter_batch_items(archive_fp, uploads: list) -> Iterator[IngestItem]:
+    if archive_fp:
+        max_entry_bytes = get_ingest_config()["max_entry_bytes"]
+        items = iter_zip_items(archive_fp, {}, max_entry_bytes)
+    else:
+        items = iter_upload_items(uploads, {})
+
+    for item in items:
+        if item.status == "error":
+            pass
+        elif not item.filename.lower().endswith(IMAGE_EXTENSIONS):
+            item.fail("Only PNG and JPEG files are allowed")
+        else:
+            try:
+                check_image(io.BytesIO(item.data))
+            except ImageTooLarge as e:
+                item.fail(str(e))
+
+        yield item
+
+
+# Spool the images and enqueue the job that ranks them. Items that already failed
+# (e.g. too large) are kept, so they show up in the results with their error.
+def create_batch(user: User, items: Iterator[IngestItem], k: int) -> BatchQuery:
+    conf = get_batch_config()
+    batch = BatchQuery(user_id=user.id, k=k, status="pending")
+    batch_items: list[BatchQueryItem] = []
+    try:
+        for (position, item) in enumerate(items):
+            if position >= conf["max_images"]:
+                raise TooManyImages(f"At most {conf['max_images']} images are allowed")
+
+            batch_item = BatchQueryItem(position=position, filename=item.filename)
+            if item.status == "error":
+                batch_item.status = "error"
+                batch_item.error = item.error
+            else:
+                image_fp = io.BytesIO(item.data)
+                batch_item.digest = image_digest(image_fp)
+                batch_item.spool_path = spool_upload(image_fp, batch_item.digest)
+                item.data = None
+
+            batch_items.append(batch_item)
+    except Exception:
+        remove_spooled(batch_items)
+        raise
+
+    batch.total = len(batch_items)
+    batch.processed = sum(1 for item in batch_items if item.status == "error")
+    db.session.add(batch)
+    db.session.flush()
+
+    # One INSERT for all of the items, however many there are
+    for batch_item in batch_items:
+        batch_item.batch_id = batch.id
+
+    db.session.bulk_save_objects(batch_items)
+    batch.job = enqueue("batch_query", {"batch_id": batch.id})
+    db.session.commit()
+    job_queue.notify()
+    return batch
+
+
+def remove_spooled(items: list[BatchQueryItem]) -> None:
+    for item in items:
+        if item.spool_path is not None and os.path.exists(item.spool_path):
+            os.remove(item.spool_path)
+
+
+# Runs on the pool, so it mustn't touch the database
+def fingerprint_spooled(spool_path: str, model_version: str) -> np.ndarray:
+    from .evaluation import get_img_fingerprint
+
+    with open(spool_path, "rb") as image_fp:
+        return np.asarray(
+            get_img_fingerprint(image_fp, model_version), dtype=np.float32
+        )
+
+
+# Fingerprint the images that don't have one yet, with the model version of the
+# user's gallery, which is returned. Cache lookups and all database writes stay on
+# this thread; progress is committed every few images.
+def fingerprint_items(batch: BatchQuery, conf: dict) -> str:
+    pending = [item for item in batch.items if item.status == "pending"]
+
+    # Same model version as the gallery the images are ranked against
+    version = user_model_version(db.session.get(User, batch.user_id))
+    batch.status = "fingerprinting"
+    db.session.commit()
+
+    done: list[BatchQueryItem] = []
+
+    def finish(item: BatchQueryItem) -> None:
+        done.append(item)
+        batch.processed += 1
+        if len(done) % conf["progress_every"] == 0:
+            db.session.commit()
+
+    try:
+        with ThreadPoolExecutor(conf["workers"]) as pool:
+            futures = {}
+            for item in pending:
+                cached = fingerprint_cache.get(item.digest, version)
+                if cached is not None:
+                    item.fingerprint = cached
+                    item.status = "ready"
+                    finish(item)
+                else:
+                    future = pool.submit(fingerprint_spooled, item.spool_path, version)
+                    futures[future] = item
+
+            for future in as_completed(futures):
+                item = futures[future]
+                try:
+                    fingerprint = future.result()
+                except ModelUnavailable:
+                    # Leave the rest for when the job is retried
+                    raise
+                except Exception as e:
+                    traceback.print_exc()
+                    item.status = "error"
+                    item.error = f"Could not process image: {e}"
+                else:
+                    fingerprint_cache.put(
+                        item.digest, fingerprint, version, commit=False
+                    )
+                    item.fingerprint = fingerprint
+                    item.status = "ready"
+
+                finish(item)
+    finally:
+        db.session.commit()
+
+    return version
+
+
+# Rank every image fingerprinted with the given model version against the gallery
+# in one pass. Returns False, without ranking, if the gallery has moved to another
+# version since.
+def rank_items(batch: BatchQuery, conf: dict, version: str) -> bool:
+    batch.status = "ranking"
+    db.session.commit()
+
+    (samples_version, model_version) = get_gallery_versions(batch.user_id)
+    if model_version != version:
+        return False
+
+    ready = [item for item in batch.items if item.status == "ready"]
+    if ready:
+        engine = get_engine(batch.user_id, samples_version)
+        queries = np.stack([item.fingerprint for item in ready])
+        ranked = engine.top_k_many(queries, batch.k, conf["chunk_bytes"])
+        for (item, candidates) in zip(ready, ranked):
+            item.ranked = candidates
+            item.status = "done"
+
+    batch.status = "done"
+    batch.finished = datetime.utcnow()
+    db.session.commit()
+    return True
+
+
+# Mark the fingerprinted images as not done, so they are fingerprinted again
+def reset_ready(batch: BatchQuery) -> None:
+    for item in batch.items:
+        if item.status == "ready":
+            item.status = "pending"
+            item.fingerprint_blob = None
+            batch.processed -= 1
+
+    db.session.commit()
+
+
+@job_handler("batch_query")
+def run_batch_query(payload: dict) -> None:
+    batch = BatchQuery.query.get(payload["batch_id"])
+    if batch is None:
+        return
+
+    conf = get_batch_config()
+    try:
+        version = fingerprint_items(batch, conf)
+        while not rank_items(batch, conf, version):
+            # The backfill moved the user to a new model while the images were
+            # being fingerprinted; their spooled files are still here
+            reset_ready(batch)
+            version = fingerprint_items(batch, conf)
+
+        remove_spooled(batch.items)
+        for item in batch.items:
+            item.spool_path = None
+
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        batch = BatchQuery.query.get(payload["batch_id"])
+        batch.error = str(e)
+        db.session.commit()
+        raise
+
+
+# The batch's status, taking into account a job that has given up
+def batch_status(batch: BatchQuery) -> str:
+    if batch.status != "done" and batch.job is not None:
+        if batch.job.status == "failed":
+            return "failed"
+
+    return batch.status
+
+
+def batch_progress(batch: BatchQuery) -> dict:
+    return {
+        "id": batch.id,
+        "status": batch_status(batch),
+        "k": batch.k,
+        "total": batch.total,
+        "processed": batch.processed,
+        "error": batch.error,
+        "created": batch.created.isoformat() if batch.created else None,
+        "finished": batch.finished.isoformat() if batch.finished else None,
+    }
+
+
+# The candidates for each image of a finished batch, in upload order, with the
+# author names of the samples. Samples deleted since the batch ran are left out.
+def batch_results(batch: BatchQuery) -> list[dict]:
+    from .evaluation import get_sample_labels
+
+    ranked = {item.id: item.ranked for item in batch.items}
+    sample_ids = sorted({i for result in ranked.values() for (i, _) in result})
+    labels = get_sample_labels(batch.user_id, sample_ids)
+
+    results = []
+    for item in batch.items:
+        candidates = [
+            {
+                "id": sample_id,
+                "image_id": labels[sample_id][0],
+                "name": labels[sample_id][1],
+                "distance": round(distance, 6),
+            }
+            for (sample_id, distance) in ranked[item.id]
+            if sample_id in labels
+        ]
+        results.append(
+            {
+                "position": item.position,
+                "filename": item.filename,
+                "status": item.status,
+                "error": item.error,
+                "candidates": candidates,
+            }
+        )
+
+    return results
+
+
+# One row per candidate, plus a row for each image that failed
+def results_csv(results: list[dict]) -> str:
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(CSV_COLUMNS)
+    for result in results:
+        if not result["candidates"]:
+            writer.writerow(
+                [
+                    result["position"],
+                    result["filename"],
+                    "",
+                    "",
+                    "",
+                    "",
+                    result["error"],
+                ]
+            )
+
+        for (rank, candidate) in enumerate(result["candidates"], 1):
+            writer.writerow(
+                [
+                    result["position"],
+                    result["filename"],
+                    rank,
+                    candidate["id"],
+                    candidate["name"],
+                    candidate["distance"],
+                    "",
+                ]
+            )
+
+    return out.getvalue()
+
+
+# Read the k parameter for a new batch. None if it is out of range.
+def parse_k(value: Optional[int]) -> Optional[int]:
+    conf = get_batch_config()
+    if value is None:
+        return conf["default_k"]
+
+    if not 0 < value <= conf["max_k"]:
+        return None
+
+    return value
+
+
+# A batch of the user's, or None. Other users' batches are reported as missing.
+def get_own_batch(user: User, batch_id: int) -> Optional[BatchQuery]:
+    batch = BatchQuery.query.get(batch_id)
+    if batch is None or batch.user_id != user.id:
+        return None
+
+    return batch
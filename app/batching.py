@@ -0,0 +1,116 @@
+"""
+    This module contains the micro-batching layer in front of the model server.
+    Requests arriving within a short window of each other (or until the batch is full)
+    are sent to the model as one multi-image call, and the results are handed back to
+    each waiting request thread.
+"""
+
+from concurrent.futures import Future
+import queue
+import threading
+import time
+from typing import BinaryIO, Optional
+
+from .modelclient import ModelClient
+
+
+DEFAULT_CONFIG = {
+    "enabled": False,
+    "window_ms": 10,
+    "max_batch": 16,
+    "timeout": 60.0,
+}
+
+
+class FingerprintBatcher:
+    """
+    Collects fingerprint requests from many threads and dispatches them in batches
+    from a single background thread.
+    """
+
+    def __init__(
+        self,
+        client: ModelClient,
+        window: float = DEFAULT_CONFIG["window_ms"] / 1000,
+        max_batch: int = DEFAULT_CONFIG["max_batch"],
+        timeout: float = DEFAULT_CONFIG["timeout"],
+    ):
+        self.client = client
+        self.window = window
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self.pending: queue.Queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+        self.batches = 0
+        self.images = 0
+
+    @classmethod
+    def from_settings(cls, client: ModelClient, settings: dict) -> "FingerprintBatcher":
+        conf = {**DEFAULT_CONFIG, **settings.get("batching", {})}
+        return cls(
+            client,
+            window=conf["window_ms"] / 1000,
+            max_batch=conf["max_batch"],
+            timeout=conf["timeout"],
+        )
+
+    # Queue an image and get a future for its fingerprint
+    def submit(self, data: bytes) -> Future:
+        self._ensure_running()
+        future: Future = Future()
+        self.pending.put((data, future))
+        return future
+
+    # Get the fingerprint of one image, blocking until its batch has been processed
+    def fingerprint(self, image_fp: BinaryIO) -> list[float]:
+        image_fp.seek(0)
+        return self.submit(image_fp.read()).result(timeout=self.timeout)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "batches": self.batches,
+                "images": self.images,
+                "mean_batch": self.images / self.batches if self.batches else 0.0,
+            }
+
+    def _ensure_running(self) -> None:
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def _run(self) -> None:
+        while True:
+            batch = [self.pending.get()]
+
+            # Keep collecting until the window closes or the batch is full
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+
+                try:
+                    batch.append(self.pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            self._dispatch(batch)
+
+    def _dispatch(self, batch: list) -> None:
+        with self.lock:
+            self.batches += 1
+            self.images += len(batch)
+
+        try:
+            results = self.client.fingerprint_batch([data for (data, _) in batch])
+        except Exception as e:
+            for (_, future) in batch:
+                future.set_exception(e)
+
+            return
+
+        for ((_, future), fingerprint) in zip(batch, results):
+            future.set_result(fingerprint)
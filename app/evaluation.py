@@ -3,62 +3,228 @@
     model.
 """
 
-import json
+from functools import partial
 import traceback
-from typing import BinaryIO
-import requests
+import zipfile
+from typing import BinaryIO, Optional
 import numpy as np
 import os
 
 from flask import (
     Blueprint,
     Response,
+    jsonify,
     make_response,
     redirect,
     render_template,
+    request,
     abort,
     url_for,
 )
 from flask_login import current_user, login_required
 
 from .models import UserImage, db, SampleEval
-from .forms import LabelledSampleForm, UnlabelledSampleForm
+from .authors import add_to_summary, remove_from_summary
+from .backends import backend_from_settings
+from .backfill import previous_backend, user_model_version
+from .batch import (
+    TooManyImages,
+    batch_progress,
+    batch_results,
+    batch_status,
+    create_batch,
+    get_own_batch,
+    iter_batch_items,
+    parse_k,
+    results_csv,
+)
+from .forms import (
+    BatchQueryForm,
+    BulkSampleForm,
+    LabelledSampleForm,
+    UnlabelledSampleForm,
+)
+from .fpcache import fingerprint_cache, get_model_version
+from .ingest import (
+    BulkIngester,
+    get_ingest_config,
+    iter_upload_items,
+    iter_zip_items,
+    parse_manifest,
+)
+from .imagestore import image_store
+from .jobs import enqueue_store_image, job_queue
+from .gallery import gallery_cache, rank_gallery
 from .main import settings
+from .metrics import MODEL_FAILURES, stage_timer
+from .querycount import query_budget
+from .supervisor import ModelUnavailable
+from .pagination import get_pagination_config, load_ranking, page_samples, save_ranking
+from .uploads import ImageTooLarge, UploadInfo, inspect_upload
 
 
 evalviews = Blueprint("evalviews", __name__, template_folder="templates/")
 
+# The views only see the FingerprintBackend interface (see backends.py)
+fingerprint_backend = backend_from_settings(settings)
+
+# Keep IN (...) lists well under SQLite's bound parameter limit
+MAX_IN_PARAMS = 500
+
+
+# Query the model to get a fingerprint for an image, from the previous model if the
+# user it is for hasn't been backfilled onto the current one yet
+def get_img_fingerprint(
+    image_fp: BinaryIO, model_version: Optional[str] = None
+) -> list[float]:
+    backend = fingerprint_backend
+    if model_version is not None and model_version != get_model_version():
+        backend = previous_backend(model_version)
+
+    with stage_timer("fingerprint"):
+        try:
+            return backend.fingerprint(image_fp)
+        except Exception:
+            MODEL_FAILURES.inc()
+            raise
+
+
+# Error page for when the model server is down or still starting up
+def model_unavailable(error: ModelUnavailable) -> Response:
+    return make_response(
+        render_template(
+            "error.html",
+            err_msg=f"The ID model isn't available right now. Please try again shortly. {error}",
+        ),
+        503,
+    )
+
+
+# Error page for an image over the upload limits
+def image_too_large(error: ImageTooLarge) -> Response:
+    return make_response(render_template("error.html", err_msg=str(error)), 413)
+
+
+# Get the fingerprint for an uploaded image, asking the model only if we haven't seen
+# this exact image before. The image is checked against the upload limits first.
+# Returns the fingerprint along with the image's digest and MIME type.
+def fingerprint_upload(
+    image_fp: BinaryIO, model_version: Optional[str] = None
+) -> tuple[np.ndarray, UploadInfo]:
+    upload = inspect_upload(image_fp)
+    fingerprint = fingerprint_cache.get(upload.digest, model_version)
+    if fingerprint is None:
+        fingerprint = np.asarray(
+            get_img_fingerprint(image_fp, model_version), dtype=np.float32
+        )
+        fingerprint_cache.put(upload.digest, fingerprint, model_version)
+
+    return fingerprint, upload
+
+
+# Load the given samples belonging to a user, keyed by id
+def get_samples_by_id(user, sample_ids: list[int]) -> dict[int, SampleEval]:
+    if len(sample_ids) > MAX_IN_PARAMS:
+        # Too many to list in one query; the whole gallery is wanted anyway
+        samples = SampleEval.query.filter_by(user_id=user.id).all()
+    else:
+        samples = SampleEval.query.filter(
+            SampleEval.user_id == user.id, SampleEval.id.in_(sample_ids)
+        ).all()
+
+    return {sample.id: sample for sample in samples}
+
 
-# Query the model to get a fingerprint for an image
-def get_img_fingerprint(image_fp: BinaryIO) -> list[float]:
-    query_url = f"http://{settings['modelServerIP']}:{settings['modelServerPort']}/"
-    files = {"rq_image": image_fp}
-    res = requests.post(query_url, files=files)
+# The image id and name of each of the given samples of a user, without loading
+# their fingerprints
+def get_sample_labels(user_id: int, sample_ids: list[int]) -> dict[int, tuple]:
+    query = db.session.query(
+        SampleEval.id, SampleEval.image_id, SampleEval.name
+    ).filter(SampleEval.user_id == user_id)
+    if len(sample_ids) <= MAX_IN_PARAMS:
+        query = query.filter(SampleEval.id.in_(sample_ids))
 
-    return res.json()
+    return {row[0]: (row[1], row[2]) for row in query}
+
+
+# Add a labelled sample for the user from an uploaded image. Returns the new sample.
+def add_sample(user, image_fp: BinaryIO, name: str) -> SampleEval:
+    # Fingerprinted by the same model as the rest of the user's gallery. The backfill
+    # can move the user to a new model in the meantime, so the version is checked
+    # again by the first write, which holds the database's write lock until commit.
+    while True:
+        version = user_model_version(user)
+        fingerprint, upload = fingerprint_upload(image_fp, version)
+        if upload.mimetype is None:
+            raise ValueError("This isn't an image that can be stored")
+
+        if user.bump_samples_version(version):
+            break
+
+        # Moved; rolling back also reloads the user's model version
+        db.session.rollback()
+
+    # If the store doesn't have this image yet, its files are written by a
+    # background job (which takes over the spooled upload), so we only need to
+    # wait for the fingerprint here
+    digest = upload.digest
+    stored = image_store.acquire(digest, upload.mimetype)
+    new_image = UserImage(user, digest=digest, stored=stored)
+    new_image.ready = image_store.exists(digest)
+    db.session.add(new_image)
+
+    new_eval = SampleEval(
+        new_image, name=name, fingerprint=fingerprint, model_version=version
+    )
+    db.session.add(new_eval)
+    add_to_summary(user.id, name, fingerprint)
+    if not new_image.ready:
+        enqueue_store_image(new_image, image_fp, digest)
+
+    db.session.commit()
+    job_queue.notify()
+
+    gallery_cache.add_sample(
+        user.id, user.samples_version, new_eval.id, new_eval.fingerprint
+    )
+    return new_eval
+
+
+# Delete one of the user's samples along with its image
+def delete_sample(user, sample: SampleEval) -> None:
+    sample_id = sample.id
+    image = sample.image
+    db.session.delete(image)
+    db.session.delete(sample)
+    remove_from_summary(user.id, sample.name, sample.fingerprint)
+    user.bump_samples_version()
+    if image.digest is not None:
+        # Other samples may share the stored files, so only drop our reference
+        image_store.release(image.digest)
+    else:
+        # Saved before the image store existed, so the files are ours alone
+        for path in (image.image_path, image.thumbnail_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    db.session.commit()
+
+    gallery_cache.remove_sample(user.id, user.samples_version, sample_id)
 
 
 # Add a new labelled image.
 @evalviews.route("/new", methods=["GET", "POST"])
 @login_required
+@query_budget(17)
 def new_sample() -> Response:
     form = LabelledSampleForm()
     if form.validate_on_submit():
         try:
-            image_fp = form.attachment.data
-            fingerprint_json = json.dumps(get_img_fingerprint(image_fp))
-
-            new_image = UserImage(current_user, image_fp)
-            db.session.add(new_image)
-            db.session.commit()
-
-            new_eval = SampleEval(
-                new_image,
-                name=form.name.data,
-                fingerprint=fingerprint_json,
-            )
-            db.session.add(new_eval)
-            db.session.commit()
+            add_sample(current_user, form.attachment.data, form.name.data)
+        except ImageTooLarge as e:
+            return image_too_large(e)
+        except ModelUnavailable as e:
+            return model_unavailable(e)
         except Exception:
             traceback.print_exc()
             return make_response(
@@ -69,32 +235,69 @@ def new_sample() -> Response:
                 500,
             )
 
-    user_evals = SampleEval.query.filter_by(user=current_user).order_by(
-        SampleEval.timestamp.desc()
+    # One page of the list at a time, continuing from the cursor in ?after=
+    user_evals, next_cursor = page_samples(current_user, request.args.get("after"))
+    next_url = None
+    if next_cursor is not None:
+        next_url = url_for(".new_sample", after=next_cursor)
+
+    return render_template(
+        "eval/labelled.html", form=form, list_evals=user_evals, next_url=next_url
     )
-    if user_evals.count() == 0:
-        return render_template("eval/labelled.html", form=form)
 
-    return render_template("eval/labelled.html", form=form, list_evals=user_evals)
+
+# Add many labelled images at once, from a zip archive or a multi-file upload
+@evalviews.route("/bulk", methods=["GET", "POST"])
+@login_required
+def bulk_samples() -> Response:
+    form = BulkSampleForm()
+    if not form.validate_on_submit():
+        return render_template("eval/bulk.html", form=form)
+
+    manifest = {}
+    if form.manifest.data:
+        manifest = parse_manifest(form.manifest.data)
+
+    uploads = [
+        upload for upload in form.attachments.data or [] if upload and upload.filename
+    ]
+    version = user_model_version(current_user)
+    get_fingerprint = partial(get_img_fingerprint, model_version=version)
+    if form.archive.data:
+        try:
+            items = iter_zip_items(
+                form.archive.data, manifest, get_ingest_config()["max_entry_bytes"]
+            )
+            report = BulkIngester(
+                current_user, get_fingerprint, model_version=version
+            ).run(items)
+        except zipfile.BadZipFile:
+            form.archive.errors.append("This isn't a valid zip archive.")
+            return make_response(render_template("eval/bulk.html", form=form), 400)
+    elif uploads:
+        items = iter_upload_items(uploads, manifest)
+        report = BulkIngester(current_user, get_fingerprint, model_version=version).run(
+            items
+        )
+    else:
+        form.archive.errors.append("Upload a zip archive or some images.")
+        return make_response(render_template("eval/bulk.html", form=form), 400)
+
+    # Many samples changed at once, so let the next query reload the gallery
+    gallery_cache.invalidate(current_user.id)
+    return render_template("eval/bulk.html", form=form, report=report)
 
 
 # Delete a previously uploaded sample
 @evalviews.route("/del/<int:sample_id>")
 @login_required
+@query_budget(12)
 def del_sample(sample_id: int) -> Response:
     sample = SampleEval.query.get_or_404(sample_id)
-    if sample.user != current_user:
+    if sample.user_id != current_user.id:
         abort(401)
 
-    if os.path.exists(sample.image.image_path):
-        os.remove(sample.image.image_path)
-
-    if os.path.exists(sample.image.thumbnail_path):
-        os.remove(sample.image.thumbnail_path)
-
-    db.session.delete(sample.image)
-    db.session.delete(sample)
-    db.session.commit()
+    delete_sample(current_user, sample)
 
     return redirect(url_for(".new_sample"))
 
@@ -102,28 +305,29 @@ def del_sample(sample_id: int) -> Response:
 # Get a ranked candidate list for an unlabelled sample
 @evalviews.route("/query", methods=["GET", "POST"])
 @login_required
+@query_budget(12)
 def query_model() -> Response:
     form = UnlabelledSampleForm()
-    sample_evals = current_user.samples
+    conf = get_pagination_config()
     if form.validate_on_submit():
         try:
             image_fp = form.attachment.data
-            fingerprint = get_img_fingerprint(image_fp)
-
-            distances = []
-            for labelled in sample_evals:
-                compare_to = json.loads(labelled.fingerprint)
-                distances.append(
-                    np.linalg.norm(np.asarray(fingerprint) - np.asarray(compare_to))
-                )
-
-            # Get the distances in ascending order while preserving knowledge of indices
-            distances = sorted(list(enumerate(distances)), key=lambda t: t[1])
-
-            # Produce a ranked list of labelled samples based on proximity to unlabelled upload
-            ranked = [(sample_evals[i], dist) for (i, dist) in distances]
-            ranked = [r for (r, _) in ranked]
-            return render_template("eval/query.html", form=form, ranked=ranked)
+            fingerprint, _ = fingerprint_upload(
+                image_fp, user_model_version(current_user)
+            )
+
+            # Rank against the user's resident gallery, and keep the ranking so that
+            # later pages don't need to do it again
+            top_k = settings.get("query_top_k") or conf["query_max_results"]
+            with stage_timer("ranking"):
+                ranked = rank_gallery(current_user.id, fingerprint, top_k)
+
+            token = save_ranking(current_user, ranked)
+            return render_ranked_page(form, ranked, token, 0)
+        except ImageTooLarge as e:
+            return image_too_large(e)
+        except ModelUnavailable as e:
+            return model_unavailable(e)
         except Exception:
             traceback.print_exc()
             return make_response(
@@ -134,4 +338,114 @@ def query_model() -> Response:
                 500,
             )
 
-    return render_template("eval/query.html", form=form, ranked=sample_evals)
+    # Nothing to rank against yet, so show the newest samples
+    newest, _ = page_samples(current_user, page_size=conf["query_page_size"])
+    return render_template("eval/query.html", form=form, ranked=newest)
+
+
+# Later pages of a query's results, from the ranking saved under the token
+@evalviews.route("/query/<token>")
+@login_required
+@query_budget(4)
+def query_results(token: str) -> Response:
+    ranked = load_ranking(current_user, token)
+    if ranked is None:
+        # Expired, so the query has to be run again
+        return redirect(url_for(".query_model"))
+
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    return render_ranked_page(UnlabelledSampleForm(), ranked, token, offset)
+
+
+# Render one page of ranked results, loading only the samples on that page
+def render_ranked_page(
+    form: UnlabelledSampleForm, ranked: list[tuple[int, float]], token: str, offset: int
+) -> Response:
+    page_size = get_pagination_config()["query_page_size"]
+    page = ranked[offset : offset + page_size]
+    by_id = get_samples_by_id(current_user, [i for (i, _) in page])
+
+    # Samples deleted since the query ran are left out
+    samples = [by_id[sample_id] for (sample_id, _) in page if sample_id in by_id]
+    next_url = None
+    if offset + page_size < len(ranked):
+        next_url = url_for(".query_results", token=token, offset=offset + page_size)
+
+    return render_template(
+        "eval/query.html",
+        form=form,
+        ranked=samples,
+        offset=offset,
+        next_url=next_url,
+    )
+
+
+# Rank many unlabelled images at once, from a zip archive or a multi-file upload.
+# The ranking runs as a background job, and the batch's page shows its progress.
+@evalviews.route("/batch", methods=["GET", "POST"])
+@login_required
+def batch_query() -> Response:
+    form = BatchQueryForm()
+    if not form.validate_on_submit():
+        return render_template("eval/batch.html", form=form)
+
+    k = parse_k(form.k.data)
+    uploads = [
+        upload for upload in form.attachments.data or [] if upload and upload.filename
+    ]
+    if k is None:
+        form.k.errors.append("That's out of range.")
+    elif not form.archive.data and not uploads:
+        form.archive.errors.append("Upload a zip archive or some images.")
+    else:
+        try:
+            items = iter_batch_items(form.archive.data, uploads)
+            batch = create_batch(current_user, items, k)
+            return redirect(url_for(".batch_page", batch_id=batch.id))
+        except zipfile.BadZipFile:
+            form.archive.errors.append("This isn't a valid zip archive.")
+        except TooManyImages as e:
+            form.archive.errors.append(str(e))
+
+    return make_response(render_template("eval/batch.html", form=form), 400)
+
+
+# Progress of a batch query, and its results once it's done
+@evalviews.route("/batch/<int:batch_id>")
+@login_required
+def batch_page(batch_id: int) -> Response:
+    batch = get_own_batch(current_user, batch_id)
+    if batch is None:
+        abort(404)
+
+    status = batch_status(batch)
+    results = batch_results(batch) if status == "done" else None
+    return render_template(
+        "eval/batch_status.html",
+        batch=batch_progress(batch),
+        results=results,
+    )
+
+
+# Download the results of a finished batch query as CSV or JSON
+@evalviews.route("/batch/<int:batch_id>/results.<fmt>")
+@login_required
+def batch_download(batch_id: int, fmt: str) -> Response:
+    batch = get_own_batch(current_user, batch_id)
+    if batch is None or fmt not in ("csv", "json"):
+        abort(404)
+
+    if batch_status(batch) != "done":
+        abort(409)
+
+    results = batch_results(batch)
+    if fmt == "csv":
+        response = make_response(results_csv(results))
+        response.mimetype = "text/csv"
+    else:
+        response = jsonify({**batch_progress(batch), "results": results})
+
+    response.headers[
+        "Content-Disposition"
+    ] = f"attachment; filename=batch-{batch.id}.{fmt}"
+    return response
@@ -0,0 +1,49 @@
+"""
+    This module contains the helpers for storing fingerprints in binary form.
+    Fingerprints are stored as packed little-endian float32 together with their
+    dimension and dtype, so they can be read back without copying via np.frombuffer.
+"""
+
+import json
+from typing import Iterable, Optional
+import numpy as np
+
+
+FINGERPRINT_DTYPE = "<f4"
+
+
+# Pack a fingerprint into bytes. Returns the blob along with its dimension and dtype.
+def pack_fingerprint(values: Iterable[float]) -> tuple[bytes, int, str]:
+    array = np.asarray(values, dtype=FINGERPRINT_DTYPE).ravel()
+    return array.tobytes(), array.shape[0], FINGERPRINT_DTYPE
+
+
+# Read a packed fingerprint back. The returned array is a read-only view of the blob.
+def unpack_fingerprint(
+    blob: bytes, dim: Optional[int] = None, dtype: Optional[str] = None
+) -> np.ndarray:
+    array = np.frombuffer(blob, dtype=dtype or FINGERPRINT_DTYPE)
+    if dim is not None and array.shape[0] != dim:
+        raise ValueError(
+            f"Fingerprint blob holds {array.shape[0]} values, expected {dim}"
+        )
+
+    return array
+
+
+# Decode a fingerprint stored in either the packed or the legacy JSON format
+def decode_fingerprint(
+    blob: Optional[bytes],
+    dim: Optional[int],
+    dtype: Optional[str],
+    fingerprint_json: str,
+) -> np.ndarray:
+    if blob is None:
+        return np.asarray(json.loads(fingerprint_json), dtype=FINGERPRINT_DTYPE)
+
+    return unpack_fingerprint(blob, dim, dtype)
+
+
+# Convert a legacy JSON-encoded fingerprint to the packed format
+def pack_json_fingerprint(fingerprint_json: str) -> tuple[bytes, int, str]:
+    return pack_fingerprint(json.loads(fingerprint_json))
@@ -8,10 +8,10 @@
 
 from wsgiref.validate import validator
 from flask_wtf import FlaskForm
-from flask_wtf.file import FileField, FileRequired, FileAllowed
+from flask_wtf.file import FileField, FileRequired, FileAllowed, MultipleFileField
 from flask_uploads import UploadSet, IMAGES, extension
-from wtforms import EmailField, StringField, PasswordField, SubmitField
-from wtforms.validators import DataRequired, Email
+from wtforms import EmailField, IntegerField, StringField, PasswordField, SubmitField
+from wtforms.validators import DataRequired, Email, Optional
 
 
 image_extensions = ["png", "jpg", "jpeg"]
@@ -62,3 +62,28 @@ class UnlabelledSampleForm(FlaskForm):
     )
 
     submit = SubmitField("Upload")
+
+
+class BulkSampleForm(FlaskForm):
+    archive = FileField(
+        "Zip archive (one folder per student)",
+        validators=[FileAllowed(["zip"], "Only zip archives are allowed.")],
+    )
+    attachments = MultipleFileField("Or several sample images")
+    manifest = FileField(
+        "Manifest (optional CSV of file name, student name)",
+        validators=[FileAllowed(["csv"], "The manifest must be a CSV file.")],
+    )
+
+    submit = SubmitField("Upload samples")
+
+
+class BatchQueryForm(FlaskForm):
+    archive = FileField(
+        "Zip archive of unlabelled images",
+        validators=[FileAllowed(["zip"], "Only zip archives are allowed.")],
+    )
+    attachments = MultipleFileField("Or several unlabelled images")
+    k = IntegerField("Candidates per image", validators=[Optional()])
+
+    submit = SubmitField("Rank images")
@@ -0,0 +1,215 @@
+"""
+    This module contains the persistent cache of fingerprints returned by the model,
+    keyed by the SHA-1 of the image plus the model version. Uploading or querying
+    the same scan twice then skips the model server entirely. The cache never
+    commits or rolls back the caller's session: its own writes go through a session
+    of their own, and hits are recorded once the caller's transaction is over.
+"""
+
+from datetime import datetime, timedelta
+import threading
+from typing import Optional
+import numpy as np
+from sqlalchemy import bindparam, event
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session, SessionTransaction
+
+from .fingerprints import pack_fingerprint, unpack_fingerprint
+from .main import settings
+from .metrics import record_cache_lookup
+from .models import CachedFingerprint, db
+
+
+DEFAULT_MAX_ENTRIES = 100000
+
+# Only record a hit in the database if the entry hasn't been touched for this long,
+# so that a busy cache doesn't turn every read into a write
+TOUCH_INTERVAL = timedelta(hours=1)
+
+# How many inserts to allow between checks of the cache size
+EVICT_CHECK_EVERY = 64
+
+# Where a session keeps the entries that were hit, to touch once its transaction ends
+TOUCH_KEY = "fingerprint_cache_touch"
+
+
+# The version of the model currently serving fingerprints
+def get_model_version() -> str:
+    return str(settings.get("model_version", "default"))
+
+
+class FingerprintCache:
+    """
+    Fingerprint cache backed by the fingerprint_cache table. Once it holds more than
+    max_entries rows, the least recently used tenth of them is evicted.
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.inserts_since_check = 0
+
+    def get(
+        self, digest: str, model_version: Optional[str] = None
+    ) -> Optional[np.ndarray]:
+        model_version = model_version or get_model_version()
+        entry = db.session.get(CachedFingerprint, (digest, model_version))
+        record_cache_lookup("fingerprint", entry is not None)
+        if entry is None:
+            with self.lock:
+                self.misses += 1
+
+            return None
+
+        with self.lock:
+            self.hits += 1
+
+        fingerprint = unpack_fingerprint(
+            entry.fingerprint_blob, entry.fingerprint_dim, entry.fingerprint_dtype
+        )
+        if (
+            entry.last_used is None
+            or datetime.utcnow() - entry.last_used > TOUCH_INTERVAL
+        ):
+            touched = db.session.info.setdefault(TOUCH_KEY, set())
+            touched.add((digest, model_version))
+
+        return fingerprint
+
+    # Cache a fingerprint. With commit=False the entry is only added to the session,
+    # so it goes in with the caller's own transaction. Otherwise it is written right
+    # away in a transaction of its own, which has to wait if the caller's transaction
+    # has already written something, so those callers should use commit=False.
+    def put(
+        self,
+        digest: str,
+        fingerprint,
+        model_version: Optional[str] = None,
+        commit: bool = True,
+    ) -> None:
+        blob, dim, dtype = pack_fingerprint(fingerprint)
+        entry = CachedFingerprint(
+            digest=digest,
+            model_version=model_version or get_model_version(),
+            fingerprint_blob=blob,
+            fingerprint_dim=dim,
+            fingerprint_dtype=dtype,
+            last_used=datetime.utcnow(),
+        )
+        if not commit:
+            # merge rather than add, in case another worker cached the same image
+            # meanwhile
+            db.session.merge(entry)
+            return
+
+        with self._session() as session:
+            session.merge(entry)
+            self._commit(session)
+
+        with self.lock:
+            self.inserts_since_check += 1
+            check = self.inserts_since_check >= EVICT_CHECK_EVERY
+            if check:
+                self.inserts_since_check = 0
+
+        if check:
+            self.evict()
+
+    # Trim the cache back down to 90% of max_entries, oldest entries first
+    def evict(self) -> int:
+        with self._session() as session:
+            count = session.query(CachedFingerprint).count()
+            if count <= self.max_entries:
+                return 0
+
+            # Everything used no later than the excess-th oldest entry goes
+            excess = count - int(self.max_entries * 0.9)
+            cutoff = (
+                session.query(CachedFingerprint.last_used)
+                .order_by(CachedFingerprint.last_used)
+                .offset(excess - 1)
+                .limit(1)
+                .scalar()
+            )
+            deleted = (
+                session.query(CachedFingerprint)
+                .filter(CachedFingerprint.last_used <= cutoff)
+                .delete(synchronize_session=False)
+            )
+            if not self._commit(session):
+                return 0
+
+        with self.lock:
+            self.evictions += deleted
+
+        return deleted
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    # A session for the cache's own writes, apart from the caller's
+    @staticmethod
+    def _session() -> Session:
+        return Session(db.engine)
+
+    # The cache is only an optimization, so failing to write to it mustn't fail the request
+    @staticmethod
+    def _commit(session: Session) -> bool:
+        try:
+            session.commit()
+            return True
+        except SQLAlchemyError:
+            session.rollback()
+            return False
+
+
+# Record the hits from a session once its transaction is over, with a connection of
+# our own. By then the caller's transaction no longer holds the database's write
+# lock, whether it was committed or rolled back.
+def _touch_entries(session: Session, transaction: SessionTransaction) -> None:
+    if transaction.parent is not None:
+        return
+
+    touched = session.info.pop(TOUCH_KEY, None)
+    if not touched:
+        return
+
+    table = CachedFingerprint.__table__
+    touch = (
+        table.update()
+        .where(
+            table.c.digest == bindparam("entry_digest"),
+            table.c.model_version == bindparam("entry_version"),
+        )
+        .values(last_used=datetime.utcnow())
+    )
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(
+                touch,
+                [
+                    {"entry_digest": digest, "entry_version": version}
+                    for (digest, version) in touched
+                ],
+            )
+    except SQLAlchemyError:
+        pass
+
+
+if not event.contains(Session, "after_transaction_end", _touch_entries):
+    event.listen(Session, "after_transaction_end", _touch_entries)
+
+
+fingerprint_cache = FingerprintCache(
+    settings.get("fingerprint_cache_entries", DEFAULT_MAX_ENTRIES)
+)
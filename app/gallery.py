@@ -0,0 +1,235 @@
+"""
+    This module contains the process-level cache of each active user's fingerprint
+    gallery, kept resident as a ranking engine (fingerprint matrix plus sample ids).
+    Entries are tagged with the user's samples_version from the database. Views update
+    them in place when they add or delete a sample, and any worker that sees a newer
+    version in the database knows its own copy is stale and reloads it.
+"""
+
+from collections import OrderedDict
+import threading
+from typing import Callable, Optional
+import numpy as np
+
+from .ann import ann_manager
+from .fingerprints import decode_fingerprint, unpack_fingerprint
+from .fpcache import get_model_version
+from .main import settings
+from .metrics import record_cache_lookup
+from .models import SampleEval, User, db
+from .ranking import RankingEngine
+
+
+DEFAULT_BUDGET = 256 * 1024 * 1024
+
+
+class GalleryCache:
+    """
+    LRU cache of ranking engines keyed by user id. When the engines together hold
+    more than budget_bytes, the least recently used users are evicted first.
+    """
+
+    def __init__(self, budget_bytes: int = DEFAULT_BUDGET, name: str = "gallery"):
+        self.budget_bytes = budget_bytes
+        self.name = name
+        self.lock = threading.Lock()
+        self.entries: OrderedDict[int, tuple[int, RankingEngine]] = OrderedDict()
+        self.total_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self.entries
+
+    # Get a user's engine at the given version, calling loader to build it if the cached
+    # copy is missing or stale
+    def get(
+        self, user_id: int, version: int, loader: Callable[[], RankingEngine]
+    ) -> RankingEngine:
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is not None and entry[0] == version:
+                self.entries.move_to_end(user_id)
+                record_cache_lookup(self.name, True)
+                return entry[1]
+
+        record_cache_lookup(self.name, False)
+
+        # Load without holding the lock, so other users' queries aren't held up
+        engine = loader()
+        self.put(user_id, version, engine)
+        return engine
+
+    def put(self, user_id: int, version: int, engine: RankingEngine) -> None:
+        with self.lock:
+            self._drop(user_id)
+            self.entries[user_id] = (version, engine)
+            self.total_bytes += engine.nbytes
+            self._evict()
+
+    # Drop a user's entry entirely
+    def invalidate(self, user_id: int) -> None:
+        with self.lock:
+            self._drop(user_id)
+
+    # Apply a newly added sample. The entry is only patched if it was exactly one
+    # version behind; otherwise some other worker changed the gallery too and the
+    # entry is dropped so it gets reloaded.
+    def add_sample(
+        self, user_id: int, version: int, sample_id: int, fingerprint
+    ) -> None:
+        self._patch(
+            user_id, version, lambda engine: engine.with_sample(sample_id, fingerprint)
+        )
+
+    def remove_sample(self, user_id: int, version: int, sample_id: int) -> None:
+        self._patch(user_id, version, lambda engine: engine.without_sample(sample_id))
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def _patch(
+        self,
+        user_id: int,
+        version: int,
+        change: Callable[[RankingEngine], RankingEngine],
+    ) -> None:
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None:
+                return
+
+            old_version, engine = entry
+            self._drop(user_id)
+            if old_version != version - 1:
+                return
+
+            try:
+                engine = change(engine)
+            except ValueError:
+                # Leave it to the next query to reload the gallery from the database
+                return
+
+            self.entries[user_id] = (version, engine)
+            self.total_bytes += engine.nbytes
+            self._evict()
+
+    def _drop(self, user_id: int) -> None:
+        entry = self.entries.pop(user_id, None)
+        if entry is not None:
+            self.total_bytes -= entry[1].nbytes
+
+    # Evict least recently used entries until we're within budget. The most recent
+    # entry is always kept, even if it alone is over budget.
+    def _evict(self) -> None:
+        while self.total_bytes > self.budget_bytes and len(self.entries) > 1:
+            _, (_, engine) = self.entries.popitem(last=False)
+            self.total_bytes -= engine.nbytes
+
+
+# The current version of a user's samples according to the database
+def get_samples_version(user_id: int) -> int:
+    return db.session.query(User.samples_version).filter_by(id=user_id).scalar() or 0
+
+
+# The samples version of a user's gallery and the model version of its fingerprints,
+# in one query
+def get_gallery_versions(user_id: int) -> tuple[int, str]:
+    row = (
+        db.session.query(User.samples_version, User.model_version)
+        .filter_by(id=user_id)
+        .first()
+    )
+    if row is None:
+        return 0, get_model_version()
+
+    return row[0] or 0, row[1] or get_model_version()
+
+
+# Stack a user's fingerprints straight from the sample table, without building ORM objects
+def load_engine(user_id: int, metric: Optional[str] = None) -> RankingEngine:
+    metric = metric or settings.get("distance_metric", "euclidean")
+    rows = (
+        db.session.query(
+            SampleEval.id,
+            SampleEval.fingerprint_blob,
+            SampleEval.fingerprint_dim,
+            SampleEval.fingerprint_dtype,
+            SampleEval.fingerprint_json,
+        )
+        .filter_by(user_id=user_id)
+        .order_by(SampleEval.id)
+        .all()
+    )
+    if not rows:
+        return RankingEngine([], [], metric=metric)
+
+    ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+    layouts = {(row[2], row[3]) for row in rows}
+    if len(layouts) == 1 and all(row[1] is not None for row in rows):
+        # Common case: every row is packed the same way, so the blobs can be joined
+        # and viewed as one matrix
+        (dim, dtype) = layouts.pop()
+        matrix = unpack_fingerprint(b"".join(row[1] for row in rows), dtype=dtype)
+        matrix = matrix.reshape(len(rows), dim)
+    else:
+        matrix = np.stack([decode_fingerprint(*row[1:]) for row in rows])
+
+    return RankingEngine.from_arrays(ids, matrix, metric=metric)
+
+
+# Get a user's ranking engine, reusing the resident copy if it is still current
+def get_engine(user_id: int, version: Optional[int] = None) -> RankingEngine:
+    if version is None:
+        version = get_samples_version(user_id)
+
+    return gallery_cache.get(user_id, version, lambda: load_engine(user_id))
+
+
+# Rank a user's gallery against a query fingerprint. Large galleries go through the
+# author centroids first, or through the approximate index, when those are enabled
+# in the config.
+def rank_gallery(
+    user_id: int, query, k: Optional[int] = None
+) -> list[tuple[int, float]]:
+    from .authors import author_ranking
+
+    (version, model_version) = get_gallery_versions(user_id)
+    engine = get_engine(user_id, version)
+    if author_ranking.applies(engine, k):
+        return author_ranking.top_k(user_id, version, engine, query, k)
+
+    if ann_manager.applies(engine, k):
+        return ann_manager.top_k(user_id, engine, query, k, model_version)
+
+    return engine.top_k(query, k)
+
+
+# Load the galleries of the users with the most samples into an empty cache, until
+# max_users are loaded or the cache is full. Returns the number loaded.
+def preload_galleries(max_users: int) -> int:
+    user_ids = (
+        db.session.query(SampleEval.user_id)
+        .group_by(SampleEval.user_id)
+        .order_by(db.func.count(SampleEval.id).desc())
+        .limit(max_users)
+        .all()
+    )
+
+    loaded = 0
+    for (user_id,) in user_ids:
+        get_engine(user_id)
+
+        # Stop once the cache is full, rather than evicting galleries loaded earlier
+        if len(gallery_cache) <= loaded:
+            break
+
+        loaded += 1
+
+    return loaded
+
+
+gallery_cache = GalleryCache(settings.get("gallery_cache_bytes", DEFAULT_BUDGET))
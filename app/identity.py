@@ -0,0 +1,72 @@
+"""
+    This module contains the identity cache used to load the logged-in user.
+    Flask-Login calls the user loader on every request, which used to mean a SELECT
+    on the user table each time. Instead, the user's id, email and name are kept in
+    the signed session cookie for a short time, and a User is rebuilt from them and
+    merged into the session without touching the database. Other columns (such as
+    the password hash) never go in the cookie and are loaded on first access.
+"""
+
+import time
+from typing import Optional
+from flask import session
+from sqlalchemy.orm import make_transient_to_detached
+
+from .main import settings
+from .models import User, db
+
+
+DEFAULT_CONFIG = {
+    "enabled": True,
+    "ttl": 60,
+}
+
+SESSION_KEY = "_identity"
+
+
+def get_identity_config() -> dict:
+    return {**DEFAULT_CONFIG, **settings.get("identity_cache", {})}
+
+
+# Put a user's identity in the session, to be reused until the TTL runs out
+def remember_identity(user: User) -> None:
+    session[SESSION_KEY] = {
+        "id": user.id,
+        "email": user.email,
+        "name": user.name,
+        "at": time.time(),
+    }
+
+
+def forget_identity() -> None:
+    session.pop(SESSION_KEY, None)
+
+
+# The user from the session's cached identity, attached to the database session
+# without a query. None if there is no cached identity, or it is stale or for
+# another user.
+def cached_user(user_id: int) -> Optional[User]:
+    conf = get_identity_config()
+    identity = session.get(SESSION_KEY)
+    if not conf["enabled"] or not identity or identity.get("id") != user_id:
+        return None
+
+    if time.time() - identity.get("at", 0) > conf["ttl"]:
+        return None
+
+    user = User(id=user_id, email=identity["email"], name=identity["name"])
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+# The user loader for Flask-Login
+def load_identity(user_id: int) -> Optional[User]:
+    user = cached_user(user_id)
+    if user is not None:
+        return user
+
+    user = User.query.get(user_id)
+    if user is not None and get_identity_config()["enabled"]:
+        remember_identity(user)
+
+    return user
@@ -0,0 +1,384 @@
+"""
+    This module contains the content-addressed store for uploaded images.
+    The original bytes of each image are kept once, however many samples use them,
+    under a path derived from their SHA-1 and split into shard directories so no
+    single directory grows too large. A row in the stored_image table counts the
+    references to each digest, and the files are removed once the transaction that
+    drops the last one has committed.
+    Thumbnails come in a configurable set of sizes. They are made from a reduced-size
+    decode of the original and shrunk in place from the largest size down, so a
+    large JPEG scan is never decoded at full resolution.
+"""
+
+import os
+from typing import BinaryIO, NamedTuple, Optional
+import uuid
+
+from PIL import Image, ImageOps, features
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+
+from .main import settings
+from .metrics import stage_timer
+from .models import DATA_PATH, StoredImage, db, image_digest
+
+
+DEFAULT_CONFIG = {
+    "root": None,
+    "shard_depth": 2,
+    "shard_width": 2,
+    "thumbnails": {
+        "list": {"size": 240, "format": "WEBP", "quality": 80},
+        "preview": {"size": 1024, "format": "JPEG", "quality": 85},
+    },
+    "default_thumbnail": "list",
+}
+
+COPY_CHUNK = 1024 * 1024
+
+# Where a session keeps the digests to collect once it commits
+COLLECT_KEY = "image_store_collect"
+
+# File extension and MIME type of each format thumbnails can be saved in
+THUMBNAIL_FORMATS = {
+    "WEBP": ("webp", "image/webp"),
+    "JPEG": ("jpg", "image/jpeg"),
+    "PNG": ("png", "image/png"),
+}
+
+
+class ThumbnailSpec(NamedTuple):
+    name: str
+    size: int
+    format: str
+    quality: int
+
+    @property
+    def extension(self) -> str:
+        return THUMBNAIL_FORMATS[self.format][0]
+
+    @property
+    def mimetype(self) -> str:
+        return THUMBNAIL_FORMATS[self.format][1]
+
+
+# Read the thumbnail sizes from the config. WebP falls back to JPEG if this build
+# of Pillow can't write it.
+def parse_thumbnail_specs(conf: dict) -> dict[str, ThumbnailSpec]:
+    specs = {}
+    for (name, spec) in conf.items():
+        image_format = spec.get("format", "JPEG").upper()
+        if image_format == "WEBP" and not features.check("webp"):
+            image_format = "JPEG"
+
+        if image_format not in THUMBNAIL_FORMATS:
+            raise ValueError(f"Unsupported thumbnail format {image_format}")
+
+        specs[name] = ThumbnailSpec(
+            name, int(spec["size"]), image_format, int(spec.get("quality", 80))
+        )
+
+    return specs
+
+
+# MIME type of an image, from its header. The file is rewound afterwards.
+def image_mimetype(image_fp: BinaryIO) -> Optional[str]:
+    image_fp.seek(0)
+    try:
+        with Image.open(image_fp) as image:
+            return image.get_format_mimetype()
+    finally:
+        image_fp.seek(0)
+
+
+class AtomicFile:
+    """
+    A file written under a temporary name and moved into place when it is closed,
+    so readers never see it half-written.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        self.fp: Optional[BinaryIO] = None
+
+    def __enter__(self) -> BinaryIO:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.fp = open(self.temp_path, "wb")
+        return self.fp
+
+    def __exit__(self, exc_type, *_):
+        self.fp.close()
+        if exc_type is None:
+            os.replace(self.temp_path, self.path)
+        else:
+            os.remove(self.temp_path)
+
+
+# Convert an image to a mode the given format can save, keeping transparency where
+# the format supports it
+def convert_for_format(image: Image.Image, image_format: str) -> Image.Image:
+    has_alpha = image.mode in ("RGBA", "LA", "PA") or (
+        image.mode == "P" and "transparency" in image.info
+    )
+    if has_alpha and image_format != "JPEG":
+        return image if image.mode == "RGBA" else image.convert("RGBA")
+
+    if image.mode in ("L", "RGB"):
+        return image
+
+    if image.mode in ("1", "LA", "I", "I;16", "F"):
+        return image.convert("L")
+
+    return image.convert("RGB")
+
+
+# Write thumbnails of an image to the given paths. The image is decoded at the
+# smallest scale that is still at least as large as the biggest thumbnail (which
+# only JPEG supports), then each size is shrunk in place from the one before it.
+def make_thumbnails(
+    image_fp: BinaryIO, targets: list[tuple[ThumbnailSpec, str]]
+) -> None:
+    if not targets:
+        return
+
+    targets = sorted(targets, key=lambda target: target[0].size, reverse=True)
+    largest = targets[0][0].size
+    image_fp.seek(0)
+    with stage_timer("image_processing"), Image.open(image_fp) as image:
+        image.draft(image.mode, (largest, largest))
+        thumbnail = ImageOps.exif_transpose(image)
+        for (spec, path) in targets:
+            thumbnail.thumbnail((spec.size, spec.size), Image.LANCZOS)
+            with AtomicFile(path) as store_to:
+                convert_for_format(thumbnail, spec.format).save(
+                    store_to, format=spec.format, quality=spec.quality
+                )
+
+    image_fp.seek(0)
+
+
+class ImageStore:
+    """
+    Files for each digest live at objects/ab/cd/<digest> (the original bytes) and
+    thumbnails/<size name>/ab/cd/<digest>.<ext> under the root. Files are written
+    atomically, so a path that exists is always complete.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        shard_depth: int = DEFAULT_CONFIG["shard_depth"],
+        shard_width: int = DEFAULT_CONFIG["shard_width"],
+        thumbnails: Optional[dict[str, ThumbnailSpec]] = None,
+        default_thumbnail: str = DEFAULT_CONFIG["default_thumbnail"],
+    ):
+        self.root = root
+        self.shard_depth = shard_depth
+        self.shard_width = shard_width
+        if thumbnails is None:
+            thumbnails = parse_thumbnail_specs(DEFAULT_CONFIG["thumbnails"])
+
+        if default_thumbnail not in thumbnails:
+            raise ValueError(f"No thumbnail size named {default_thumbnail}")
+
+        self.thumbnails = thumbnails
+        self.default_thumbnail = default_thumbnail
+
+    @classmethod
+    def from_settings(cls, settings: dict) -> "ImageStore":
+        conf = {**DEFAULT_CONFIG, **settings.get("image_store", {})}
+        return cls(
+            conf["root"] or os.path.join(DATA_PATH, "store"),
+            shard_depth=conf["shard_depth"],
+            shard_width=conf["shard_width"],
+            thumbnails=parse_thumbnail_specs(conf["thumbnails"]),
+            default_thumbnail=conf["default_thumbnail"],
+        )
+
+    def _shard(self, directory: str, digest: str) -> str:
+        width = self.shard_width
+        shards = [digest[i * width : (i + 1) * width] for i in range(self.shard_depth)]
+        return os.path.join(self.root, directory, *shards)
+
+    def object_path(self, digest: str) -> str:
+        return os.path.join(self._shard("objects", digest), digest)
+
+    def thumbnail_path(self, digest: str, name: Optional[str] = None) -> str:
+        spec = self.thumbnails[name or self.default_thumbnail]
+        directory = self._shard(os.path.join("thumbnails", spec.name), digest)
+        return os.path.join(directory, f"{digest}.{spec.extension}")
+
+    # Paths of the original image and its default thumbnail
+    def paths(self, digest: str) -> tuple[str, str]:
+        return self.object_path(digest), self.thumbnail_path(digest)
+
+    def exists(self, digest: str) -> bool:
+        paths = [self.object_path(digest)]
+        paths += [self.thumbnail_path(digest, name) for name in self.thumbnails]
+        return all(os.path.exists(path) for path in paths)
+
+    # Write the files for an image unless they are already there. This only touches
+    # the filesystem, so it is safe to call from any thread.
+    def write(self, image_fp: BinaryIO, digest: Optional[str] = None) -> str:
+        if digest is None:
+            digest = image_digest(image_fp)
+
+        image_path = self.object_path(digest)
+        if not os.path.exists(image_path):
+            image_fp.seek(0)
+            with AtomicFile(image_path) as store_to:
+                while True:
+                    chunk = image_fp.read(COPY_CHUNK)
+                    if not chunk:
+                        break
+
+                    store_to.write(chunk)
+
+        make_thumbnails(image_fp, self._missing_thumbnails(digest))
+        return digest
+
+    # The same for an image spooled to the temp directory, which is renamed into
+    # place as the original rather than copied. The spooled file is gone afterwards.
+    def adopt(self, spool_path: str, digest: str) -> str:
+        image_path = self.object_path(digest)
+        if os.path.exists(image_path):
+            # Already stored, or adopted by an earlier attempt at the same job
+            if os.path.exists(spool_path):
+                os.remove(spool_path)
+        else:
+            os.makedirs(os.path.dirname(image_path), exist_ok=True)
+            try:
+                os.replace(spool_path, image_path)
+            except OSError:
+                # The temp directory is on another filesystem
+                with open(spool_path, "rb") as image_fp:
+                    self.write(image_fp, digest)
+
+                os.remove(spool_path)
+                return digest
+
+        with open(image_path, "rb") as image_fp:
+            make_thumbnails(image_fp, self._missing_thumbnails(digest))
+
+        return digest
+
+    # Path of a thumbnail, making it from the stored original if it doesn't exist
+    # yet (e.g. a size added to the config after the image was uploaded). Returns
+    # None if the original isn't there either.
+    def ensure_thumbnail(
+        self, digest: str, name: Optional[str] = None
+    ) -> Optional[str]:
+        path = self.thumbnail_path(digest, name)
+        if os.path.exists(path):
+            return path
+
+        image_path = self.object_path(digest)
+        if not os.path.exists(image_path):
+            return None
+
+        spec = self.thumbnails[name or self.default_thumbnail]
+        with open(image_path, "rb") as image_fp:
+            make_thumbnails(image_fp, [(spec, path)])
+
+        return path
+
+    def _missing_thumbnails(self, digest: str) -> list[tuple[ThumbnailSpec, str]]:
+        targets = []
+        for (name, spec) in self.thumbnails.items():
+            path = self.thumbnail_path(digest, name)
+            if not os.path.exists(path):
+                targets.append((spec, path))
+
+        return targets
+
+    # Every file stored for a digest, including thumbnails in sizes that have since
+    # been removed from the config
+    def _all_paths(self, digest: str) -> list[str]:
+        paths = [self.object_path(digest)]
+        thumbnails_root = os.path.join(self.root, "thumbnails")
+        if os.path.isdir(thumbnails_root):
+            for name in os.listdir(thumbnails_root):
+                directory = self._shard(os.path.join("thumbnails", name), digest)
+                if os.path.isdir(directory):
+                    paths += [
+                        os.path.join(directory, filename)
+                        for filename in os.listdir(directory)
+                        if filename.startswith(f"{digest}.")
+                        and not filename.endswith(".tmp")
+                    ]
+
+        return paths
+
+    # Add a reference to a digest as part of the current transaction. Returns the
+    # paths its files are (or will be) stored at.
+    def acquire(self, digest: str, mimetype: Optional[str] = None) -> tuple[str, str]:
+        updated = StoredImage.query.filter_by(digest=digest).update(
+            {StoredImage.refcount: StoredImage.refcount + 1},
+            synchronize_session=False,
+        )
+        if updated == 0:
+            db.session.add(StoredImage(digest=digest, refcount=1, mimetype=mimetype))
+            db.session.flush()
+
+        return self.paths(digest)
+
+    # Write an image's files and add a reference to it
+    def put(self, image_fp: BinaryIO, digest: Optional[str] = None) -> tuple[str, str]:
+        mimetype = image_mimetype(image_fp)
+        digest = self.write(image_fp, digest)
+        return self.acquire(digest, mimetype)
+
+    # Drop a reference to a digest as part of the current transaction. Its files are
+    # removed after the commit if that was the last one.
+    def release(self, digest: str) -> None:
+        StoredImage.query.filter_by(digest=digest).update(
+            {StoredImage.refcount: StoredImage.refcount - 1},
+            synchronize_session=False,
+        )
+        self.collect(digest)
+
+    # Remove a digest's files once the current transaction has committed, if nothing
+    # refers to them by then. Until then a rollback can still bring the references
+    # back, so nothing is touched here.
+    def collect(self, digest: str) -> None:
+        db.session.info.setdefault(COLLECT_KEY, []).append((self, digest))
+
+    # Delete a digest's row and files if nothing refers to them, in a transaction of
+    # its own. The files are removed while that transaction holds the row, so a
+    # concurrent acquire() waits until they are gone and then finds that it needs to
+    # write them again. Returns whether they were removed.
+    def sweep(self, digest: str) -> bool:
+        table = StoredImage.__table__
+        with db.engine.begin() as conn:
+            conn.execute(
+                table.delete().where(table.c.digest == digest, table.c.refcount <= 0)
+            )
+            remaining = conn.execute(
+                select(table.c.refcount).where(table.c.digest == digest)
+            ).scalar()
+            if remaining is not None:
+                return False
+
+            for path in self._all_paths(digest):
+                if os.path.exists(path):
+                    os.remove(path)
+
+        return True
+
+
+def _sweep_collected(session: Session) -> None:
+    for (store, digest) in session.info.pop(COLLECT_KEY, []):
+        store.sweep(digest)
+
+
+def _forget_collected(session: Session) -> None:
+    session.info.pop(COLLECT_KEY, None)
+
+
+if not event.contains(Session, "after_commit", _sweep_collected):
+    event.listen(Session, "after_commit", _sweep_collected)
+    event.listen(Session, "after_rollback", _forget_collected)
+
+
+image_store = ImageStore.from_settings(settings)
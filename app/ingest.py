@@ -0,0 +1,279 @@
+"""
+    This module contains the bulk ingestion of labelled samples, from a zip archive or
+    a multi-file upload. Entries are streamed through a bounded thread pool that
+    fingerprints them and writes their image files, while the request thread adds the
+    finished samples to the database and commits them in batches.
+"""
+
+from concurrent.futures import Future, ThreadPoolExecutor
+import csv
+import io
+import os
+import time
+import traceback
+from typing import BinaryIO, Callable, Iterator, Optional
+import zipfile
+import numpy as np
+
+from .authors import add_to_summary
+from .backfill import user_model_version
+from .fpcache import fingerprint_cache
+from .imagestore import image_store
+from .main import settings
+from .models import SampleEval, User, UserImage, db, image_digest
+from .uploads import IMAGE_EXTENSIONS, check_image
+
+
+DEFAULT_CONFIG = {
+    "workers": 4,
+    "batch_size": 50,
+    "max_entry_bytes": 50 * 1024 * 1024,
+}
+
+
+def get_ingest_config() -> dict:
+    return {**DEFAULT_CONFIG, **settings.get("ingest", {})}
+
+
+class IngestItem:
+    """
+    One image to ingest, along with its outcome once it has been processed.
+    """
+
+    def __init__(self, filename: str, name: Optional[str], data: Optional[bytes]):
+        self.filename = filename
+        self.name = name
+        self.data = data
+        self.status = "pending"
+        self.error: Optional[str] = None
+        self.sample_id: Optional[int] = None
+
+    def fail(self, error: str) -> None:
+        self.status = "error"
+        self.error = error
+        self.data = None
+
+
+class IngestReport:
+    def __init__(self):
+        self.items: list[IngestItem] = []
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    @property
+    def succeeded(self) -> int:
+        return sum(1 for item in self.items if item.status == "ok")
+
+    @property
+    def failed(self) -> int:
+        return sum(1 for item in self.items if item.status == "error")
+
+    @property
+    def per_second(self) -> float:
+        return self.succeeded / self.elapsed if self.elapsed > 0 else 0.0
+
+
+# Read a manifest of "filename,author name" rows
+def parse_manifest(manifest_fp: BinaryIO) -> dict[str, str]:
+    text = io.TextIOWrapper(manifest_fp, encoding="utf-8-sig", newline="")
+    names = {}
+    for row in csv.reader(text):
+        if len(row) < 2 or not row[0].strip() or not row[1].strip():
+            continue
+
+        names[row[0].strip()] = row[1].strip()
+
+    text.detach()
+    return names
+
+
+# Author of an entry: from the manifest by full path or by file name, otherwise
+# the name of the folder the file is in
+def author_for(path: str, manifest: dict[str, str]) -> Optional[str]:
+    path = path.replace("\\", "/")
+    name = manifest.get(path) or manifest.get(os.path.basename(path))
+    if name is not None:
+        return name
+
+    folder = os.path.basename(os.path.dirname(path))
+    return folder or None
+
+
+# Lazily yield the images in a zip archive. The bytes of each entry are only read
+# when the item is pulled from the iterator.
+def iter_zip_items(
+    archive_fp: BinaryIO, manifest: dict[str, str], max_entry_bytes: int
+) -> Iterator[IngestItem]:
+    with zipfile.ZipFile(archive_fp) as archive:
+        for entry in archive.infolist():
+            path = entry.filename
+            if entry.is_dir() or path.startswith("__MACOSX/"):
+                continue
+
+            if not path.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+
+            item = IngestItem(path, author_for(path, manifest), None)
+            if entry.file_size > max_entry_bytes:
+                item.fail("Image is too large")
+            else:
+                item.data = archive.read(entry)
+
+            yield item
+
+
+def iter_upload_items(files: list, manifest: dict[str, str]) -> Iterator[IngestItem]:
+    for upload in files:
+        if not upload or not upload.filename:
+            continue
+
+        yield IngestItem(
+            upload.filename, author_for(upload.filename, manifest), upload.read()
+        )
+
+
+# Work done on the pool: check the image's size, fingerprint it (unless cached) and
+# write its files. References to the files are taken later, on the request thread.
+def process_item(
+    item: IngestItem,
+    digest: str,
+    fingerprint: Optional[np.ndarray],
+    get_fingerprint: Callable[[BinaryIO], list[float]],
+) -> tuple[np.ndarray, bool, Optional[str]]:
+    image_fp = io.BytesIO(item.data)
+    mimetype = check_image(image_fp)
+    if mimetype is None:
+        raise ValueError("This isn't an image that can be stored")
+
+    computed = fingerprint is None
+    if computed:
+        fingerprint = np.asarray(get_fingerprint(image_fp), dtype=np.float32)
+
+    image_store.write(image_fp, digest)
+    return fingerprint, computed, mimetype
+
+
+class BulkIngester:
+    """
+    Runs a bulk ingestion for one user. At most workers * 2 items are in flight at
+    once, so only that many images are held in memory regardless of archive size.
+    """
+
+    def __init__(
+        self,
+        user: User,
+        get_fingerprint: Callable[[BinaryIO], list[float]],
+        workers: Optional[int] = None,
+        batch_size: Optional[int] = None,
+        model_version: Optional[str] = None,
+    ):
+        conf = get_ingest_config()
+        self.user = user
+        self.get_fingerprint = get_fingerprint
+
+        # The version get_fingerprint computes, which is the user's
+        self.model_version = model_version or user_model_version(user)
+        self.workers = workers or conf["workers"]
+        self.batch_size = batch_size or conf["batch_size"]
+        self.report = IngestReport()
+        self.uncommitted: list[tuple[IngestItem, SampleEval]] = []
+
+    def run(self, items: Iterator[IngestItem]) -> IngestReport:
+        in_flight: list[tuple[IngestItem, str, Future]] = []
+        with ThreadPoolExecutor(self.workers) as pool:
+            for item in items:
+                self.report.items.append(item)
+                if item.status == "error":
+                    continue
+
+                if not item.name:
+                    item.fail("No author name in the manifest or folder name")
+                    continue
+
+                # Cache lookups use the database, so they stay on this thread
+                digest = image_digest(io.BytesIO(item.data))
+                cached = fingerprint_cache.get(digest, self.model_version)
+
+                # Wait for the oldest item before reading more if too many are in flight
+                while len(in_flight) >= self.workers * 2:
+                    self._finish(*in_flight.pop(0))
+
+                future = pool.submit(
+                    process_item,
+                    item,
+                    digest,
+                    cached,
+                    self.get_fingerprint,
+                )
+                in_flight.append((item, digest, future))
+
+                # Pick up whatever has finished so far, in submission order
+                while in_flight and in_flight[0][2].done():
+                    self._finish(*in_flight.pop(0))
+
+            for entry in in_flight:
+                self._finish(*entry)
+
+        self._commit()
+        self.report.elapsed = time.perf_counter() - self.report.started
+        return self.report
+
+    def _finish(self, item: IngestItem, digest: str, future: Future) -> None:
+        try:
+            fingerprint, computed, mimetype = future.result()
+        except Exception as e:
+            traceback.print_exc()
+            item.fail(f"Could not process image: {e}")
+            return
+        finally:
+            item.data = None
+
+        if computed:
+            fingerprint_cache.put(digest, fingerprint, self.model_version, commit=False)
+
+        stored = image_store.acquire(digest, mimetype)
+        image = UserImage(self.user, digest=digest, stored=stored)
+        sample = SampleEval(
+            image,
+            name=item.name,
+            fingerprint=fingerprint,
+            model_version=self.model_version,
+        )
+        db.session.add(image)
+        db.session.add(sample)
+        add_to_summary(self.user.id, item.name, fingerprint)
+        self.uncommitted.append((item, sample))
+        if len(self.uncommitted) >= self.batch_size:
+            self._commit()
+
+    def _commit(self) -> None:
+        if not self.uncommitted:
+            return
+
+        try:
+            # The backfill may have moved the user to a new model since these were
+            # fingerprinted
+            if not self.user.bump_samples_version(self.model_version):
+                raise ValueError("The gallery was moved to a new model; try again")
+
+            # Read the new ids before committing expires the objects
+            db.session.flush()
+            sample_ids = [sample.id for (_, sample) in self.uncommitted]
+            db.session.commit()
+        except Exception as e:
+            traceback.print_exc()
+            db.session.rollback()
+            for (item, _) in self.uncommitted:
+                item.fail(f"Could not save sample: {e}")
+
+            # Remove any files that were written only for this batch
+            for digest in {sample.image.digest for (_, sample) in self.uncommitted}:
+                image_store.collect(digest)
+
+            db.session.commit()
+        else:
+            for ((item, _), sample_id) in zip(self.uncommitted, sample_ids):
+                item.status = "ok"
+                item.sample_id = sample_id
+
+        self.uncommitted = []
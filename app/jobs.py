@@ -0,0 +1,285 @@
+"""
+    This module contains a small job queue backed by the job table, and the worker
+    threads that run it. Slow work such as writing image files and thumbnails is
+    enqueued in the same transaction as the rows it belongs to, so the request can
+    return as soon as that transaction commits.
+    Jobs are claimed with a conditional UPDATE, so several worker processes can share
+    one database without running the same job twice.
+    A job that fails because the model server is unavailable is put back to wait for
+    unavailable_delay seconds, and that attempt doesn't count towards max_attempts.
+"""
+
+from datetime import datetime, timedelta
+import json
+import os
+import threading
+import time
+import traceback
+from typing import BinaryIO, Callable, Optional
+import uuid
+
+from flask import Flask
+from sqlalchemy import or_, text
+from sqlalchemy.orm.exc import StaleDataError
+
+from .main import settings
+from .imagestore import image_store
+from .models import TEMP_PATH, Job, UserImage, db
+from .querycount import uncounted
+from .supervisor import ModelUnavailable
+from .uploads import spooled
+
+
+DEFAULT_CONFIG = {
+    "workers": 2,
+    "poll_interval": 0.5,
+    "max_attempts": 3,
+    "unavailable_delay": 30.0,
+    "stale_after": 600,
+    "thumbnail_wait": 2.0,
+    "image_wait": 5.0,
+}
+
+HANDLERS: dict[str, Callable[[dict], None]] = {}
+
+
+def get_jobs_config() -> dict:
+    return {**DEFAULT_CONFIG, **settings.get("jobs", {})}
+
+
+# Register a function as the handler for a kind of job
+def job_handler(kind: str) -> Callable:
+    def register(func: Callable[[dict], None]) -> Callable[[dict], None]:
+        HANDLERS[kind] = func
+        return func
+
+    return register
+
+
+# Add a job to the session. It is picked up once the caller commits.
+def enqueue(kind: str, payload: dict) -> Job:
+    if kind not in HANDLERS:
+        raise ValueError(f"No handler for job kind {kind}")
+
+    job = Job(kind=kind, payload=json.dumps(payload), status="pending", attempts=0)
+    db.session.add(job)
+    return job
+
+
+class JobQueue:
+    """
+    Runs pending jobs on a pool of worker threads. Until the workers are started,
+    notify() runs pending jobs inline instead, so tools and tests that never start
+    them still get their jobs done.
+    """
+
+    def __init__(self):
+        self.app: Optional[Flask] = None
+        self.threads: list[threading.Thread] = []
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.conf = get_jobs_config()
+
+    @property
+    def running(self) -> bool:
+        return bool(self.threads)
+
+    def start(self, app: Flask, workers: Optional[int] = None) -> None:
+        self.app = app
+        self.conf = get_jobs_config()
+        workers = self.conf["workers"] if workers is None else workers
+        self.stopping.clear()
+        with app.app_context():
+            self.recover_stale()
+
+        for i in range(workers):
+            thread = threading.Thread(
+                target=self._loop, name=f"job-worker-{i}", daemon=True
+            )
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self.stopping.set()
+        self.wakeup.set()
+        for thread in self.threads:
+            thread.join(timeout)
+
+        self.threads = []
+
+    # Tell the workers there is new work, or do it now if there are no workers
+    def notify(self) -> None:
+        if self.running:
+            self.wakeup.set()
+        else:
+            self.run_pending()
+
+    # Run pending jobs on the current thread until there are none left
+    def run_pending(self) -> int:
+        count = 0
+        while self.run_one():
+            count += 1
+
+        return count
+
+    # Claim and run one pending job. Returns False if there was nothing to do.
+    def run_one(self) -> bool:
+        job = self.claim()
+        if job is None:
+            return False
+
+        try:
+            HANDLERS[job.kind](json.loads(job.payload))
+        except ModelUnavailable as e:
+            # Not the job's fault, so try again later without using up an attempt
+            db.session.rollback()
+            job = Job.query.get(job.id)
+            job.error = repr(e)
+            job.status = "pending"
+            job.attempts -= 1
+            job.run_after = datetime.utcnow() + timedelta(
+                seconds=self.conf["unavailable_delay"]
+            )
+        except Exception as e:
+            traceback.print_exc()
+            db.session.rollback()
+            job = Job.query.get(job.id)
+            job.error = repr(e)
+            if job.attempts >= self.conf["max_attempts"]:
+                job.status = "failed"
+                job.finished = datetime.utcnow()
+            else:
+                job.status = "pending"
+        else:
+            job = Job.query.get(job.id)
+            job.status = "done"
+            job.finished = datetime.utcnow()
+
+        db.session.commit()
+        return True
+
+    # Atomically take the oldest pending job that is due. The UPDATE only succeeds for
+    # one worker, even across processes, because it requires the job to still be pending.
+    def claim(self) -> Optional[Job]:
+        while True:
+            job_id = (
+                db.session.query(Job.id)
+                .filter(
+                    Job.status == "pending",
+                    or_(Job.run_after.is_(None), Job.run_after <= datetime.utcnow()),
+                )
+                .order_by(Job.id)
+                .limit(1)
+                .scalar()
+            )
+            if job_id is None:
+                db.session.commit()
+                return None
+
+            claimed = db.session.execute(
+                text(
+                    "UPDATE job SET status = 'running', attempts = attempts + 1, "
+                    "started = :now WHERE id = :id AND status = 'pending'"
+                ),
+                {"id": job_id, "now": datetime.utcnow()},
+            ).rowcount
+            db.session.commit()
+            if claimed == 1:
+                return Job.query.get(job_id)
+
+    # Put jobs that have been running for too long (their worker probably died)
+    # back in the queue
+    def recover_stale(self) -> None:
+        cutoff = datetime.utcnow() - timedelta(seconds=self.conf["stale_after"])
+        Job.query.filter(Job.status == "running", Job.started < cutoff).update(
+            {Job.status: "pending"}, synchronize_session=False
+        )
+        db.session.commit()
+
+    def _loop(self) -> None:
+        with self.app.app_context():
+            while not self.stopping.is_set():
+                try:
+                    ran = self.run_one()
+                except Exception:
+                    traceback.print_exc()
+                    db.session.rollback()
+                    ran = False
+                finally:
+                    db.session.remove()
+
+                if not ran:
+                    self.wakeup.wait(self.conf["poll_interval"])
+                    self.wakeup.clear()
+
+
+# Copy an upload to the temp directory so a job can pick it up after the request ends
+def spool_upload(image_fp: BinaryIO, digest: str) -> str:
+    os.makedirs(TEMP_PATH, exist_ok=True)
+    path = os.path.join(TEMP_PATH, f"{uuid.uuid4().hex}-{digest}.upload")
+    image_fp.seek(0)
+    with open(path, "wb") as spool_fp:
+        while True:
+            chunk = image_fp.read(1024 * 1024)
+            if not chunk:
+                break
+
+            spool_fp.write(chunk)
+
+    return path
+
+
+# Spool an image and enqueue the job that writes its files. An upload that was
+# already spooled as it arrived is handed over rather than copied. The image should
+# be marked as not ready, and the caller commits.
+def enqueue_store_image(image: UserImage, image_fp: BinaryIO, digest: str) -> Job:
+    db.session.flush()
+    spool = spooled(image_fp)
+    if spool is not None and spool.owned and spool.digest == digest:
+        spool_path = spool.detach()
+    else:
+        spool_path = spool_upload(image_fp, digest)
+
+    return enqueue(
+        "store_image",
+        {"image_id": image.id, "digest": digest, "spool_path": spool_path},
+    )
+
+
+@job_handler("store_image")
+def store_image(payload: dict) -> None:
+    spool_path = payload["spool_path"]
+    digest = payload["digest"]
+    image = UserImage.query.get(payload["image_id"])
+    if image is None:
+        # The sample was deleted before we got to it
+        if os.path.exists(spool_path):
+            os.remove(spool_path)
+
+        image_store.collect(digest)
+        db.session.commit()
+        return
+
+    image_store.adopt(spool_path, digest)
+    image.ready = True
+    try:
+        db.session.commit()
+    except StaleDataError:
+        # Deleted while we were writing the files, which may not be needed any more
+        db.session.rollback()
+        image_store.collect(digest)
+        db.session.commit()
+
+
+# Wait up to timeout seconds for an image's files to be written
+def wait_until_ready(image: UserImage, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    with uncounted():
+        while not image.ready and time.monotonic() < deadline:
+            time.sleep(0.05)
+            db.session.refresh(image)
+
+    return image.ready
+
+
+job_queue = JobQueue()
@@ -8,7 +8,6 @@ import subprocess
 import json
 import secrets
 import os
-import time
 
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
@@ -50,9 +49,14 @@ settings = get_config(CONFIG)
 
 
 def create_app() -> tuple[Flask, SQLAlchemy]:
+    from .api import apiviews
     from .userviews import login_manager, userviews
     from .mainviews import mainviews
     from .evaluation import evalviews
+    from .metrics import install_metrics
+    from .migrate import configure_database
+    from .querycount import install_query_counter
+    from .uploads import install_upload_limits
 
     # Initialize database connection
     from .models import db
@@ -62,6 +66,11 @@ def create_app() -> tuple[Flask, SQLAlchemy]:
     app.config["SQLALCHEMY_DATABASE_URI"] = settings["db_uri"]
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
+    # Don't send the session cookie with cross-site POSTs
+    app.config["SESSION_COOKIE_SAMESITE"] = "Lax"
+    install_upload_limits(app)
+    configure_database(app)
+
     # Initialize database mediator objects
     db.init_app(app)
     login_manager.init_app(app)
@@ -70,6 +79,9 @@ def create_app() -> tuple[Flask, SQLAlchemy]:
     app.register_blueprint(userviews, url_prefix="/users")
     app.register_blueprint(mainviews)
     app.register_blueprint(evalviews, url_prefix="/eval")
+    app.register_blueprint(apiviews, url_prefix="/api/v1")
+    install_query_counter(app)
+    install_metrics(app)
     app.app_context().push()
 
     return app, db
@@ -86,14 +98,42 @@ def kill_port_user():
     subprocess.run(["fuser", f"{settings.get('modelServerPort')}/tcp", "--kill"])
 
 
-# Start model server here
+# Start model server here. It runs under a supervisor (see supervisor.py), which
+# restarts it if it dies, and this waits until it answers or the deadline passes.
 def start_model_server():
     assert not settings.get("debug")  # Will crash
 
-    kill_port_user()
-    subprocess.run("./start_model_server.sh")
+    from .supervisor import get_supervisor_config, model_supervisor
+
+    if not model_supervisor.start():
+        deadline = get_supervisor_config()["startup_deadline"]
+        print(f"The model server wasn't ready after {deadline}s, still trying")
+
+
+# Create the test user from the config, replacing any that is left from a previous run
+def reset_test_user(db: SQLAlchemy) -> None:
+    from .imagestore import image_store
+    from .models import User
+
+    test_user_email = settings.get("test_user_email", TEST_USER_EMAIL)
+    test_user_pw = settings.get("test_user_pw", TEST_USER_PW)
+
+    test_user = User.query.filter_by(email=test_user_email).one_or_none()
+    if test_user is not None:
+        for image in test_user.images:
+            if image.digest is not None:
+                image_store.release(image.digest)
+
+        db.session.delete(test_user)
+        db.session.commit()
 
-    time.sleep(5)  # Give tensorflow a few seconds to init
+    pw_hash = generate_password_hash(test_user_pw)
+    test_user = User(email=test_user_email, name="Test User", pw_hash=pw_hash)
+    db.session.add(test_user)
+    db.session.commit()
+
+    print(f"Test user email: {test_user_email}")
+    print(f"Test user password: {test_user_pw}")
 
 
 class AppContextManager:
@@ -107,22 +147,38 @@ class AppContextManager:
         self.app, self.db = create_app()
 
     def __enter__(self):
+        from .migrate import reset_schema_version, upgrade_schema
+
         if self.flag_drop_all:
             self.db.drop_all()
+            reset_schema_version(self.db)
 
         self.db.create_all()
+
+        # Bring databases created by older versions up to date
+        upgrade_schema(self.db)
+
+        # Start the background workers that write image files
+        from .jobs import job_queue
+
+        job_queue.start(self.app)
         return self
 
     def __exit__(self, *_):
+        from .evaluation import fingerprint_backend
+        from .jobs import job_queue
+
+        job_queue.stop()
+        fingerprint_backend.close()
         if self.flag_drop_all:
             self.db.drop_all()
 
-        kill_port_user()
+        from .supervisor import model_supervisor
 
+        model_supervisor.stop()
 
-if __name__ == "__main__":
-    from .models import User
 
+if __name__ == "__main__":
     if settings.get("doStart"):
         start_model_server()
 
@@ -135,21 +191,7 @@ if __name__ == "__main__":
         ensure_secret_key(manager.app, KEYFILE)
 
         if settings.get("test_user"):
-            test_user_email = settings.get("test_user_email", TEST_USER_EMAIL)
-            test_user_pw = settings.get("test_user_pw", TEST_USER_PW)
-
-            test_user = User.query.filter_by(email=test_user_email).one_or_none()
-            if test_user is not None:
-                manager.db.session.delete(test_user)
-                manager.db.session.commit()
-
-            pw_hash = generate_password_hash(test_user_pw)
-            test_user = User(email=test_user_email, name="Test User", pw_hash=pw_hash)
-            manager.db.session.add(test_user)
-            manager.db.session.commit()
-
-            print(f"Test user email: {test_user_email}")
-            print(f"Test user password: {test_user_pw}")
+            reset_test_user(manager.db)
 
         port = settings.get("port")
         if port is None or not isinstance(port, int):
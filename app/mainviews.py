@@ -4,14 +4,39 @@
     displaying model evaluations to the user.
 """
 
-from flask import Blueprint, Response, render_template, abort
+import os
+from typing import Optional
+from flask import (
+    Blueprint,
+    Response,
+    abort,
+    current_app,
+    jsonify,
+    render_template,
+    send_file,
+    send_from_directory,
+)
 from flask_login import current_user, login_required
 
-from .models import UserImage
+from .imagestore import image_mimetype, image_store
+from .jobs import get_jobs_config, wait_until_ready
+from .models import StoredImage, UserImage
+from .querycount import query_budget
+from .supervisor import model_supervisor
 
 
 mainviews = Blueprint("mainviews", __name__, template_folder="templates/")
 
+IMAGE_MAX_AGE = 365 * 24 * 60 * 60
+
+
+# Stand-in for an image whose files haven't been written yet. It mustn't be cached,
+# so the browser asks for the real image next time.
+def placeholder() -> Response:
+    response = send_from_directory(current_app.static_folder, "placeholder.svg")
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
 
 @mainviews.route("/")
 def index() -> Response:
@@ -21,26 +46,97 @@ def index() -> Response:
     return render_template("index.html")
 
 
+# Readiness of the app for load balancers and deploy scripts. It isn't ready while
+# a model server run by the supervisor is down or starting up.
+@mainviews.route("/health")
+def health() -> Response:
+    status = model_supervisor.status()
+    ready = status["ready"] or not status["supervised"]
+    return jsonify({"ready": ready, "model": status}), 200 if ready else 503
+
+
+# Send an image file as a stream. The URLs of images carry their digest, and the
+# stored files are named by it, so the content behind a URL never changes and the
+# browser can keep it for a long time without asking again. Range requests and
+# If-None-Match are handled by send_file.
+def send_image_file(path: str, mimetype: str, etag: str) -> Response:
+    response = send_file(
+        os.path.abspath(path),
+        mimetype=mimetype,
+        etag=etag,
+        conditional=True,
+        max_age=IMAGE_MAX_AGE,
+    )
+
+    # Images are only visible to their owner, so shared caches mustn't keep them
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
+
+
+# Content type and ETag of an image saved before the image store existed. Its file
+# name is the digest of the re-encoded file, which is good enough for an ETag.
+def legacy_file_info(path: str) -> tuple[str, str]:
+    with open(path, "rb") as image_fp:
+        mimetype = image_mimetype(image_fp) or "application/octet-stream"
+
+    return mimetype, os.path.splitext(os.path.basename(path))[0]
+
+
 @mainviews.route("/image/<int:image_id>")
 @login_required
+@query_budget(3)
 def get_image(image_id: int) -> Response:
     image = UserImage.query.get_or_404(image_id)
-    if image.user != current_user:
+    if image.user_id != current_user.id:
         abort(401)
 
-    with open(image.image_path, "rb") as image_fp:
-        return Response(image_fp.read(), mimetype="image")
+    if not wait_until_ready(image, get_jobs_config()["image_wait"]):
+        return placeholder()
 
+    if image.digest is None:
+        mimetype, etag = legacy_file_info(image.image_path)
+        return send_image_file(image.image_path, mimetype, etag)
 
+    stored = StoredImage.query.get(image.digest)
+    mimetype = stored.mimetype if stored is not None else None
+    return send_image_file(
+        image.image_path, mimetype or "application/octet-stream", image.digest
+    )
+
+
+# Thumbnails come in the sizes named in the image_store config, e.g. "list" for
+# pages with many images and "preview" for a single larger one. Unknown sizes get
+# the default one.
 @mainviews.route("/image/<int:image_id>/thumbnail")
+@mainviews.route("/image/<int:image_id>/thumbnail/<size>")
 @login_required
-def get_thumbnail(image_id: int) -> Response:
+@query_budget(3)
+def get_thumbnail(image_id: int, size: Optional[str] = None) -> Response:
+    if size not in image_store.thumbnails:
+        size = image_store.default_thumbnail
+
     image = UserImage.query.get_or_404(image_id)
-    if image.user != current_user:
+    if image.user_id != current_user.id:
         abort(401)
 
-    with open(image.thumbnail_path, "rb") as image_fp:
-        return Response(image_fp.read(), mimetype="image")
+    if not wait_until_ready(image, get_jobs_config()["thumbnail_wait"]):
+        return placeholder()
+
+    if image.digest is None:
+        # Saved before the image store existed, so there is only one size
+        mimetype, etag = legacy_file_info(image.thumbnail_path)
+        return send_image_file(image.thumbnail_path, mimetype, f"{etag}-thumbnail")
+
+    thumbnail_path = image_store.ensure_thumbnail(image.digest, size)
+    if thumbnail_path is None:
+        abort(404)
+
+    spec = image_store.thumbnails[size]
+    return send_image_file(
+        thumbnail_path, spec.mimetype, f"{image.digest}-{spec.name}-{spec.extension}"
+    )
 
 
 @mainviews.app_errorhandler(404)
@@ -53,6 +149,11 @@ def internal_error(_):
     return render_template("error.html", err_msg="500! Server error."), 500
 
 
+@mainviews.app_errorhandler(413)
+def too_large(error):
+    return render_template("error.html", err_msg=f"413! {error.description}"), 413
+
+
 @mainviews.app_errorhandler(401)
 def access_denied(_):
     return (
@@ -0,0 +1,293 @@
+"""
+    This module contains the app's metrics: counters and latency histograms for each
+    stage of handling a request (model calls, image processing, database commits,
+    ranking and template rendering), served in the Prometheus text format on
+    /metrics when "metrics" is enabled in the config.
+    The values are kept per process, so with several workers each one reports its
+    own, and Prometheus should scrape them individually or sum them.
+"""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+import threading
+import time
+from typing import Iterator, Optional
+from flask import (
+    Flask,
+    Response,
+    before_render_template,
+    g,
+    request,
+    template_rendered,
+)
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from .main import settings
+
+
+DEFAULT_CONFIG = {
+    "enabled": False,
+    "path": "/metrics",
+}
+
+# Latency buckets in seconds, from a fast cache hit to a slow batch of model calls
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+def get_metrics_config() -> dict:
+    return {**DEFAULT_CONFIG, **settings.get("metrics", {})}
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...], extra="") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for (name, value) in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter:
+    """
+    A count that only goes up, with one series per combination of label values.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1.0) -> None:
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0.0) + amount
+
+    def value(self, *label_values: str) -> float:
+        with self.lock:
+            return self.values.get(label_values, 0.0)
+
+    def samples(self) -> Iterator[str]:
+        with self.lock:
+            values = dict(self.values)
+
+        for (label_values, value) in sorted(values.items()):
+            yield f"{self.name}{_format_labels(self.labels, label_values)} {value:g}"
+
+
+class Histogram:
+    """
+    Observations counted into cumulative buckets, plus their sum and count.
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+
+        # Per series: count in each bucket (the last one is +Inf), sum and count
+        self.series: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, *label_values: str) -> None:
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            if label_values not in self.series:
+                self.series[label_values] = ([0] * (len(self.buckets) + 1), [0.0, 0])
+
+            counts, totals = self.series[label_values]
+            counts[index] += 1
+            totals[0] += value
+            totals[1] += 1
+
+    @contextmanager
+    def time(self, *label_values: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def count(self, *label_values: str) -> int:
+        with self.lock:
+            series = self.series.get(label_values)
+            return series[1][1] if series else 0
+
+    def samples(self) -> Iterator[str]:
+        with self.lock:
+            series = {
+                key: (list(counts), list(totals))
+                for (key, (counts, totals)) in self.series.items()
+            }
+
+        for (label_values, (counts, totals)) in sorted(series.items()):
+            cumulative = 0
+            bounds = [f"{bound:g}" for bound in self.buckets] + ["+Inf"]
+            for (bound, count) in zip(bounds, counts):
+                cumulative += count
+                labels = _format_labels(self.labels, label_values, f'le="{bound}"')
+                yield f"{self.name}_bucket{labels} {cumulative}"
+
+            labels = _format_labels(self.labels, label_values)
+            yield f"{self.name}_sum{labels} {totals[0]:g}"
+            yield f"{self.name}_count{labels} {totals[1]}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+REQUESTS = registry.register(
+    Counter(
+        "authorid_requests_total",
+        "HTTP requests handled",
+        ("endpoint", "method", "status"),
+    )
+)
+REQUEST_ERRORS = registry.register(
+    Counter(
+        "authorid_request_errors_total",
+        "HTTP requests that ended in a server error",
+        ("endpoint",),
+    )
+)
+REQUEST_SECONDS = registry.register(
+    Histogram(
+        "authorid_request_duration_seconds",
+        "Time spent handling HTTP requests",
+        ("endpoint",),
+    )
+)
+STAGE_SECONDS = registry.register(
+    Histogram(
+        "authorid_stage_duration_seconds",
+        "Time spent in each stage of request handling",
+        ("stage",),
+    )
+)
+CACHE_LOOKUPS = registry.register(
+    Counter(
+        "authorid_cache_lookups_total",
+        "Cache lookups by cache and result",
+        ("cache", "result"),
+    )
+)
+MODEL_FAILURES = registry.register(
+    Counter(
+        "authorid_model_server_failures_total",
+        "Fingerprint requests that failed after all retries",
+    )
+)
+
+
+# Time a stage of request handling, e.g. with stage_timer("fingerprint"): ...
+def stage_timer(stage: str):
+    return STAGE_SECONDS.time(stage)
+
+
+def record_cache_lookup(cache: str, hit: bool) -> None:
+    CACHE_LOOKUPS.inc(cache, "hit" if hit else "miss")
+
+
+def _start_request() -> None:
+    g.metrics_start = time.perf_counter()
+
+
+def _finish_request(response: Response) -> Response:
+    start = g.pop("metrics_start", None)
+    endpoint = request.endpoint or "unknown"
+    if start is not None:
+        REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint)
+
+    REQUESTS.inc(endpoint, request.method, str(response.status_code))
+    if response.status_code >= 500:
+        REQUEST_ERRORS.inc(endpoint)
+
+    return response
+
+
+def _start_render(*_, **__) -> None:
+    g.metrics_render_start = time.perf_counter()
+
+
+def _finish_render(*_, **__) -> None:
+    start = g.pop("metrics_render_start", None)
+    if start is not None:
+        STAGE_SECONDS.observe(time.perf_counter() - start, "render")
+
+
+def _start_commit(session: Session) -> None:
+    session.info["metrics_commit_start"] = time.perf_counter()
+
+
+def _finish_commit(session: Session) -> None:
+    start = session.info.pop("metrics_commit_start", None)
+    if start is not None:
+        STAGE_SECONDS.observe(time.perf_counter() - start, "db_commit")
+
+
+def _metrics_view() -> Response:
+    return Response(registry.render(), content_type="text/plain; version=0.0.4")
+
+
+# Hook the metrics into an app and serve them, if they are enabled in the config
+def install_metrics(app: Flask, conf: Optional[dict] = None) -> bool:
+    conf = conf or get_metrics_config()
+    if not conf["enabled"]:
+        return False
+
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    before_render_template.connect(_start_render, app)
+    template_rendered.connect(_finish_render, app)
+    if not event.contains(Session, "before_commit", _start_commit):
+        event.listen(Session, "before_commit", _start_commit)
+        event.listen(Session, "after_commit", _finish_commit)
+
+    app.add_url_rule(conf["path"], "metrics", _metrics_view)
+    return True
@@ -0,0 +1,402 @@
+"""
+    This module contains the upgrades needed to bring an existing database up to date
+    with the current models, and the SQLite settings the app runs with.
+    Schema changes (new columns, indexes and derived tables) are versioned migrations,
+    applied in order at startup. The database's version is kept in SQLite's
+    user_version pragma.
+    Converting the stored fingerprints to the binary format and moving image files
+    into the image store are done in small batches, each in its own transaction, so
+    they can run with `python -m app.migrate` while the server is live.
+"""
+
+import argparse
+import itertools
+import os
+import sqlite3
+import time
+import traceback
+from typing import Callable, Optional
+import numpy as np
+
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect, or_, text
+from sqlalchemy.engine import Connection, Engine, make_url
+from sqlalchemy.pool import QueuePool
+
+from .fingerprints import decode_fingerprint, pack_json_fingerprint
+from .main import settings
+
+
+DEFAULT_CONFIG = {
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "busy_timeout": 5.0,
+    "pool_size": 5,
+    "max_overflow": 10,
+    "pool_timeout": 30.0,
+}
+
+JOURNAL_MODES = ("delete", "truncate", "persist", "memory", "wal", "off")
+SYNCHRONOUS_MODES = ("off", "normal", "full", "extra")
+
+
+def get_database_config() -> dict:
+    return {**DEFAULT_CONFIG, **settings.get("database", {})}
+
+
+# Engine options for the configured database. SQLite's default is not to pool
+# connections at all, so every checkout would open the file again.
+def engine_options(db_uri: str, conf: Optional[dict] = None) -> dict:
+    conf = conf or get_database_config()
+    url = make_url(db_uri)
+    if url.get_backend_name() != "sqlite" or url.database in (None, "", ":memory:"):
+        return {}
+
+    options = {"connect_args": {"timeout": conf["busy_timeout"]}}
+    if conf["pool_size"]:
+        options.update(
+            poolclass=QueuePool,
+            pool_size=conf["pool_size"],
+            max_overflow=conf["max_overflow"],
+            pool_timeout=conf["pool_timeout"],
+        )
+
+        # Pooled connections go from thread to thread, one thread at a time
+        options["connect_args"]["check_same_thread"] = False
+
+    return options
+
+
+def _set_pragmas(dbapi_connection, _) -> None:
+    synchronous = get_database_config()["synchronous"]
+    if isinstance(dbapi_connection, sqlite3.Connection) and synchronous:
+        if synchronous.lower() not in SYNCHRONOUS_MODES:
+            raise ValueError(f"Unknown synchronous mode: {synchronous}")
+
+        dbapi_connection.execute(f"PRAGMA synchronous = {synchronous}")
+
+
+# Apply the database settings from the config to an app, before its engine is made
+def configure_database(app: Flask) -> None:
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(
+        app.config["SQLALCHEMY_DATABASE_URI"]
+    )
+    if not event.contains(Engine, "connect", _set_pragmas):
+        event.listen(Engine, "connect", _set_pragmas)
+
+
+# Columns added to tables after they were first created, as (name, SQL type)
+ADDED_COLUMNS = {
+    "user": [("samples_version", "INTEGER NOT NULL DEFAULT 0")],
+    "image": [("ready", "BOOLEAN NOT NULL DEFAULT 1"), ("digest", "VARCHAR(40)")],
+    "sample": [
+        ("fingerprint_blob", "BLOB"),
+        ("fingerprint_dim", "INTEGER"),
+        ("fingerprint_dtype", "VARCHAR(8)"),
+    ],
+}
+
+# The columns migration 4 adds
+MODEL_VERSION_COLUMNS = {
+    "user": [("model_version", "VARCHAR(64)")],
+    "sample": [("model_version", "VARCHAR(64)")],
+}
+
+
+# Indexes for the ways the tables are actually read
+INDEXES = [
+    # The labelled sample list, newest first (pagination.page_samples)
+    "CREATE INDEX IF NOT EXISTS ix_sample_user_timestamp "
+    "ON sample (user_id, timestamp DESC, id DESC)",
+    # A user's samples in id order (gallery.load_engine) and by id for a user
+    # (evaluation.get_samples_by_id). SQLite keeps the id in the index entries.
+    "CREATE INDEX IF NOT EXISTS ix_sample_user_id ON sample (user_id)",
+    # A user's images, e.g. when the user is deleted
+    "CREATE INDEX IF NOT EXISTS ix_image_user_id ON image (user_id)",
+]
+
+
+# Add the given columns to the tables that exist but don't have them yet
+def add_missing_columns(conn: Connection, columns_by_table: dict) -> None:
+    inspector = inspect(conn)
+    tables = set(inspector.get_table_names())
+    for table, columns in columns_by_table.items():
+        if table not in tables:
+            continue
+
+        existing = {column["name"] for column in inspector.get_columns(table)}
+        for name, sql_type in columns:
+            if name not in existing:
+                conn.execute(
+                    text(f'ALTER TABLE "{table}" ADD COLUMN {name} {sql_type}')
+                )
+
+
+# Migration 1: add any columns that db.create_all() won't add to tables that
+# already exist
+def add_columns(conn: Connection) -> None:
+    add_missing_columns(conn, ADDED_COLUMNS)
+
+
+# Migration 2: add the indexes, and gather the statistics the planner uses to pick them
+def add_indexes(conn: Connection) -> None:
+    for statement in INDEXES:
+        conn.execute(text(statement))
+
+    conn.execute(text("ANALYZE"))
+
+
+# Migration 3: summarize each author's samples (see authors.py), and index samples
+# by author for the second stage of author ranking
+def add_author_summaries(conn: Connection) -> None:
+    from .authors import summarize
+    from .models import AuthorSummary
+
+    conn.execute(
+        text("CREATE INDEX IF NOT EXISTS ix_sample_user_name ON sample (user_id, name)")
+    )
+    AuthorSummary.__table__.create(conn, checkfirst=True)
+    conn.execute(AuthorSummary.__table__.delete())
+
+    rows = conn.execute(
+        text(
+            "SELECT user_id, name, fingerprint_blob, fingerprint_dim, "
+            "fingerprint_dtype, fingerprint FROM sample "
+            "WHERE user_id IS NOT NULL ORDER BY user_id, name"
+        )
+    )
+    for ((user_id, name), group) in itertools.groupby(rows, key=lambda row: row[:2]):
+        try:
+            fingerprints = [decode_fingerprint(*row[2:]) for row in group]
+        except ValueError:
+            traceback.print_exc()
+            continue
+
+        # Mixed dimensions can't be summarized; the author is left out of the first
+        # stage until their samples agree again
+        if len({len(fingerprint) for fingerprint in fingerprints}) > 1:
+            continue
+
+        count, centroid, sum_sq = summarize(np.stack(fingerprints))
+        conn.execute(
+            AuthorSummary.__table__.insert(),
+            {
+                "user_id": user_id,
+                "name": name,
+                "count": count,
+                "centroid_blob": np.asarray(centroid, dtype="<f8").tobytes(),
+                "dim": len(centroid),
+                "sum_sq": sum_sq,
+            },
+        )
+
+
+# Migration 4: tag fingerprints with the version of the model that computed them.
+# Existing ones are assumed to come from the model configured now. Also adds the
+# table of fingerprints waiting for a backfill to finish (see backfill.py).
+def add_model_versions(conn: Connection) -> None:
+    from .fpcache import get_model_version
+    from .models import PendingFingerprint
+
+    add_missing_columns(conn, MODEL_VERSION_COLUMNS)
+    PendingFingerprint.__table__.create(conn, checkfirst=True)
+    conn.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_sample_user_model_version "
+            "ON sample (user_id, model_version)"
+        )
+    )
+
+    version = {"version": get_model_version()}
+    for table in ("user", "sample"):
+        conn.execute(
+            text(
+                f'UPDATE "{table}" SET model_version = :version '
+                "WHERE model_version IS NULL"
+            ),
+            version,
+        )
+
+
+# Migration 5: let jobs wait before they are retried (see jobs.py)
+def add_job_delays(conn: Connection) -> None:
+    add_missing_columns(conn, {"job": [("run_after", "DATETIME")]})
+
+
+# The schema migrations in order; applying the nth one brings the database to
+# version n. New ones go at the end. SQLite's driver doesn't always run DDL inside
+# the transaction, so each one must be safe to run again.
+MIGRATIONS: list[Callable[[Connection], None]] = [
+    add_columns,
+    add_indexes,
+    add_author_summaries,
+    add_model_versions,
+    add_job_delays,
+]
+
+
+def schema_version(conn: Connection) -> int:
+    return conn.execute(text("PRAGMA user_version")).scalar()
+
+
+# Mark the database as having no migrations applied, e.g. after its tables have been
+# dropped and created again
+def reset_schema_version(db: SQLAlchemy) -> None:
+    with db.engine.begin() as conn:
+        conn.execute(text("PRAGMA user_version = 0"))
+
+
+# Apply the migrations the database doesn't have yet, then switch it to the
+# configured journal mode. Returns the new schema version.
+def upgrade_schema(db: SQLAlchemy) -> int:
+    with db.engine.connect() as conn:
+        version = schema_version(conn)
+
+    for (number, migration) in enumerate(MIGRATIONS[version:], start=version + 1):
+        with db.engine.begin() as conn:
+            migration(conn)
+            conn.execute(text(f"PRAGMA user_version = {number}"))
+
+    # The journal mode is kept in the database file, and can't be changed inside a
+    # transaction
+    journal_mode = get_database_config()["journal_mode"]
+    if journal_mode:
+        if journal_mode.lower() not in JOURNAL_MODES:
+            raise ValueError(f"Unknown journal mode: {journal_mode}")
+
+        with db.engine.connect() as conn:
+            conn.exec_driver_sql(f"PRAGMA journal_mode = {journal_mode}")
+
+    return max(version, len(MIGRATIONS))
+
+
+# Convert JSON fingerprints to packed float32, batch_size rows per transaction.
+# Returns the number of rows converted.
+def migrate_fingerprints(
+    db: SQLAlchemy, batch_size: int = 500, pause: float = 0.0
+) -> int:
+    converted = 0
+    last_id = 0
+    while True:
+        with db.engine.begin() as conn:
+            rows = conn.execute(
+                text(
+                    "SELECT id, fingerprint FROM sample "
+                    "WHERE fingerprint_blob IS NULL AND id > :last_id "
+                    "ORDER BY id LIMIT :batch_size"
+                ),
+                {"last_id": last_id, "batch_size": batch_size},
+            ).fetchall()
+            if not rows:
+                break
+
+            params = []
+            for (sample_id, fingerprint_json) in rows:
+                try:
+                    blob, dim, dtype = pack_json_fingerprint(fingerprint_json)
+                except ValueError:
+                    # Leave unreadable rows alone rather than stopping the whole migration
+                    traceback.print_exc()
+                    continue
+
+                params.append(
+                    {"id": sample_id, "blob": blob, "dim": dim, "dtype": dtype}
+                )
+
+            if params:
+                conn.execute(
+                    text(
+                        "UPDATE sample SET fingerprint_blob = :blob, fingerprint_dim = :dim, "
+                        "fingerprint_dtype = :dtype, fingerprint = '' "
+                        "WHERE id = :id AND fingerprint_blob IS NULL"
+                    ),
+                    params,
+                )
+
+            converted += len(params)
+            last_id = rows[-1][0]
+
+        # Give other writers a chance at the database between batches
+        if pause > 0:
+            time.sleep(pause)
+
+    return converted
+
+
+# Move images saved in the old layout (datadir/<user_id>/<sha1>.png) into the image
+# store, batch_size images per transaction. The old files are removed once no image
+# refers to them. Returns the number of images moved.
+def migrate_images(db: SQLAlchemy, batch_size: int = 100, pause: float = 0.0) -> int:
+    from .imagestore import image_mimetype, image_store
+    from .models import UserImage, image_digest
+
+    moved = 0
+    last_id = 0
+    while True:
+        images = (
+            UserImage.query.filter(UserImage.digest.is_(None), UserImage.id > last_id)
+            .order_by(UserImage.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not images:
+            break
+
+        old_paths = set()
+        for image in images:
+            last_id = image.id
+            if not os.path.exists(image.image_path):
+                print(f"Skipping image {image.id}: {image.image_path} is missing")
+                continue
+
+            with open(image.image_path, "rb") as image_fp:
+                digest = image_digest(image_fp)
+                mimetype = image_mimetype(image_fp)
+                image_store.write(image_fp, digest)
+
+            old_paths.update((image.image_path, image.thumbnail_path))
+            image.digest = digest
+            image.image_path, image.thumbnail_path = image_store.acquire(
+                digest, mimetype
+            )
+            image.ready = True
+            moved += 1
+
+        db.session.commit()
+
+        # Images of the same user with the same digest shared their files, so a
+        # file can only go once every image using it has been moved
+        for path in old_paths:
+            in_use = UserImage.query.filter(
+                or_(UserImage.image_path == path, UserImage.thumbnail_path == path)
+            ).count()
+            if not in_use and os.path.exists(path):
+                os.remove(path)
+
+        if pause > 0:
+            time.sleep(pause)
+
+    return moved
+
+
+if __name__ == "__main__":
+    from .main import create_app
+
+    parser = argparse.ArgumentParser(
+        description="Upgrade an existing database in place."
+    )
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--pause", type=float, default=0.05)
+    args = parser.parse_args()
+
+    _, db = create_app()
+    db.create_all()
+    version = upgrade_schema(db)
+    print(f"Schema is at version {version}")
+
+    count = migrate_fingerprints(db, batch_size=args.batch_size, pause=args.pause)
+    print(f"Converted {count} fingerprints")
+
+    count = migrate_images(db, batch_size=args.batch_size, pause=args.pause)
+    print(f"Moved {count} images into the image store")
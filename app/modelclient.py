@@ -0,0 +1,205 @@
+"""
+    This module contains the client used to talk to the author-id-model server.
+    Each worker process keeps one pooled keep-alive session, every call has connect
+    and read timeouts, failures that are safe to repeat are retried with backoff,
+    and the model's response is checked before it is used.
+"""
+
+import io
+import math
+import os
+import threading
+import time
+from typing import BinaryIO, NamedTuple, Optional
+import requests
+from requests.adapters import HTTPAdapter
+
+
+# Statuses that mean the server couldn't take the request right now. Fingerprinting
+# has no side effects, so these are safe to retry.
+RETRY_STATUSES = (429, 502, 503, 504)
+
+DEFAULT_CONFIG = {
+    "connect_timeout": 2.0,
+    "read_timeout": 30.0,
+    "retries": 2,
+    "backoff": 0.25,
+    "pool_size": 16,
+    "batch_path": "batch",
+}
+
+
+class ModelServerError(Exception):
+    pass
+
+
+class CallStats(NamedTuple):
+    latency: float
+    attempts: int
+    status: Optional[int]
+
+
+# Check that the model returned a flat, non-empty list of finite numbers
+def validate_fingerprint(data, expected_dim: Optional[int] = None) -> list[float]:
+    if not isinstance(data, list) or len(data) == 0:
+        raise ModelServerError("The model server didn't return a list of numbers")
+
+    if not all(isinstance(x, (int, float)) and not isinstance(x, bool) for x in data):
+        raise ModelServerError("The model server returned a non-numeric fingerprint")
+
+    if not all(math.isfinite(x) for x in data):
+        raise ModelServerError("The model server returned a non-finite fingerprint")
+
+    if expected_dim is not None and len(data) != expected_dim:
+        raise ModelServerError(
+            f"The model server returned {len(data)} values, expected {expected_dim}"
+        )
+
+    return [float(x) for x in data]
+
+
+class ModelClient:
+    """
+    HTTP client for the model server. The session is created lazily and recreated
+    after a fork, so every worker process gets its own connection pool.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        connect_timeout: float = DEFAULT_CONFIG["connect_timeout"],
+        read_timeout: float = DEFAULT_CONFIG["read_timeout"],
+        retries: int = DEFAULT_CONFIG["retries"],
+        backoff: float = DEFAULT_CONFIG["backoff"],
+        pool_size: int = DEFAULT_CONFIG["pool_size"],
+        expected_dim: Optional[int] = None,
+        batch_path: str = DEFAULT_CONFIG["batch_path"],
+    ):
+        self.base_url = base_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.expected_dim = expected_dim
+        self.batch_path = batch_path
+
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.session: Optional[requests.Session] = None
+        self.session_pid: Optional[int] = None
+
+        self.calls = 0
+        self.failures = 0
+        self.retried = 0
+        self.total_latency = 0.0
+
+    @classmethod
+    def from_settings(cls, settings: dict) -> "ModelClient":
+        conf = {**DEFAULT_CONFIG, **settings.get("model_client", {})}
+        return cls(
+            f"http://{settings['modelServerIP']}:{settings['modelServerPort']}/",
+            connect_timeout=conf["connect_timeout"],
+            read_timeout=conf["read_timeout"],
+            retries=conf["retries"],
+            backoff=conf["backoff"],
+            pool_size=conf["pool_size"],
+            expected_dim=settings.get("fingerprint_dim"),
+            batch_path=conf["batch_path"],
+        )
+
+    def get_session(self) -> requests.Session:
+        with self.lock:
+            if self.session is None or self.session_pid != os.getpid():
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.pool_size, max_retries=0
+                )
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self.session = session
+                self.session_pid = os.getpid()
+
+            return self.session
+
+    # Stats for the last call made from the current thread
+    @property
+    def last_call(self) -> Optional[CallStats]:
+        return getattr(self.local, "last_call", None)
+
+    # POST to the model server, retrying connection failures, timeouts and
+    # temporary server errors. Returns the decoded JSON response.
+    def post(self, path: str = "", files=None, rewind: tuple = ()) -> object:
+        url = self.base_url + path
+        start = time.perf_counter()
+        status = None
+        attempt = 0
+        try:
+            while True:
+                attempt += 1
+                for image_fp in rewind:
+                    image_fp.seek(0)
+
+                try:
+                    res = self.get_session().post(
+                        url, files=files, timeout=self.timeout
+                    )
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    if attempt > self.retries:
+                        raise ModelServerError(f"Model server unreachable: {e}") from e
+                else:
+                    status = res.status_code
+                    if res.ok:
+                        try:
+                            return res.json()
+                        except ValueError as e:
+                            raise ModelServerError(
+                                "Model server sent invalid JSON"
+                            ) from e
+
+                    if status not in RETRY_STATUSES or attempt > self.retries:
+                        raise ModelServerError(f"Model server responded with {status}")
+
+                with self.lock:
+                    self.retried += 1
+
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+        except ModelServerError:
+            with self.lock:
+                self.failures += 1
+
+            raise
+        finally:
+            latency = time.perf_counter() - start
+            self.local.last_call = CallStats(latency, attempt, status)
+            with self.lock:
+                self.calls += 1
+                self.total_latency += latency
+
+    # Get the fingerprint of one image
+    def fingerprint(self, image_fp: BinaryIO) -> list[float]:
+        data = self.post(files={"rq_image": image_fp}, rewind=(image_fp,))
+        return validate_fingerprint(data, self.expected_dim)
+
+    # Get the fingerprints of several images in one call to the batch endpoint.
+    # A single image goes to the regular endpoint, which every model server has.
+    def fingerprint_batch(self, images: list[bytes]) -> list[list[float]]:
+        if len(images) == 1:
+            return [self.fingerprint(io.BytesIO(images[0]))]
+
+        files = [("rq_images", (f"image{i}", data)) for (i, data) in enumerate(images)]
+        data = self.post(self.batch_path, files=files)
+        if not isinstance(data, list) or len(data) != len(images):
+            raise ModelServerError(
+                f"The model server returned a batch of the wrong size for {len(images)} images"
+            )
+
+        return [validate_fingerprint(item, self.expected_dim) for item in data]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "calls": self.calls,
+                "failures": self.failures,
+                "retries": self.retried,
+                "mean_latency": self.total_latency / self.calls if self.calls else 0.0,
+            }
@@ -5,19 +5,39 @@
 
 import hashlib
 import os
-from typing import BinaryIO
+from typing import BinaryIO, Optional
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
-from PIL import Image
+import numpy as np
 
+from .fingerprints import decode_fingerprint, pack_fingerprint, unpack_fingerprint
 from .main import settings
 
 
 TEMP_PATH = settings["tempdir"]
 DATA_PATH = settings["datadir"]
+DIGEST_CHUNK = 1024 * 1024
 db = SQLAlchemy()
 
 
+# The version of the model currently serving fingerprints, for column defaults
+def current_model_version() -> str:
+    from .fpcache import get_model_version
+
+    return get_model_version()
+
+
+# SHA-1 of an uploaded file, read in chunks. The file is rewound afterwards.
+def image_digest(image_fp: BinaryIO) -> str:
+    sha1 = hashlib.sha1()
+    image_fp.seek(0)
+    for chunk in iter(lambda: image_fp.read(DIGEST_CHUNK), b""):
+        sha1.update(chunk)
+
+    image_fp.seek(0)
+    return sha1.hexdigest()
+
+
 class User(UserMixin, db.Model):
     __tablename__ = "user"
 
@@ -25,13 +45,52 @@ class User(UserMixin, db.Model):
     email = db.Column(db.Text, unique=True, nullable=False)
     name = db.Column(db.Text, nullable=False)
     pw_hash = db.Column(db.String(100), nullable=False)
+    # A user can have a very large gallery, so these are only loaded when asked for.
+    # Views that list samples query them a page at a time instead.
     images = db.relationship(
-        "UserImage", back_populates="user", cascade="all, delete-orphan"
+        "UserImage", back_populates="user", cascade="all, delete-orphan", lazy="select"
     )
     samples = db.relationship(
-        "SampleEval", back_populates="user", cascade="all, delete-orphan"
+        "SampleEval", back_populates="user", cascade="all, delete-orphan", lazy="select"
+    )
+    batch_queries = db.relationship(
+        "BatchQuery", cascade="all, delete-orphan", lazy="select"
+    )
+    authors = db.relationship(
+        "AuthorSummary", cascade="all, delete-orphan", lazy="select"
+    )
+    pending_fingerprints = db.relationship(
+        "PendingFingerprint", cascade="all, delete-orphan", lazy="select"
+    )
+
+    # The model version of this user's fingerprints. Queries are fingerprinted by
+    # the same version until a backfill moves the user to a new one (backfill.py).
+    model_version = db.Column(db.String(64), default=current_model_version)
+
+    # Incremented whenever a sample is added or removed, so that every worker process
+    # can tell when its cached copy of this user's gallery is out of date
+    samples_version = db.Column(
+        db.Integer, nullable=False, default=0, server_default="0"
     )
 
+    # Bump samples_version as part of the current transaction. This is done in SQL
+    # rather than in Python so that concurrent workers can't lose an increment.
+    # If model_version is given, the bump only happens while the user's fingerprints
+    # are still of that version. Returns whether it happened.
+    def bump_samples_version(self, model_version: Optional[str] = None) -> bool:
+        query = User.query.filter_by(id=self.id)
+        if model_version is not None:
+            query = query.filter(
+                db.func.coalesce(User.model_version, current_model_version())
+                == model_version
+            )
+
+        updated = query.update(
+            {User.samples_version: User.samples_version + 1},
+            synchronize_session=False,
+        )
+        return updated > 0
+
 
 class UserImage(db.Model):
     __tablename__ = "image"
@@ -40,46 +99,65 @@ class UserImage(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
     user = db.relationship("User", back_populates="images")
 
+    # SHA-1 of the image's files in the image store (see imagestore.py). Images
+    # saved before the store existed have none until they are migrated.
+    digest = db.Column(db.String(40), index=True)
+
     # Image for the sample as filename
     image_path = db.Column(db.Text)
     thumbnail_path = db.Column(db.Text)
 
+    # False while the image files are still being written by a background job
+    ready = db.Column(db.Boolean, nullable=False, default=True, server_default="1")
+
     sample = db.relationship("SampleEval", back_populates="image", uselist=False)
 
-    def __init__(self, user: User, image_fp: BinaryIO):
+    def __init__(
+        self,
+        user: User,
+        image_fp: Optional[BinaryIO] = None,
+        digest: Optional[str] = None,
+        stored: Optional[tuple[str, str]] = None,
+    ):
         super(db.Model, self).__init__()
         self.user = user
-        directory = os.path.join(DATA_PATH, str(user.id))
-        os.makedirs(directory, exist_ok=True)
-
-        # Generate a path unique enough that collisions are impossible
-        image_fp.seek(0)
-        digest = hashlib.sha1(image_fp.read()).hexdigest()
-        self.image_path = os.path.join(directory, f"{digest}.png")
-        self.thumbnail_path = os.path.join(directory, f"{digest}.thumbnail.png")
-        with Image.open(image_fp) as image:
-            with open(self.image_path, "wb") as store_to:
-                image.save(store_to)
-
-            factor: float
-            if image.size[0] > image.size[1]:
-                factor = 400 / image.size[0]
-            else:
-                factor = 400 / image.size[1]
-
-            thumbnail = image.resize(
-                (int(factor * image.size[0]), int(factor * image.size[1]))
-            )
-            with open(self.thumbnail_path, "wb") as store_to:
-                thumbnail.save(store_to)
+
+        # stored is the (image, thumbnail) paths, if a reference to the image was
+        # already taken in the image store
+        if stored is None:
+            from .imagestore import image_store
+
+            if digest is None:
+                digest = image_digest(image_fp)
+
+            stored = image_store.put(image_fp, digest)
+
+        self.digest = digest
+        self.image_path, self.thumbnail_path = stored
+
+
+class StoredImage(db.Model):
+    """
+    An image in the image store, with the number of UserImages that refer to it.
+    """
+
+    __tablename__ = "stored_image"
+
+    digest = db.Column(db.String(40), primary_key=True)
+    refcount = db.Column(db.Integer, nullable=False, default=0)
+    mimetype = db.Column(db.String(32))
+    created = db.Column(db.DateTime, server_default=db.func.now())
 
 
 class SampleEval(db.Model):
     __tablename__ = "sample"
+    # Indexes on user_id and (user_id, timestamp) are added by the migrations in
+    # migrate.py
 
     id = db.Column(db.Integer, primary_key=True)
     image_id = db.Column(db.Integer, db.ForeignKey("image.id"))
-    image = db.relationship("UserImage", back_populates="sample")
+    # Wherever samples are shown, so are their images, so load them in the same query
+    image = db.relationship("UserImage", back_populates="sample", lazy="joined")
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
     user = db.relationship("User", back_populates="samples")
     timestamp = db.Column(db.DateTime, server_default=db.func.now())
@@ -87,11 +165,244 @@ class SampleEval(db.Model):
     # Name of this handwriting sample's known author
     name = db.Column(db.Text, nullable=False)
 
-    # Fingerprint of the sample
-    fingerprint = db.Column(db.Text, nullable=False)
+    # Legacy JSON-encoded fingerprint. Only rows that haven't been migrated yet still use it.
+    fingerprint_json = db.Column("fingerprint", db.Text, nullable=False, default="")
+
+    # Fingerprint of the sample as packed little-endian floats (see fingerprints.py)
+    fingerprint_blob = db.Column(db.LargeBinary)
+    fingerprint_dim = db.Column(db.Integer)
+    fingerprint_dtype = db.Column(db.String(8))
+
+    # Version of the model that computed the fingerprint
+    model_version = db.Column(db.String(64), default=current_model_version)
 
     def __init__(self, image: UserImage, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
         self.image = image
         self.user = image.user
+
+    @property
+    def fingerprint(self) -> np.ndarray:
+        return decode_fingerprint(
+            self.fingerprint_blob,
+            self.fingerprint_dim,
+            self.fingerprint_dtype,
+            self.fingerprint_json,
+        )
+
+    @fingerprint.setter
+    def fingerprint(self, values) -> None:
+        (
+            self.fingerprint_blob,
+            self.fingerprint_dim,
+            self.fingerprint_dtype,
+        ) = pack_fingerprint(values)
+        self.fingerprint_json = ""
+
+
+class AuthorSummary(db.Model):
+    """
+    Running summary of one author's samples in a user's gallery: how many there are,
+    their centroid and the sum of their squared distances from it. It is kept up to
+    date as samples are added and deleted (see authors.py).
+    """
+
+    __tablename__ = "author_summary"
+
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+
+    # Same as SampleEval.name
+    name = db.Column(db.Text, primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    # Packed little-endian float64, so that many small updates don't lose precision
+    centroid_blob = db.Column(db.LargeBinary, nullable=False)
+    dim = db.Column(db.Integer, nullable=False)
+    sum_sq = db.Column(db.Float, nullable=False, default=0.0)
+
+    @property
+    def centroid(self) -> np.ndarray:
+        return np.frombuffer(self.centroid_blob, dtype="<f8")
+
+    @centroid.setter
+    def centroid(self, values) -> None:
+        array = np.asarray(values, dtype="<f8").ravel()
+        self.centroid_blob = array.tobytes()
+        self.dim = array.shape[0]
+
+    # Root mean squared distance of the samples from the centroid
+    @property
+    def spread(self) -> float:
+        return float(np.sqrt(max(self.sum_sq, 0.0) / self.count)) if self.count else 0.0
+
+
+class PendingFingerprint(db.Model):
+    """
+    A sample's fingerprint from a newer model version, computed by the backfill in
+    backfill.py. These replace the user's fingerprints all at once, when every one
+    of their samples has one.
+    """
+
+    __tablename__ = "pending_fingerprint"
+
+    sample_id = db.Column(db.Integer, db.ForeignKey("sample.id"), primary_key=True)
+    model_version = db.Column(db.String(64), primary_key=True)
+    user_id = db.Column(
+        db.Integer, db.ForeignKey("user.id"), nullable=False, index=True
+    )
+    fingerprint_blob = db.Column(db.LargeBinary, nullable=False)
+    fingerprint_dim = db.Column(db.Integer, nullable=False)
+    fingerprint_dtype = db.Column(db.String(8), nullable=False)
+    created = db.Column(db.DateTime, server_default=db.func.now())
+
+
+class CachedFingerprint(db.Model):
+    """
+    A fingerprint the model returned for an image, keyed by the image's SHA-1 and
+    the version of the model that computed it.
+    """
+
+    __tablename__ = "fingerprint_cache"
+
+    digest = db.Column(db.String(40), primary_key=True)
+    model_version = db.Column(db.String(64), primary_key=True)
+    fingerprint_blob = db.Column(db.LargeBinary, nullable=False)
+    fingerprint_dim = db.Column(db.Integer, nullable=False)
+    fingerprint_dtype = db.Column(db.String(8), nullable=False)
+    last_used = db.Column(db.DateTime, server_default=db.func.now(), index=True)
+
+
+class QueryResult(db.Model):
+    """
+    The ranked sample ids and distances for one query, kept for a short time so
+    that later pages of the results don't need the query to be run again.
+    """
+
+    __tablename__ = "query_result"
+
+    token = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+
+    # Packed little-endian int64 ids and float32 distances, best match first
+    ids_blob = db.Column(db.LargeBinary, nullable=False)
+    dists_blob = db.Column(db.LargeBinary, nullable=False)
+    created = db.Column(db.DateTime, server_default=db.func.now(), index=True)
+
+
+class BatchQuery(db.Model):
+    """
+    Many unlabelled images ranked against a user's gallery together, by the
+    batch_query job in batch.py.
+    """
+
+    __tablename__ = "batch_query"
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    job_id = db.Column(db.Integer, db.ForeignKey("job.id"))
+    job = db.relationship("Job")
+    k = db.Column(db.Integer, nullable=False)
+
+    # One of pending, fingerprinting, ranking or done
+    status = db.Column(db.String(16), nullable=False, default="pending")
+
+    # Number of images, and how many of them have been fingerprinted so far
+    total = db.Column(db.Integer, nullable=False, default=0)
+    processed = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text)
+    created = db.Column(db.DateTime, server_default=db.func.now())
+    finished = db.Column(db.DateTime)
+
+    items = db.relationship(
+        "BatchQueryItem",
+        back_populates="batch",
+        cascade="all, delete-orphan",
+        order_by="BatchQueryItem.position",
+        lazy="select",
+    )
+
+
+class BatchQueryItem(db.Model):
+    """
+    One image of a batch query, and its ranked candidates once the batch is done.
+    """
+
+    __tablename__ = "batch_query_item"
+
+    id = db.Column(db.Integer, primary_key=True)
+    batch_id = db.Column(
+        db.Integer, db.ForeignKey("batch_query.id"), nullable=False, index=True
+    )
+    batch = db.relationship("BatchQuery", back_populates="items")
+    position = db.Column(db.Integer, nullable=False)
+    filename = db.Column(db.Text, nullable=False)
+    digest = db.Column(db.String(40))
+
+    # The upload, copied to the temp directory until the batch has been ranked
+    spool_path = db.Column(db.Text)
+
+    # One of pending, ready (fingerprinted), done or error
+    status = db.Column(db.String(16), nullable=False, default="pending")
+    error = db.Column(db.Text)
+
+    fingerprint_blob = db.Column(db.LargeBinary)
+    fingerprint_dim = db.Column(db.Integer)
+    fingerprint_dtype = db.Column(db.String(8))
+
+    # Packed little-endian int64 sample ids and float32 distances, best match first
+    ids_blob = db.Column(db.LargeBinary)
+    dists_blob = db.Column(db.LargeBinary)
+
+    @property
+    def fingerprint(self) -> np.ndarray:
+        return unpack_fingerprint(
+            self.fingerprint_blob, self.fingerprint_dim, self.fingerprint_dtype
+        )
+
+    @fingerprint.setter
+    def fingerprint(self, values) -> None:
+        (
+            self.fingerprint_blob,
+            self.fingerprint_dim,
+            self.fingerprint_dtype,
+        ) = pack_fingerprint(values)
+
+    @property
+    def ranked(self) -> list[tuple[int, float]]:
+        if self.ids_blob is None:
+            return []
+
+        ids = np.frombuffer(self.ids_blob, dtype="<i8")
+        dists = np.frombuffer(self.dists_blob, dtype="<f4")
+        return [(int(i), float(d)) for (i, d) in zip(ids, dists)]
+
+    @ranked.setter
+    def ranked(self, ranked: list[tuple[int, float]]) -> None:
+        self.ids_blob = np.array([i for (i, _) in ranked], dtype="<i8").tobytes()
+        self.dists_blob = np.array([d for (_, d) in ranked], dtype="<f4").tobytes()
+
+
+class Job(db.Model):
+    """
+    A unit of background work, run by the worker threads in jobs.py.
+    """
+
+    __tablename__ = "job"
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(32), nullable=False)
+
+    # JSON-encoded arguments for the job's handler
+    payload = db.Column(db.Text, nullable=False, default="{}")
+
+    # One of pending, running, done or failed
+    status = db.Column(db.String(16), nullable=False, default="pending", index=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text)
+
+    # A pending job isn't claimed before this time, e.g. while the model is down
+    run_after = db.Column(db.DateTime)
+    created = db.Column(db.DateTime, server_default=db.func.now())
+    started = db.Column(db.DateTime)
+    finished = db.Column(db.DateTime)
@@ -0,0 +1,139 @@
+"""
+    This module contains the paging of long listings.
+    The labelled sample list is paged by keyset over (timestamp, id), so each page
+    is an index range scan no matter how far down the list it is. Query results are
+    ranked once, and the ranking is kept in the query_result table under a random,
+    short-lived token, so further pages come straight from it without calling the
+    model or computing distances again.
+"""
+
+import base64
+from datetime import datetime, timedelta
+import secrets
+from typing import Optional
+import numpy as np
+from sqlalchemy import and_, or_, type_coerce
+
+from .main import settings
+from .models import QueryResult, SampleEval, User, db
+
+
+DEFAULT_CONFIG = {
+    "page_size": 50,
+    "query_page_size": 20,
+    "query_max_results": 1000,
+    "query_result_ttl": 600,
+}
+
+# How many saved rankings to allow between sweeps of expired ones
+SWEEP_EVERY = 32
+
+_saved_since_sweep = 0
+
+
+def get_pagination_config() -> dict:
+    return {**DEFAULT_CONFIG, **settings.get("pagination", {})}
+
+
+# Timestamps are compared as they are stored rather than as datetimes. SQLite keeps
+# them as text, and a bound datetime would be formatted with microseconds that the
+# server default doesn't write, so equal timestamps wouldn't compare equal.
+RAW_TIMESTAMP = type_coerce(SampleEval.timestamp, db.String)
+
+
+# Opaque cursor for the position just after a sample in the labelled list
+def encode_cursor(timestamp: str, sample_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{timestamp}|{sample_id}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Optional[tuple[str, int]]:
+    try:
+        key = base64.urlsafe_b64decode(cursor.encode()).decode()
+        timestamp, sample_id = key.rsplit("|", 1)
+        return timestamp, int(sample_id)
+    except ValueError:
+        return None
+
+
+# One page of a user's labelled samples, newest first, starting after the cursor.
+# Returns the samples and the cursor for the next page, if there is one.
+def page_samples(
+    user: User, cursor: Optional[str] = None, page_size: Optional[int] = None
+) -> tuple[list[SampleEval], Optional[str]]:
+    page_size = page_size or get_pagination_config()["page_size"]
+    query = db.session.query(SampleEval, RAW_TIMESTAMP).filter(
+        SampleEval.user_id == user.id
+    )
+
+    after = decode_cursor(cursor) if cursor else None
+    if after is not None:
+        timestamp, sample_id = after
+        query = query.filter(
+            or_(
+                RAW_TIMESTAMP < timestamp,
+                and_(RAW_TIMESTAMP == timestamp, SampleEval.id < sample_id),
+            )
+        )
+
+    # Fetch one extra row to find out whether there is another page
+    rows = (
+        query.order_by(SampleEval.timestamp.desc(), SampleEval.id.desc())
+        .limit(page_size + 1)
+        .all()
+    )
+    samples = [sample for (sample, _) in rows[:page_size]]
+    if len(rows) <= page_size:
+        return samples, None
+
+    (last, timestamp) = rows[page_size - 1]
+    return samples, encode_cursor(timestamp, last.id)
+
+
+# Keep a ranking for later pages. Returns its token.
+def save_ranking(user: User, ranked: list[tuple[int, float]]) -> str:
+    global _saved_since_sweep
+
+    conf = get_pagination_config()
+    ranked = ranked[: conf["query_max_results"]]
+    token = secrets.token_urlsafe(16)
+    db.session.add(
+        QueryResult(
+            token=token,
+            user_id=user.id,
+            ids_blob=np.array([i for (i, _) in ranked], dtype="<i8").tobytes(),
+            dists_blob=np.array([d for (_, d) in ranked], dtype="<f4").tobytes(),
+        )
+    )
+    db.session.commit()
+
+    _saved_since_sweep += 1
+    if _saved_since_sweep >= SWEEP_EVERY:
+        _saved_since_sweep = 0
+        sweep_rankings()
+
+    return token
+
+
+# A saved ranking, or None if the token is unknown, expired or someone else's
+def load_ranking(user: User, token: str) -> Optional[list[tuple[int, float]]]:
+    result = QueryResult.query.get(token)
+    if result is None or result.user_id != user.id:
+        return None
+
+    ttl = timedelta(seconds=get_pagination_config()["query_result_ttl"])
+    if datetime.utcnow() - result.created > ttl:
+        return None
+
+    ids = np.frombuffer(result.ids_blob, dtype="<i8")
+    dists = np.frombuffer(result.dists_blob, dtype="<f4")
+    return [(int(i), float(d)) for (i, d) in zip(ids, dists)]
+
+
+# Delete expired rankings
+def sweep_rankings() -> int:
+    ttl = timedelta(seconds=get_pagination_config()["query_result_ttl"])
+    deleted = QueryResult.query.filter(
+        QueryResult.created < datetime.utcnow() - ttl
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
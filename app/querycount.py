@@ -0,0 +1,106 @@
+"""
+    This module counts the SQL statements each request runs, and checks them against
+    a budget set per view with @query_budget. Going over budget is logged, or raises
+    QueryBudgetExceeded when the app's QUERY_BUDGET_STRICT option is set, so tests
+    catch views that start issuing one query per row. Counting is a single increment
+    per statement, so it is always on.
+"""
+
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Iterator
+from flask import Flask, Response, current_app, g, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .main import settings
+
+
+DEFAULT_CONFIG = {
+    "log": True,
+    "header": False,
+}
+
+HEADER = "X-SQL-Statements"
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def get_query_budget_config() -> dict:
+    return {**DEFAULT_CONFIG, **settings.get("query_budget", {})}
+
+
+def _count_statement(*_) -> None:
+    # Statements from background threads aren't part of any request
+    if has_request_context():
+        g.sql_statements = g.get("sql_statements", 0) + 1
+
+
+# Number of statements run so far by the current request
+def statement_count() -> int:
+    return g.get("sql_statements", 0)
+
+
+# Leave the statements run inside this block out of the count, for work that doesn't
+# scale with the data, such as polling for a background job
+@contextmanager
+def uncounted() -> Iterator[None]:
+    before = statement_count() if has_request_context() else None
+    try:
+        yield
+    finally:
+        if before is not None:
+            g.sql_statements = before
+
+
+# Limit the number of statements a view may run per request
+def query_budget(limit: int) -> Callable:
+    def decorator(view: Callable) -> Callable:
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            g.query_budget = limit
+            g.query_budget_view = view.__name__
+            return view(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+# g belongs to the app context, which a request shares if one is already pushed,
+# so start each request from zero
+def _reset_count() -> None:
+    g.sql_statements = 0
+    g.query_budget = None
+
+
+def _check_budget(response: Response) -> Response:
+    count = statement_count()
+    if current_app.config.get("QUERY_BUDGET_HEADER"):
+        response.headers[HEADER] = str(count)
+
+    limit = g.get("query_budget")
+    if limit is not None and count > limit:
+        message = f"{g.query_budget_view} ran {count} SQL statements, budget is {limit}"
+        if current_app.config.get("QUERY_BUDGET_STRICT"):
+            raise QueryBudgetExceeded(message)
+
+        if current_app.config.get("QUERY_BUDGET_LOG"):
+            current_app.logger.warning(message)
+
+    return response
+
+
+# Start counting statements for an app
+def install_query_counter(app: Flask) -> None:
+    conf = get_query_budget_config()
+    app.config.setdefault("QUERY_BUDGET_STRICT", False)
+    app.config.setdefault("QUERY_BUDGET_LOG", conf["log"])
+    app.config.setdefault("QUERY_BUDGET_HEADER", conf["header"])
+    if not event.contains(Engine, "before_cursor_execute", _count_statement):
+        event.listen(Engine, "before_cursor_execute", _count_statement)
+
+    app.before_request(_reset_count)
+    app.after_request(_check_budget)
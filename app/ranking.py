@@ -0,0 +1,214 @@
+"""
+    This module contains the ranking engine used to compare an unlabelled fingerprint
+    against a user's gallery of labelled fingerprints.
+    All of the distances are computed in one batched NumPy operation, and only the
+    requested top-k candidates are sorted. Many queries can be ranked together as
+    one query-by-gallery distance matrix, computed a block of queries at a time.
+"""
+
+from typing import Iterable, Optional, Sequence
+import numpy as np
+
+
+METRICS = ("euclidean", "cosine")
+
+# Most bytes of distances to hold at once when ranking many queries
+DEFAULT_CHUNK_BYTES = 64 * 1024 * 1024
+
+
+class RankingEngine:
+    """
+    Holds a user's fingerprints stacked into one contiguous float32 matrix together with
+    the matching sample ids, so that ranking a query is a single matrix-vector product.
+    The per-row squared norms are computed once up front and reused for every query.
+    """
+
+    def __init__(self, ids: Sequence[int], fingerprints: Iterable, metric="euclidean"):
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric: {metric}")
+
+        self.metric = metric
+        self.ids = np.asarray(ids, dtype=np.int64)
+        rows = [np.asarray(fp, dtype=np.float32) for fp in fingerprints]
+        if len(rows) != len(self.ids):
+            raise ValueError("Every fingerprint needs a matching sample id")
+
+        if rows:
+            self.matrix = np.ascontiguousarray(np.stack(rows))
+        else:
+            self.matrix = np.empty((0, 0), dtype=np.float32)
+
+        # Squared norms of each row, used by both metrics
+        self.sq_norms = np.einsum("ij,ij->i", self.matrix, self.matrix)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    # Approximate memory held by the engine's arrays
+    @property
+    def nbytes(self) -> int:
+        return self.ids.nbytes + self.matrix.nbytes + self.sq_norms.nbytes
+
+    # Build an engine straight from arrays that are already stacked
+    @classmethod
+    def from_arrays(
+        cls, ids: np.ndarray, matrix: np.ndarray, metric="euclidean"
+    ) -> "RankingEngine":
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric: {metric}")
+
+        matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        sq_norms = np.einsum("ij,ij->i", matrix, matrix)
+        return cls._assemble(metric, np.asarray(ids, dtype=np.int64), matrix, sq_norms)
+
+    # Copy of this engine with one more sample. The original is left untouched, so
+    # requests that are still ranking against it aren't disturbed. A sample that is
+    # already there, e.g. because the engine was loaded after it was committed, is
+    # not added again.
+    def with_sample(self, sample_id: int, fingerprint) -> "RankingEngine":
+        row = np.asarray(fingerprint, dtype=np.float32).reshape(1, -1)
+        if len(self) > 0 and row.shape[1] != self.matrix.shape[1]:
+            raise ValueError("Fingerprint dimension doesn't match the gallery")
+
+        if np.any(self.ids == sample_id):
+            return self
+
+        matrix = row if len(self) == 0 else np.concatenate((self.matrix, row))
+        return self._assemble(
+            self.metric,
+            np.append(self.ids, sample_id),
+            matrix,
+            np.append(self.sq_norms, np.einsum("ij,ij->i", row, row)),
+        )
+
+    # Copy of this engine without the given sample
+    def without_sample(self, sample_id: int) -> "RankingEngine":
+        keep = self.ids != sample_id
+        return self._assemble(
+            self.metric, self.ids[keep], self.matrix[keep], self.sq_norms[keep]
+        )
+
+    @classmethod
+    def _assemble(cls, metric, ids, matrix, sq_norms) -> "RankingEngine":
+        engine = cls.__new__(cls)
+        engine.metric = metric
+        engine.ids = ids
+        engine.matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        engine.sq_norms = np.asarray(sq_norms, dtype=np.float32)
+        return engine
+
+    # Distances from the query to every row of the matrix, in row order.
+    # If rows is given, only those rows are compared.
+    def distances(self, query, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        query = np.asarray(query, dtype=np.float32).ravel()
+        if len(self) == 0:
+            return np.empty(0, dtype=np.float32)
+
+        if query.shape[0] != self.matrix.shape[1]:
+            raise ValueError(
+                f"Query has dimension {query.shape[0]}, expected {self.matrix.shape[1]}"
+            )
+
+        matrix, sq_norms = self.matrix, self.sq_norms
+        if rows is not None:
+            matrix, sq_norms = matrix[rows], sq_norms[rows]
+
+        dots = matrix @ query
+        query_sq = float(query @ query)
+        if self.metric == "cosine":
+            denom = np.sqrt(sq_norms * query_sq)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                similarity = np.where(denom > 0, dots / denom, 0.0)
+
+            return (1.0 - similarity).astype(np.float32)
+
+        # ||a - b||^2 = ||a||^2 - 2 a.b + ||b||^2; clip the tiny negatives caused by rounding
+        sq_dists = sq_norms - 2.0 * dots + query_sq
+        np.maximum(sq_dists, 0.0, out=sq_dists)
+        return np.sqrt(sq_dists)
+
+    # Get the k closest samples as (sample id, distance) pairs in ascending order of distance.
+    # If k is None, the whole gallery is ranked.
+    def top_k(self, query, k: Optional[int] = None) -> list[tuple[int, float]]:
+        dists = self.distances(query)
+        return select_top_k(self.ids, dists, k)
+
+    # Distances from each query, one per row, to every row of the matrix
+    def distance_matrix(self, queries) -> np.ndarray:
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if len(self) == 0:
+            return np.empty((len(queries), 0), dtype=np.float32)
+
+        if queries.shape[1] != self.matrix.shape[1]:
+            raise ValueError(
+                f"Queries have dimension {queries.shape[1]}, expected {self.matrix.shape[1]}"
+            )
+
+        dots = queries @ self.matrix.T
+        query_sq = np.einsum("ij,ij->i", queries, queries)[:, None]
+        if self.metric == "cosine":
+            denom = np.sqrt(self.sq_norms[None, :] * query_sq)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                similarity = np.where(denom > 0, dots / denom, 0.0)
+
+            return (1.0 - similarity).astype(np.float32)
+
+        dots *= -2.0
+        dots += self.sq_norms[None, :]
+        dots += query_sq
+        np.maximum(dots, 0.0, out=dots)
+        return np.sqrt(dots, out=dots)
+
+    # top_k() for many queries at once. The distance matrix is worked through a block
+    # of queries at a time, so that only about chunk_bytes of it exists at once.
+    def top_k_many(
+        self, queries, k: Optional[int] = None, chunk_bytes: int = DEFAULT_CHUNK_BYTES
+    ) -> list[list[tuple[int, float]]]:
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        rows = max(1, chunk_bytes // (4 * max(len(self), 1)))
+        results = []
+        for start in range(0, len(queries), rows):
+            dists = self.distance_matrix(queries[start : start + rows])
+            results.extend(select_top_k_rows(self.ids, dists, k))
+
+        return results
+
+
+# Pick the k smallest distances with a partial selection, then sort only those k
+def select_top_k(
+    ids: np.ndarray, dists: np.ndarray, k: Optional[int] = None
+) -> list[tuple[int, float]]:
+    n = len(dists)
+    if k is None or k >= n:
+        order = np.argsort(dists, kind="stable")
+    elif k <= 0:
+        return []
+    else:
+        part = np.argpartition(dists, k - 1)[:k]
+        order = part[np.argsort(dists[part], kind="stable")]
+
+    return [(int(ids[i]), float(dists[i])) for i in order]
+
+
+# select_top_k() for each row of a distance matrix, in one vectorized pass
+def select_top_k_rows(
+    ids: np.ndarray, dists: np.ndarray, k: Optional[int] = None
+) -> list[list[tuple[int, float]]]:
+    n = dists.shape[1]
+    if k is None or k >= n:
+        order = np.argsort(dists, axis=1, kind="stable")
+    elif k <= 0:
+        return [[] for _ in range(len(dists))]
+    else:
+        part = np.argpartition(dists, k - 1, axis=1)[:, :k]
+        part_dists = np.take_along_axis(dists, part, axis=1)
+        order = np.take_along_axis(
+            part, np.argsort(part_dists, axis=1, kind="stable"), axis=1
+        )
+
+    top_ids = ids[order]
+    top_dists = np.take_along_axis(dists, order, axis=1)
+    return [
+        [(int(i), float(d)) for (i, d) in zip(row_ids, row_dists)]
+        for (row_ids, row_dists) in zip(top_ids, top_dists)
+    ]
@@ -0,0 +1,311 @@
+"""
+    This module contains the production server, used in place of app.run. The app is
+    created and warmed up once in a master process, which then forks worker processes
+    that share its listening socket and handle requests on a fixed pool of threads
+    each. Run it with:
+
+        python -m app.server
+
+    If the config starts the model server, its supervisor runs in a process of its own,
+    forked before anything else, so the workers aren't forked while its thread is
+    running. The master replaces workers as they exit. Each worker stops accepting connections
+    after max_requests requests (plus some jitter, so they don't all restart at once),
+    which bounds its memory growth. On SIGTERM or SIGINT, the workers stop accepting
+    connections and finish the requests they have, for up to graceful_timeout seconds,
+    before the master exits.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+import random
+import signal
+import socket
+import threading
+import time
+import traceback
+from typing import Optional
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+from werkzeug.serving import BaseWSGIServer
+
+from .main import KEYFILE, create_app, ensure_secret_key, settings
+from .supervisor import ModelSupervisor
+
+
+DEFAULT_CONFIG = {
+    "host": "127.0.0.1",
+    "workers": 4,
+    "threads": 8,
+    "max_requests": 1000,
+    "max_requests_jitter": 100,
+    "graceful_timeout": 30.0,
+    "preload_galleries": 16,
+    "backlog": 128,
+}
+
+# Workers that exit sooner than this after starting are replaced more slowly, so a
+# worker that can't start doesn't get forked in a tight loop
+MIN_WORKER_LIFETIME = 1.0
+
+
+def get_server_config() -> dict:
+    return {**DEFAULT_CONFIG, **settings.get("server", {})}
+
+
+class PoolWSGIServer(BaseWSGIServer):
+    """
+    Werkzeug's WSGI server, handling requests on a fixed pool of threads. After
+    max_requests connections it stops accepting more, and serve_forever() returns
+    once the requests it has are finished.
+    """
+
+    multithread = True
+
+    def __init__(
+        self,
+        app: Flask,
+        fd: int,
+        threads: int = DEFAULT_CONFIG["threads"],
+        max_requests: Optional[int] = None,
+    ):
+        super().__init__("127.0.0.1", 0, app, fd=fd)
+        self.pool = ThreadPoolExecutor(threads, thread_name_prefix="request")
+        self.max_requests = max_requests
+        self.accepted = 0
+
+    def process_request(self, request, client_address) -> None:
+        self.accepted += 1
+        if self.max_requests and self.accepted == self.max_requests:
+            self.drain()
+
+        self.pool.submit(self._handle, request, client_address)
+
+    def _handle(self, request, client_address) -> None:
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    # Stop accepting connections. shutdown() waits for the serving loop to notice,
+    # so it can't be called from that loop's thread, e.g. from a signal handler.
+    def drain(self) -> None:
+        threading.Thread(target=self.shutdown, daemon=True).start()
+
+    def serve_forever(self, poll_interval: float = 0.5) -> None:
+        try:
+            super().serve_forever(poll_interval)
+        finally:
+            self.pool.shutdown(wait=True)
+
+
+# The listening socket, shared by all the workers. It is non-blocking, so a worker
+# that loses the race to accept a connection goes back to waiting instead of hanging.
+def listen(host: str, port: int, backlog: int) -> socket.socket:
+    sock = socket.create_server((host, port), backlog=backlog)
+    sock.setblocking(False)
+    return sock
+
+
+# Body of a worker process, forked from the master
+def run_worker(app: Flask, sock: socket.socket, conf: dict, max_requests: int) -> None:
+    from .jobs import job_queue
+
+    server = PoolWSGIServer(app, sock.fileno(), conf["threads"], max_requests)
+    signal.signal(signal.SIGTERM, lambda *_: server.drain())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    job_queue.start(app)
+    try:
+        server.serve_forever()
+    finally:
+        job_queue.stop()
+
+
+class Master:
+    """
+    Forks the workers and keeps the configured number of them running until it is
+    told to stop. If it is given the model supervisor's process, it restarts that
+    too when it exits.
+    """
+
+    def __init__(
+        self,
+        app: Flask,
+        db: SQLAlchemy,
+        conf: dict,
+        supervisor: Optional[ModelSupervisor] = None,
+        supervisor_pid: Optional[int] = None,
+    ):
+        self.app = app
+        self.db = db
+        self.conf = conf
+        self.supervisor = supervisor
+        self.supervisor_pid = supervisor_pid
+        self.workers: dict[int, float] = {}
+        self.stopping = threading.Event()
+
+    def spawn(self, sock: socket.socket) -> None:
+        max_requests = self.conf["max_requests"]
+        if max_requests:
+            max_requests += random.randint(0, self.conf["max_requests_jitter"])
+
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                run_worker(self.app, sock, self.conf, max_requests)
+            except Exception:
+                traceback.print_exc()
+                status = 1
+            finally:
+                os._exit(status)
+
+        self.workers[pid] = time.monotonic()
+
+    # Collect the workers that have exited. Returns how long the youngest had run.
+    # Only the workers are waited for, so the supervisor's process isn't collected
+    # here by accident.
+    def reap(self) -> Optional[float]:
+        lifetime = None
+        for (pid, started) in list(self.workers.items()):
+            if os.waitpid(pid, os.WNOHANG)[0] == 0:
+                continue
+
+            del self.workers[pid]
+            age = time.monotonic() - started
+            lifetime = age if lifetime is None else min(lifetime, age)
+
+        return lifetime
+
+    # Start the model supervisor again if its process has exited. The master has no
+    # other threads, so forking it here is as safe as forking a worker.
+    def check_supervisor(self) -> None:
+        if self.supervisor_pid is None:
+            return
+
+        try:
+            exited = os.waitpid(self.supervisor_pid, os.WNOHANG)[0] != 0
+        except ChildProcessError:
+            exited = True
+
+        if exited:
+            print("The model supervisor exited, restarting it")
+            self.supervisor_pid = self.supervisor.start_process()
+
+    def stop(self, *_) -> None:
+        self.stopping.set()
+
+    def run(self) -> None:
+        port = settings.get("port")
+        if not isinstance(port, int):
+            port = 8090
+
+        sock = listen(self.conf["host"], port, self.conf["backlog"])
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        print(
+            f"Serving on {self.conf['host']}:{port} with {self.conf['workers']} "
+            f"workers of {self.conf['threads']} threads"
+        )
+
+        # Nothing the workers use may hold a database connection across the fork
+        self.db.session.remove()
+        self.db.engine.dispose()
+        try:
+            while not self.stopping.is_set():
+                lifetime = self.reap()
+                self.check_supervisor()
+                if lifetime is not None and lifetime < MIN_WORKER_LIFETIME:
+                    self.stopping.wait(MIN_WORKER_LIFETIME)
+
+                while len(self.workers) < self.conf["workers"]:
+                    if self.stopping.is_set():
+                        break
+
+                    self.spawn(sock)
+
+                self.stopping.wait(0.5)
+        finally:
+            self.shutdown()
+            sock.close()
+
+    # Ask every worker to finish its requests, and kill any still busy after the
+    # grace period
+    def shutdown(self) -> None:
+        for pid in self.workers:
+            os.kill(pid, signal.SIGTERM)
+
+        deadline = time.monotonic() + self.conf["graceful_timeout"]
+        while self.workers and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.1)
+
+        for pid in self.workers:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+
+        self.workers.clear()
+
+
+# Create the app and load everything the workers will need before forking, so that
+# it is done once and the memory is shared between them
+def preload(conf: dict) -> tuple[Flask, SQLAlchemy]:
+    from .gallery import preload_galleries
+    from .main import reset_test_user
+    from .migrate import upgrade_schema
+
+    app, db = create_app()
+    ensure_secret_key(app, KEYFILE)
+    db.create_all()
+    upgrade_schema(db)
+    if settings.get("test_user"):
+        reset_test_user(db)
+
+    loaded = preload_galleries(conf["preload_galleries"])
+    print(f"Preloaded {loaded} galleries")
+    return app, db
+
+
+# Stop the supervisor's process, which stops the model server
+def stop_supervisor(pid: int) -> None:
+    try:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+    except (ChildProcessError, ProcessLookupError):
+        # It already exited
+        pass
+
+
+def serve() -> None:
+    from .evaluation import fingerprint_backend
+    from .supervisor import model_supervisor
+
+    conf = get_server_config()
+    supervisor_pid = None
+    if settings.get("doStart"):
+        assert not settings.get("debug")  # Will crash
+        supervisor_pid = model_supervisor.start_process()
+        if not model_supervisor.wait_until_ready():
+            deadline = model_supervisor.startup_deadline
+            print(f"The model server wasn't ready after {deadline}s, still trying")
+
+    master = None
+    try:
+        app, db = preload(conf)
+        master = Master(app, db, conf, model_supervisor, supervisor_pid)
+        master.run()
+    finally:
+        fingerprint_backend.close()
+        if master is not None:
+            # The master may have restarted the supervisor
+            supervisor_pid = master.supervisor_pid
+
+        if supervisor_pid is not None:
+            stop_supervisor(supervisor_pid)
+
+
+if __name__ == "__main__":
+    serve()
@@ -0,0 +1,137 @@
+"""
+    This module contains a stand-in for the author-id-model server, for tests and
+    benchmarks that can't run the real TensorFlow model.
+    It returns deterministic fingerprints derived from the bytes of each image, accepts
+    batches as well as single images, and can add artificial latency to each call.
+    Run it in place of the model server with:
+
+        python -m app.stubserver --port 8080 --latency 0.05 --per-image 0.005
+"""
+
+import argparse
+import hashlib
+import threading
+import time
+from typing import Optional
+import numpy as np
+from flask import Flask, abort, jsonify, request
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+
+DEFAULT_DIM = 128
+
+
+# Deterministic unit-length fingerprint for an image, seeded by its SHA-256
+def stub_fingerprint(data: bytes, dim: int = DEFAULT_DIM) -> list[float]:
+    seed = int.from_bytes(hashlib.sha256(data).digest()[:8], "little")
+    vector = np.random.default_rng(seed).normal(size=dim)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+def create_stub_app(
+    dim: int = DEFAULT_DIM, latency: float = 0.0, per_image: float = 0.0
+) -> Flask:
+    app = Flask(__name__)
+    app.config["stats"] = {"calls": 0, "images": 0, "batches": []}
+    lock = threading.Lock()
+
+    def record(count: int) -> None:
+        with lock:
+            app.config["stats"]["calls"] += 1
+            app.config["stats"]["images"] += count
+            app.config["stats"]["batches"].append(count)
+
+        # A fixed cost per call plus a smaller cost per image, like batched inference
+        if latency > 0 or per_image > 0:
+            time.sleep(latency + per_image * count)
+
+    @app.route("/", methods=["GET", "POST"])
+    def single():
+        if request.method == "GET":
+            return jsonify({"status": "ok"})
+
+        image = request.files.get("rq_image")
+        if image is None:
+            abort(400)
+
+        record(1)
+        return jsonify(stub_fingerprint(image.read(), dim))
+
+    @app.route("/batch", methods=["POST"])
+    def batch():
+        images = request.files.getlist("rq_images")
+        if not images:
+            abort(400)
+
+        record(len(images))
+        return jsonify([stub_fingerprint(image.read(), dim) for image in images])
+
+    return app
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *_):
+        pass
+
+
+class StubServer:
+    """
+    Runs the stub model server on a background thread. Use port 0 to pick a free port.
+    """
+
+    def __init__(
+        self,
+        host: str = "localhost",
+        port: int = 0,
+        dim: int = DEFAULT_DIM,
+        latency: float = 0.0,
+        per_image: float = 0.0,
+    ):
+        self.app = create_stub_app(dim, latency, per_image)
+        self.server = make_server(
+            host, port, self.app, threaded=True, request_handler=QuietRequestHandler
+        )
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def port(self) -> int:
+        return self.server.server_port
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.server.host}:{self.port}/"
+
+    @property
+    def stats(self) -> dict:
+        return self.app.config["stats"]
+
+    def start(self) -> "StubServer":
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        if self.thread is not None:
+            self.thread.join()
+
+    def __enter__(self) -> "StubServer":
+        return self.start()
+
+    def __exit__(self, *_):
+        self.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stand-in author-id-model server.")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--dim", type=int, default=DEFAULT_DIM)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds per call")
+    parser.add_argument(
+        "--per-image", type=float, default=0.0, help="Seconds per image"
+    )
+    args = parser.parse_args()
+
+    app = create_stub_app(args.dim, args.latency, args.per_image)
+    make_server(args.host, args.port, app, threaded=True).serve_forever()
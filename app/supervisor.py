@@ -0,0 +1,326 @@
+"""
+    This module contains the supervisor for the author-id-model server.
+    It launches the model process, then sends it a warm-up fingerprint request until it
+    answers, up to a deadline. While the model is up it is probed now and then, and if
+    the process exits or stops answering it is restarted, with a growing delay between
+    attempts. The web app asks the supervisor whether the model is ready, so that
+    fingerprint calls fail straight away with a clear error while it is down, instead
+    of each one waiting for a connection timeout.
+    The state is kept in shared memory, so processes forked after the supervisor is
+    created see it change too. server.py runs the supervisor in a process of its own
+    and forks its workers from another, so that no worker is forked while the
+    supervisor's thread is running.
+"""
+
+import io
+import multiprocessing
+import os
+import signal
+import subprocess
+import threading
+import time
+import traceback
+from typing import Callable, Optional
+from PIL import Image
+
+from .main import kill_port_user, settings
+from .modelclient import ModelClient, ModelServerError
+
+
+DEFAULT_CONFIG = {
+    "command": ["./start_model_server.sh"],
+    "kill_port": True,
+    "startup_deadline": 120.0,
+    "probe_interval": 0.5,
+    "probe_timeout": 10.0,
+    "check_interval": 5.0,
+    "max_failures": 3,
+    "backoff": 1.0,
+    "max_backoff": 60.0,
+    "warmup_image": None,
+}
+
+STATES = ("stopped", "starting", "ready", "down")
+
+# How long to wait for the model process to exit before killing it
+TERMINATE_TIMEOUT = 10.0
+
+
+class ModelUnavailable(ModelServerError):
+    pass
+
+
+def get_supervisor_config() -> dict:
+    return {**DEFAULT_CONFIG, **settings.get("model_supervisor", {})}
+
+
+# A small blank page to send as the warm-up request, unless one is configured
+def warmup_image(path: Optional[str] = None) -> bytes:
+    if path is not None:
+        with open(path, "rb") as image_fp:
+            return image_fp.read()
+
+    out = io.BytesIO()
+    Image.new("RGB", (64, 64), "white").save(out, format="PNG")
+    return out.getvalue()
+
+
+# A probe that fingerprints the warm-up image with one short attempt. It raises if
+# the model doesn't give a valid answer.
+def make_probe(client: ModelClient, image: bytes) -> Callable[[], None]:
+    def probe() -> None:
+        client.fingerprint(io.BytesIO(image))
+
+    return probe
+
+
+class ModelSupervisor:
+    """
+    Runs the model server process from a background thread, restarting it when it
+    dies. The state is one of stopped, starting, ready or down.
+    """
+
+    def __init__(
+        self,
+        command: list[str],
+        probe: Callable[[], None],
+        startup_deadline: float = DEFAULT_CONFIG["startup_deadline"],
+        probe_interval: float = DEFAULT_CONFIG["probe_interval"],
+        check_interval: float = DEFAULT_CONFIG["check_interval"],
+        max_failures: int = DEFAULT_CONFIG["max_failures"],
+        backoff: float = DEFAULT_CONFIG["backoff"],
+        max_backoff: float = DEFAULT_CONFIG["max_backoff"],
+        kill_port: Optional[Callable[[], None]] = None,
+    ):
+        self.command = command
+        self.probe = probe
+        self.startup_deadline = startup_deadline
+        self.probe_interval = probe_interval
+        self.check_interval = check_interval
+        self.max_failures = max_failures
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.kill_port = kill_port
+
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.stopping = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.process: Optional[subprocess.Popen] = None
+        self.shared_state = multiprocessing.RawValue("i", 0)
+        self.last_error: Optional[str] = None
+        self.restarts = 0
+
+    @classmethod
+    def from_settings(cls, settings: dict) -> "ModelSupervisor":
+        conf = {**DEFAULT_CONFIG, **settings.get("model_supervisor", {})}
+        client = ModelClient.from_settings(settings)
+        client.timeout = (conf["probe_timeout"], conf["probe_timeout"])
+        client.retries = 0
+        return cls(
+            conf["command"],
+            make_probe(client, warmup_image(conf["warmup_image"])),
+            startup_deadline=conf["startup_deadline"],
+            probe_interval=conf["probe_interval"],
+            check_interval=conf["check_interval"],
+            max_failures=conf["max_failures"],
+            backoff=conf["backoff"],
+            max_backoff=conf["max_backoff"],
+            kill_port=kill_port_user if conf["kill_port"] else None,
+        )
+
+    @property
+    def state(self) -> str:
+        return STATES[self.shared_state.value]
+
+    @state.setter
+    def state(self, state: str) -> None:
+        self.shared_state.value = STATES.index(state)
+
+    # Whether the model server is being run by this supervisor, here or in the
+    # process this one was forked from
+    @property
+    def supervising(self) -> bool:
+        return self.state != "stopped"
+
+    # Start the model server and wait for it to be ready, up to the startup deadline.
+    # Returns whether it is ready; if not, it keeps trying in the background.
+    def start(self, wait: bool = True) -> bool:
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.stopping.clear()
+                self.state = "starting"
+                self.thread = threading.Thread(
+                    target=self._run, name="model-supervisor", daemon=True
+                )
+                self.thread.start()
+
+        if wait:
+            return self.ready.wait(self.startup_deadline)
+
+        return self.ready.is_set()
+
+    def stop(self) -> None:
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    # Run the supervisor in a child process until the child gets SIGTERM, so that
+    # the caller has no supervisor thread to carry into processes it forks later.
+    # Returns the child's pid.
+    def start_process(self) -> int:
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                terminated = threading.Event()
+                signal.signal(signal.SIGTERM, lambda *_: terminated.set())
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                self.start(wait=False)
+                while not terminated.wait(0.5):
+                    pass
+
+                self.stop()
+            except Exception:
+                traceback.print_exc()
+                status = 1
+            finally:
+                os._exit(status)
+
+        return pid
+
+    # Wait for the model server to be ready, up to the startup deadline, when the
+    # supervisor runs in another process. Returns whether it is ready.
+    def wait_until_ready(self) -> bool:
+        deadline = time.monotonic() + self.startup_deadline
+        while self.state != "ready":
+            if time.monotonic() > deadline:
+                return False
+
+            time.sleep(self.probe_interval)
+
+        return True
+
+    # Raise ModelUnavailable if the supervised model server isn't ready. Does nothing
+    # if the model server is run some other way.
+    def check(self) -> None:
+        if self.state in ("starting", "down"):
+            message = f"The model server is {self.state}"
+            if self.last_error:
+                message += f" ({self.last_error})"
+
+            raise ModelUnavailable(message)
+
+    def status(self) -> dict:
+        return {
+            "supervised": self.supervising,
+            "state": self.state,
+            "ready": self.state == "ready",
+            "restarts": self.restarts,
+            "pid": self.process.pid if self.process is not None else None,
+            "last_error": self.last_error,
+        }
+
+    def _run(self) -> None:
+        delay = self.backoff
+        while not self.stopping.is_set():
+            self.state = "starting"
+            try:
+                self._launch()
+            except OSError as e:
+                self.last_error = f"Couldn't launch the model server: {e}"
+            else:
+                if self._wait_until_ready():
+                    started = time.monotonic()
+                    self.state = "ready"
+                    self.last_error = None
+                    self.ready.set()
+                    self._watch()
+                    self.state = "down"
+                    self.ready.clear()
+
+                    # It ran well for a while, so don't hold the next restart back
+                    if time.monotonic() - started > self.max_backoff:
+                        delay = self.backoff
+
+            self._terminate()
+            if self.stopping.is_set():
+                break
+
+            self.state = "down"
+            self.restarts += 1
+            self.stopping.wait(delay)
+            delay = min(2 * delay, self.max_backoff)
+
+        self._terminate()
+        self.state = "stopped"
+
+    def _launch(self) -> None:
+        if self.kill_port is not None:
+            self.kill_port()
+
+        # In its own process group, so stopping it also stops anything it started
+        self.process = subprocess.Popen(self.command, start_new_session=True)
+
+    # Probe the model until it answers. False if it exits or the deadline passes.
+    def _wait_until_ready(self) -> bool:
+        deadline = time.monotonic() + self.startup_deadline
+        while not self.stopping.is_set():
+            if self.process.poll() is not None:
+                self.last_error = f"Exited with status {self.process.returncode}"
+                return False
+
+            if self._probe():
+                return True
+
+            if time.monotonic() > deadline:
+                self.last_error = f"Not ready after {self.startup_deadline:g}s"
+                return False
+
+            self.stopping.wait(self.probe_interval)
+
+        return False
+
+    # Keep checking a ready model. Returns once it has exited or failed too many
+    # probes in a row, or the supervisor is stopped.
+    def _watch(self) -> None:
+        failures = 0
+        while not self.stopping.wait(self.check_interval):
+            if self.process.poll() is not None:
+                self.last_error = f"Exited with status {self.process.returncode}"
+                return
+
+            if self._probe():
+                failures = 0
+            else:
+                failures += 1
+                if failures >= self.max_failures:
+                    return
+
+    def _probe(self) -> bool:
+        try:
+            self.probe()
+            return True
+        except Exception as e:
+            self.last_error = str(e)
+            return False
+
+    def _terminate(self) -> None:
+        process = self.process
+        if process is None or process.poll() is not None:
+            return
+
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+            process.wait(TERMINATE_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+        except ProcessLookupError:
+            pass
+        except OSError:
+            traceback.print_exc()
+
+
+model_supervisor = ModelSupervisor.from_settings(settings)
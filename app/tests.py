@@ -1,23 +1,106 @@
+from concurrent.futures import ThreadPoolExecutor
+import csv
+from datetime import datetime
+import hashlib
+import html
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
+import os
 import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+import zipfile
+from flask import Flask, Response, g
 from flask_login import login_user
+import numpy as np
+from PIL import Image
 import pytest
-import html
-
+import requests
+from sqlalchemy import create_engine, inspect, text
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.security import generate_password_hash
 
-from .main import (
-    AppContextManager,
-    get_config,
-    update_settings,
-    start_model_server,
+from .main import AppContextManager, get_config, start_model_server, update_settings
+
+# Set AUTHORID_REAL_MODEL=1 to run the tests against the real model, started with
+# start_model_server.sh as in production, instead of the stub model server. The
+# tests marked real_model only run then.
+REAL_MODEL = bool(os.environ.get("AUTHORID_REAL_MODEL"))
+real_model = pytest.mark.skipif(not REAL_MODEL, reason="AUTHORID_REAL_MODEL isn't set")
+
+# The modules below read the settings when they are imported, so the test config
+# has to be in place first
+test_settings = get_config("config/test_config.json")
+if REAL_MODEL:
+    test_settings.pop("model_supervisor", None)
+
+# Stored images, indexes and spooled uploads go to a temporary directory rather
+# than into the source tree
+TEST_ROOT = tempfile.mkdtemp(prefix="authorid-test-")
+test_settings["datadir"] = os.path.join(TEST_ROOT, "data", "")
+test_settings["tempdir"] = os.path.join(TEST_ROOT, "tmp", "")
+update_settings(test_settings)
+
+from . import authors, backfill, evaluation, pagination, uploads
+from .ann import AnnManager, IVFIndex, ann_manager, get_ann_config
+from .authors import summarize
+from .backends import (
+    HTTPBackend,
+    ProcessBackend,
+    StubBackend,
+    backend_from_settings,
+)
+from .batching import FingerprintBatcher
+from .fpcache import FingerprintCache, get_model_version
+from .gallery import GalleryCache, load_engine
+from .identity import SESSION_KEY
+from .imagestore import ImageStore, ThumbnailSpec, image_store
+from .jobs import HANDLERS, JobQueue, enqueue, job_handler, job_queue
+from .main import settings
+from .metrics import install_metrics
+from .migrate import (
+    MIGRATIONS,
+    migrate_fingerprints,
+    migrate_images,
+    upgrade_schema,
+)
+from .modelclient import ModelClient, ModelServerError
+from .models import (
+    AuthorSummary,
+    BatchQuery,
+    CachedFingerprint,
+    Job,
+    PendingFingerprint,
+    SampleEval,
+    StoredImage,
+    TEMP_PATH,
+    User,
+    UserImage,
+    db,
+    image_digest,
+)
+from .pagination import page_samples
+from .querycount import HEADER, QueryBudgetExceeded, _check_budget
+from .ranking import RankingEngine
+from .server import Master, PoolWSGIServer, listen, stop_supervisor
+from .stubserver import StubServer, stub_fingerprint
+from .supervisor import (
+    ModelSupervisor,
+    ModelUnavailable,
+    make_probe,
+    model_supervisor,
+    warmup_image,
 )
 
 
 @pytest.fixture(scope="session")
 def manager():
-    update_settings(get_config("config/test_config.json"))
-    from .main import settings
-
     with AppContextManager(True) as manager:
         if settings.get("doStart"):
             start_model_server()
@@ -26,6 +109,8 @@ def manager():
             {
                 "TESTING": True,
                 "WTF_CSRF_ENABLED": False,
+                "QUERY_BUDGET_STRICT": True,
+                "QUERY_BUDGET_HEADER": True,
             }
         )
         manager.app.secret_key = "planking at a candlelight vigil"
@@ -33,13 +118,20 @@ def manager():
         yield manager
 
         # Cleanup
-        shutil.rmtree(settings["datadir"], ignore_errors=True)  # Doesn't always exist
-        shutil.rmtree(settings["tempdir"], ignore_errors=True)
+        shutil.rmtree(TEST_ROOT, ignore_errors=True)
+
+
+# A test client that sends the header the JSON API wants on requests that
+# change anything
+def api_client(manager):
+    client = manager.app.test_client()
+    client.environ_base["HTTP_X_REQUESTED_WITH"] = "pytest"
+    return client
 
 
 @pytest.fixture(scope="session")
 def client(manager):
-    return manager.app.test_client()
+    return api_client(manager)
 
 
 @pytest.fixture(scope="session")
@@ -48,6 +140,16 @@ def context(manager):
         yield context
 
 
+# A stub model server that the views fingerprint with, for the length of a test
+@pytest.fixture
+def stub_model(monkeypatch):
+    with StubServer(dim=8) as stub:
+        monkeypatch.setattr(
+            evaluation, "fingerprint_backend", HTTPBackend(ModelClient(stub.url))
+        )
+        yield stub
+
+
 def test_field_required(client):
     res = client.post(
         "/users/new",
@@ -189,8 +291,6 @@ def test_compare_images(client):
 
 
 def test_del_sample(manager, client):
-    from .models import SampleEval
-
     with manager.app.app_context():
         # First sample must belong to the current user, since no other user
         # could have uploaded any samples
@@ -206,3 +306,1326 @@ def test_del_sample(manager, client):
         print(res.data)
         assert res.status_code == 200
         assert str(sample.id) not in res.get_data(as_text=True)
+
+
+def test_ranking_engine_top_k():
+    rng = np.random.default_rng(0)
+    gallery = rng.normal(size=(50, 16))
+    query = rng.normal(size=16)
+    engine = RankingEngine(range(100, 150), gallery)
+
+    expected = np.linalg.norm(gallery - query, axis=1)
+    top = engine.top_k(query, 5)
+    assert [i for (i, _) in top] == [100 + i for i in np.argsort(expected)[:5]]
+    assert np.allclose([d for (_, d) in top], np.sort(expected)[:5], atol=1e-4)
+    assert len(engine.top_k(query)) == 50
+
+
+def test_ranking_engine_cosine():
+    engine = RankingEngine([1, 2, 3], [[1, 0], [0, 1], [2, 0.1]], metric="cosine")
+    ranked = engine.top_k([3, 0], 2)
+    assert [i for (i, _) in ranked] == [1, 3]
+    assert ranked[0][1] < 1e-6
+
+
+def test_ranking_engine_top_k_many():
+    rng = np.random.default_rng(1)
+    queries = rng.normal(size=(23, 16))
+    for metric in ("euclidean", "cosine"):
+        engine = RankingEngine(range(50), rng.normal(size=(50, 16)), metric=metric)
+
+        # Small enough chunks that the queries are ranked a few at a time
+        ranked = engine.top_k_many(queries, 5, chunk_bytes=4 * 50 * 4)
+        for (query, top) in zip(queries, ranked):
+            expected = engine.top_k(query, 5)
+            assert [i for (i, _) in top] == [i for (i, _) in expected]
+            assert np.allclose([d for (_, d) in top], [d for (_, d) in expected])
+
+    assert len(engine.top_k_many(queries)[0]) == 50
+
+
+def test_migrate_fingerprints(manager):
+    values = [0.5, -1.25, 3.0]
+    with manager.app.app_context():
+        db = manager.db
+        db.session.execute(
+            text("INSERT INTO sample (name, fingerprint) VALUES ('Legacy', :fp)"),
+            {"fp": json.dumps(values)},
+        )
+        db.session.commit()
+        legacy = SampleEval.query.filter_by(name="Legacy").one()
+        assert legacy.fingerprint_blob is None
+        assert np.allclose(legacy.fingerprint, values)
+
+        assert migrate_fingerprints(db, batch_size=1) >= 1
+        db.session.expire_all()
+        assert legacy.fingerprint_json == ""
+        assert legacy.fingerprint_dim == 3
+        assert np.frombuffer(legacy.fingerprint_blob, dtype="<f4").tolist() == values
+
+        db.session.delete(legacy)
+        db.session.commit()
+
+
+def test_gallery_cache_updates_and_eviction():
+    cache = GalleryCache(budget_bytes=10**9)
+    engine = RankingEngine([1, 2], np.eye(2, 4))
+    loads = []
+
+    def loader():
+        loads.append(1)
+        return engine
+
+    assert cache.get(7, 3, loader) is engine
+    assert cache.get(7, 3, loader) is engine
+    assert len(loads) == 1
+
+    # A local insert one version ahead is applied in place
+    cache.add_sample(7, 4, 3, [0, 0, 1, 0])
+    assert [i for (i, _) in cache.get(7, 4, loader).top_k([0, 0, 1, 0], 1)] == [3]
+    cache.remove_sample(7, 5, 3)
+    assert 3 not in cache.get(7, 5, loader).ids
+    assert len(loads) == 1
+
+    # The loader can read a sample committed after the version it was tagged with,
+    # so patching in that sample mustn't add it twice
+    cache.put(7, 5, RankingEngine([1, 2, 3], np.eye(3, 4)))
+    cache.add_sample(7, 6, 3, [0, 0, 1, 0])
+    assert cache.get(7, 6, loader).ids.tolist() == [1, 2, 3]
+
+    # Another worker changed the gallery, so the version doesn't line up
+    cache.add_sample(7, 9, 4, [0, 0, 0, 1])
+    assert 7 not in cache
+    cache.get(7, 9, loader)
+    assert len(loads) == 2
+
+    # Least recently used users go first once the budget is exceeded
+    cache.budget_bytes = engine.nbytes * 2
+    cache.put(8, 0, engine)
+    cache.get(7, 9, loader)
+    cache.put(9, 0, engine)
+    assert 7 in cache and 9 in cache and 8 not in cache
+
+
+def test_ivf_index_matches_exact_search(tmp_path, monkeypatch):
+    rng = np.random.default_rng(3)
+    engine = RankingEngine.from_arrays(np.arange(500), rng.normal(size=(500, 8)))
+    query = rng.normal(size=8)
+    exact = engine.top_k(query, 10)
+
+    # Probing every list is the same as an exact scan
+    index = IVFIndex.build(engine, nlist=16)
+    ids, dists = index.search(engine, query, nprobe=16)
+    assert sorted(ids.tolist()) == list(range(500))
+
+    # The index refers to the engine's rows rather than keeping its own copy of them
+    assert index.nbytes < engine.matrix.nbytes / 2
+
+    index.save(str(tmp_path / "ivf.npz"))
+    loaded = IVFIndex.load(str(tmp_path / "ivf.npz"))
+    assert np.array_equal(loaded.ids, index.ids)
+
+    # Samples added or removed since the index was built are still accounted for
+    manager = AnnManager(str(tmp_path))
+    manager.indexes[1] = loaded
+    changed = engine.without_sample(exact[0][0]).with_sample(1000, query)
+    ranked = manager.top_k(1, changed, query, 10)
+    assert ranked[0][0] == 1000
+    assert exact[0][0] not in [i for (i, _) in ranked]
+
+    # An index of another model version's fingerprints is thrown away, even though
+    # its ids still match
+    manager.forget(1)
+    (tmp_path / "1").mkdir()
+    IVFIndex.build(engine, nlist=16, model_version="v1").save(manager.index_path(1))
+    assert manager._get_index(1, engine, "v1").model_version == "v1"
+    manager.building.add(1)  # Don't start a rebuild in the background
+    assert manager.top_k(1, engine, query, 10, "v2") == exact
+    assert 1 not in manager.indexes
+    assert not (tmp_path / "1" / "ivf.npz").exists()
+
+    monkeypatch.setitem(settings, "ann", {"nprobe": 0})
+    with pytest.raises(ValueError):
+        get_ann_config()
+
+
+def test_fingerprint_cache(manager):
+    cache = FingerprintCache(max_entries=4)
+    with manager.app.app_context():
+        assert cache.get("0" * 40, "v1") is None
+        cache.put("0" * 40, [1.0, 2.0], "v1")
+        assert np.array_equal(cache.get("0" * 40, "v1"), [1.0, 2.0])
+        assert cache.get("0" * 40, "v2") is None
+        assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 2
+
+        # A hit is recorded once the caller's transaction is over, without
+        # committing anything of the caller's
+        CachedFingerprint.query.update({"last_used": datetime(2000, 1, 1)})
+        manager.db.session.commit()
+        manager.db.session.add(
+            User(email="uncommitted@test.com", name="No", pw_hash="-")
+        )
+        assert cache.get("0" * 40, "v1") is not None
+        manager.db.session.rollback()
+        assert User.query.filter_by(email="uncommitted@test.com").count() == 0
+        entry = CachedFingerprint.query.filter_by(digest="0" * 40).one()
+        assert entry.last_used > datetime(2000, 1, 1)
+
+        for i in range(1, 8):
+            cache.put(str(i) * 40, [float(i)], "v1")
+
+        assert cache.evict() > 0
+        assert CachedFingerprint.query.count() <= 4
+        assert cache.get("7" * 40, "v1") is not None
+        CachedFingerprint.query.delete()
+        manager.db.session.commit()
+
+
+def test_model_client_retries_and_validates():
+    responses = [(503, b""), (200, b"[0.5, 1.5]"), (200, b'{"not": "a list"}')]
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            status, body = responses.pop(0)
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *_):
+            pass
+
+    server = ThreadingHTTPServer(("localhost", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        client = ModelClient(
+            f"http://localhost:{server.server_port}/", retries=1, backoff=0
+        )
+        assert client.fingerprint(io.BytesIO(b"image")) == [0.5, 1.5]
+        assert client.last_call.attempts == 2
+        assert client.last_call.status == 200
+
+        try:
+            client.fingerprint(io.BytesIO(b"image"))
+            assert False, "Invalid response was accepted"
+        except ModelServerError:
+            pass
+
+        assert client.stats()["calls"] == 2
+        assert client.stats()["retries"] == 1
+    finally:
+        server.shutdown()
+
+
+def test_batcher_groups_concurrent_requests():
+    images = [f"scan {i}".encode() for i in range(12)]
+    with StubServer(dim=8, latency=0.05) as stub:
+        batcher = FingerprintBatcher(ModelClient(stub.url), window=0.05, max_batch=8)
+        with ThreadPoolExecutor(12) as pool:
+            results = list(
+                pool.map(lambda data: batcher.fingerprint(io.BytesIO(data)), images)
+            )
+
+        # Every caller gets back its own image's fingerprint
+        for (data, fingerprint) in zip(images, results):
+            assert fingerprint == pytest.approx(stub_fingerprint(data, 8))
+
+        assert stub.stats["images"] == 12
+        assert stub.stats["calls"] < 12
+        assert max(stub.stats["batches"]) <= 8
+
+
+def test_bulk_upload_zip(manager, client, stub_model):
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zip_fp:
+        zip_fp.write("test_data/author5a.png", "Bulky/a.png")
+        zip_fp.write("test_data/author5b.png", "Bulky/b.png")
+        zip_fp.writestr("notes.txt", "not an image")
+        zip_fp.writestr("loose.png", b"no folder, no manifest entry")
+    archive.seek(0)
+
+    res = client.post("/eval/bulk", data={"archive": (archive, "class.zip")})
+
+    print(res.data)
+    assert res.status_code == 200
+    assert b"2 of 3 samples added" in res.data
+    with manager.app.app_context():
+        assert SampleEval.query.filter_by(name="Bulky").count() == 2
+
+
+def test_job_queue_runs_and_retries(context):
+    # Keep the app's workers from picking up these jobs first
+    job_queue.stop()
+    calls = []
+
+    @job_handler("flaky")
+    def flaky(payload):
+        calls.append(payload["n"])
+        if len(calls) == 1:
+            raise RuntimeError("first attempt fails")
+
+    try:
+        job = enqueue("flaky", {"n": 7})
+        db.session.commit()
+
+        queue = JobQueue()
+        assert queue.run_pending() == 2
+        job = Job.query.get(job.id)
+        assert job.status == "done"
+        assert job.attempts == 2
+        assert calls == [7, 7]
+
+        # While the model is down, the job waits without using up its attempts
+        @job_handler("needs_model")
+        def needs_model(payload):
+            calls.append(payload["n"])
+            if len(calls) < 6:
+                raise ModelUnavailable("The model server is down")
+
+        job = enqueue("needs_model", {"n": 8})
+        db.session.commit()
+        for _ in range(3):
+            assert queue.run_pending() == 1
+            job = Job.query.get(job.id)
+            assert (job.status, job.attempts) == ("pending", 0)
+            assert job.run_after > datetime.utcnow()
+            job.run_after = None
+            db.session.commit()
+
+        assert queue.run_pending() == 1
+        assert Job.query.get(job.id).status == "done"
+        assert calls == [7, 7, 8, 8, 8, 8]
+    finally:
+        del HANDLERS["flaky"]
+        HANDLERS.pop("needs_model", None)
+        job_queue.start(context.app)
+
+
+def test_upload_returns_before_thumbnail(manager, client, stub_model):
+    with open("test_data/author4.png", "rb") as image_fp:
+        res = client.post("/eval/new", data={"name": "Queued", "attachment": image_fp})
+
+    assert res.status_code == 200
+    with manager.app.app_context():
+        image_id = SampleEval.query.filter_by(name="Queued").one().image_id
+
+    # The worker threads write the files, and the view waits a little for them
+    res = client.get(f"/image/{image_id}/thumbnail")
+    assert res.status_code == 200
+    assert res.mimetype.startswith("image/")
+    with manager.app.app_context():
+        assert SampleEval.query.filter_by(name="Queued").one().image.ready
+
+
+def test_image_store_shares_files(manager, client, stub_model):
+    # An image no other test uploads, so this test holds the only references
+    upload = io.BytesIO()
+    Image.new("L", (64, 32), color=77).save(upload, format="PNG")
+    data = upload.getvalue()
+    digest = image_digest(io.BytesIO(data))
+
+    for name in ("Twice A", "Twice B"):
+        res = client.post(
+            "/eval/new",
+            data={"name": name, "attachment": (io.BytesIO(data), "scan.png")},
+        )
+        assert res.status_code == 200
+
+    image_path, thumbnail_path = image_store.paths(digest)
+    with manager.app.app_context():
+        assert StoredImage.query.get(digest).refcount == 2
+        first = SampleEval.query.filter_by(name="Twice A").one()
+        second = SampleEval.query.filter_by(name="Twice B").one()
+        assert first.image.image_path == second.image.image_path == image_path
+        first_id, second_id = first.id, second.id
+
+    # The original bytes are kept as they were uploaded
+    with open(image_path, "rb") as stored_fp:
+        assert stored_fp.read() == data
+
+    # Nothing is removed until the release is committed
+    with manager.app.app_context():
+        image_store.release(digest)
+        image_store.release(digest)
+        db.session.rollback()
+        db.session.commit()
+        assert StoredImage.query.get(digest).refcount == 2
+    assert os.path.exists(image_path) and os.path.exists(thumbnail_path)
+
+    client.get(f"/eval/del/{first_id}")
+    assert os.path.exists(image_path) and os.path.exists(thumbnail_path)
+    client.get(f"/eval/del/{second_id}")
+    assert not os.path.exists(image_path) and not os.path.exists(thumbnail_path)
+    with manager.app.app_context():
+        assert StoredImage.query.get(digest) is None
+
+
+def test_migrate_images(manager):
+    with manager.app.app_context():
+        user = User.query.first()
+        legacy_dir = os.path.join(settings["datadir"], str(user.id))
+        os.makedirs(legacy_dir, exist_ok=True)
+        legacy_path = os.path.join(legacy_dir, "legacy.png")
+        shutil.copy("test_data/author1.png", legacy_path)
+
+        # Two images sharing the same files, as the old layout did for repeat uploads
+        images = [UserImage(user, stored=(legacy_path, legacy_path)) for _ in range(2)]
+        db.session.add_all(images)
+        db.session.commit()
+        image_ids = [image.id for image in images]
+
+        assert migrate_images(db, batch_size=1) == 2
+        migrated = [UserImage.query.get(image_id) for image_id in image_ids]
+        digest = migrated[0].digest
+        assert migrated[1].digest == digest
+        assert migrated[0].image_path == image_store.paths(digest)[0]
+        assert StoredImage.query.get(digest).refcount == 2
+        assert os.path.exists(image_store.paths(digest)[1])
+        assert not os.path.exists(legacy_path)
+
+        for image in migrated:
+            image_store.release(image.digest)
+            db.session.delete(image)
+        db.session.commit()
+
+
+def test_thumbnail_sizes(tmp_path):
+    store = ImageStore(
+        str(tmp_path),
+        thumbnails={
+            "list": ThumbnailSpec("list", 64, "JPEG", 80),
+            "preview": ThumbnailSpec("preview", 256, "PNG", 80),
+        },
+    )
+    scan = io.BytesIO()
+    Image.new("RGB", (1200, 900), color=(200, 200, 190)).save(scan, format="JPEG")
+    digest = store.write(scan)
+
+    assert store.exists(digest)
+    with Image.open(store.thumbnail_path(digest, "list")) as thumbnail:
+        assert thumbnail.format == "JPEG"
+        assert thumbnail.size == (64, 48)
+
+    with Image.open(store.thumbnail_path(digest, "preview")) as thumbnail:
+        assert thumbnail.format == "PNG"
+        assert thumbnail.size == (256, 192)
+
+    # Sizes missing from disk are made on demand from the stored original
+    os.remove(store.thumbnail_path(digest, "preview"))
+    assert store.ensure_thumbnail(digest, "preview") == store.thumbnail_path(
+        digest, "preview"
+    )
+    assert store.exists(digest)
+
+
+def test_image_caching_headers(manager, client, stub_model):
+    upload = io.BytesIO()
+    Image.new("RGB", (300, 200), color=(10, 120, 30)).save(upload, format="JPEG")
+    data = upload.getvalue()
+    res = client.post(
+        "/eval/new",
+        data={"name": "Cached", "attachment": (io.BytesIO(data), "scan.jpg")},
+    )
+    assert res.status_code == 200
+
+    with manager.app.app_context():
+        image = SampleEval.query.filter_by(name="Cached").one().image
+        image_id, digest = image.id, image.digest
+
+    res = client.get(f"/image/{image_id}")
+    assert res.status_code == 200
+    assert res.mimetype == "image/jpeg"
+    assert res.data == data
+    assert res.headers["ETag"] == f'"{digest}"'
+    assert "immutable" in res.headers["Cache-Control"]
+    assert "private" in res.headers["Cache-Control"]
+
+    res = client.get(f"/image/{image_id}", headers={"If-None-Match": f'"{digest}"'})
+    assert res.status_code == 304
+
+    res = client.get(f"/image/{image_id}", headers={"Range": "bytes=0-9"})
+    assert res.status_code == 206
+    assert res.data == data[:10]
+
+    res = client.get(f"/image/{image_id}/thumbnail/list")
+    assert res.status_code == 200
+    etag = res.headers["ETag"]
+    res = client.get(
+        f"/image/{image_id}/thumbnail/list", headers={"If-None-Match": etag}
+    )
+    assert res.status_code == 304
+
+
+def test_page_samples_keyset(manager):
+    with manager.app.app_context():
+        user = User(email="pager@email.com", name="Pager", pw_hash="x")
+        db.session.add(user)
+        db.session.commit()
+
+        # Inserted in one statement batch, so many share a timestamp and only the
+        # id can break the tie
+        for i in range(7):
+            image = UserImage(user, stored=("", ""))
+            db.session.add(SampleEval(image, name=f"Page {i}", fingerprint=[0.0, i]))
+        db.session.commit()
+
+        seen = []
+        cursor = None
+        while True:
+            samples, cursor = page_samples(user, cursor, page_size=3)
+            seen += [sample.name for sample in samples]
+            if cursor is None:
+                break
+
+        assert seen == [f"Page {i}" for i in reversed(range(7))]
+
+        db.session.delete(user)
+        db.session.commit()
+
+
+def test_query_results_pages(manager, client, monkeypatch, stub_model):
+    monkeypatch.setitem(pagination.DEFAULT_CONFIG, "query_page_size", 2)
+    with open("test_data/author1.png", "rb") as image_fp:
+        res = client.post("/eval/query", data={"attachment": image_fp})
+
+    assert res.status_code == 200
+    page = res.get_data(as_text=True)
+    assert page.count('<li class="list-item content-container">') == 2
+    calls = stub_model.stats["calls"]
+
+    # The next page comes from the saved ranking, without calling the model
+    next_url = html.unescape(page.split('<a href="/eval/query/')[1].split('"')[0])
+    res = client.get(f"/eval/query/{next_url}")
+    assert res.status_code == 200
+    assert 'start="3"' in res.get_data(as_text=True)
+    assert stub_model.stats["calls"] == calls
+
+    res = client.get("/eval/query/not-a-token")
+    assert res.status_code == 302
+
+
+def test_query_budget(manager, client):
+    # The labelled list costs the same number of statements however long it is,
+    # and the logged-in user comes from the session rather than the database
+    res = client.get("/eval/new")
+    assert res.status_code == 200
+    assert int(res.headers[HEADER]) <= 2
+
+    with manager.app.test_request_context():
+        g.sql_statements = 5
+        g.query_budget = 4
+        g.query_budget_view = "some_view"
+        with pytest.raises(QueryBudgetExceeded):
+            _check_budget(Response())
+
+
+def test_identity_cache(manager, client):
+    with client.session_transaction() as session:
+        identity = session[SESSION_KEY]
+        user_id = int(session["_user_id"])
+
+    assert identity["id"] == user_id
+    res = client.get("/eval/new")
+    assert res.status_code == 200
+
+    # A stale identity is reloaded from the database and cached again
+    with client.session_transaction() as session:
+        session[SESSION_KEY] = {**identity, "at": 0}
+
+    res = client.get("/eval/new")
+    assert res.status_code == 200
+    with client.session_transaction() as session:
+        assert session[SESSION_KEY]["at"] > 0
+
+
+def test_metrics_endpoint(manager, client, stub_model):
+    if "metrics" not in manager.app.view_functions:
+        install_metrics(manager.app, {"enabled": True, "path": "/metrics"})
+
+    with open("test_data/author3.png", "rb") as image_fp:
+        res = client.post("/eval/query", data={"attachment": image_fp})
+    assert res.status_code == 200
+
+    res = client.get("/metrics")
+    assert res.status_code == 200
+    assert res.content_type.startswith("text/plain")
+    text = res.get_data(as_text=True)
+    assert "# TYPE authorid_stage_duration_seconds histogram" in text
+    assert 'authorid_stage_duration_seconds_count{stage="ranking"}' in text
+    assert 'authorid_stage_duration_seconds_count{stage="render"}' in text
+    assert 'authorid_cache_lookups_total{cache="fingerprint",result=' in text
+    assert (
+        'authorid_requests_total{endpoint="evalviews.query_model",method="POST",status="200"}'
+        in text
+    )
+
+
+def test_fingerprint_backends():
+    data = b"not really an image" * 100
+    expected = stub_fingerprint(data, 16)
+
+    stub = backend_from_settings(
+        {"fingerprint_backend": {"kind": "stub", "stub_dim": 16}}
+    )
+    assert isinstance(stub, StubBackend)
+    assert stub.fingerprint(io.BytesIO(data)) == pytest.approx(expected)
+
+    backend = ProcessBackend("app.stubserver:stub_fingerprint", workers=1)
+    try:
+        assert backend.fingerprint(io.BytesIO(data)) == pytest.approx(
+            stub_fingerprint(data)
+        )
+        assert backend.fingerprint(io.BytesIO(b"")) == pytest.approx(
+            stub_fingerprint(b"")
+        )
+    finally:
+        backend.close()
+
+    with pytest.raises(ModelServerError):
+        ProcessBackend("app.stubserver:stub_fingerprint", expected_dim=16).fingerprint(
+            io.BytesIO(data)
+        )
+
+    # A new worker takes far longer than this to start
+    backend = ProcessBackend(
+        "app.stubserver:stub_fingerprint", workers=1, timeout=0.001
+    )
+    try:
+        with pytest.raises(ModelServerError, match="didn't answer"):
+            backend.fingerprint(io.BytesIO(data))
+    finally:
+        backend.close()
+
+    with pytest.raises(ValueError):
+        backend_from_settings({"fingerprint_backend": {"kind": "carrier pigeon"}})
+
+    # The process backend has no default model
+    with pytest.raises(ValueError, match="model"):
+        backend_from_settings({"fingerprint_backend": {"kind": "process"}})
+
+
+def test_model_supervisor_restarts(client):
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        port = sock.getsockname()[1]
+
+    url = f"http://localhost:{port}/"
+    command = [sys.executable, "-m", "app.stubserver", "--port", str(port)]
+    probe_client = ModelClient(url, connect_timeout=1, read_timeout=1, retries=0)
+    supervisor = ModelSupervisor(
+        command,
+        make_probe(probe_client, warmup_image()),
+        startup_deadline=30,
+        probe_interval=0.1,
+        check_interval=0.1,
+        backoff=0.1,
+    )
+    backend = HTTPBackend(ModelClient(url), supervisor=supervisor)
+    try:
+        assert supervisor.start()
+        assert supervisor.status()["state"] == "ready"
+        assert len(backend.fingerprint(io.BytesIO(b"image"))) > 0
+
+        # Once the model dies, calls fail at once until it has been restarted
+        supervisor.process.kill()
+        deadline = time.monotonic() + 10
+        while supervisor.state == "ready" and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        with pytest.raises(ModelUnavailable):
+            backend.fingerprint(io.BytesIO(b"image"))
+
+        assert supervisor.ready.wait(30)
+        assert supervisor.status()["restarts"] == 1
+        assert len(backend.fingerprint(io.BytesIO(b"image"))) > 0
+    finally:
+        supervisor.stop()
+
+    assert supervisor.status()["state"] == "stopped"
+    assert supervisor.process.poll() is not None
+
+    # Not supervising any more, so the app doesn't depend on it
+    supervisor.check()
+    res = client.get("/health")
+    assert res.json["ready"] == (res.status_code == 200)
+
+
+def test_model_supervisor_process():
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        port = sock.getsockname()[1]
+
+    url = f"http://localhost:{port}/"
+    command = [sys.executable, "-m", "app.stubserver", "--port", str(port)]
+    probe_client = ModelClient(url, connect_timeout=1, read_timeout=1, retries=0)
+    supervisor = ModelSupervisor(
+        command,
+        make_probe(probe_client, warmup_image()),
+        startup_deadline=30,
+        probe_interval=0.1,
+    )
+    pid = supervisor.start_process()
+    try:
+        # The state is shared, but the supervisor thread runs in the child only
+        assert supervisor.wait_until_ready()
+        assert supervisor.thread is None
+        backend = HTTPBackend(ModelClient(url), supervisor=supervisor)
+        assert len(backend.fingerprint(io.BytesIO(b"image"))) > 0
+    finally:
+        stop_supervisor(pid)
+
+    assert supervisor.state == "stopped"
+
+
+def test_master_reaps_workers_only():
+    def fork(seconds: float) -> int:
+        pid = os.fork()
+        if pid == 0:
+            time.sleep(seconds)
+            os._exit(0)
+
+        return pid
+
+    # A worker that exits at once, and a supervisor that is still running
+    worker, supervisor_pid = fork(0), fork(30)
+    restarted = fork(30)
+    supervisor = SimpleNamespace(start_process=lambda: restarted)
+    master = Master(None, None, {}, supervisor, supervisor_pid)
+    master.workers[worker] = time.monotonic()
+    try:
+        deadline = time.monotonic() + 10
+        while master.workers:
+            assert time.monotonic() < deadline
+            master.reap()
+            time.sleep(0.01)
+
+        master.check_supervisor()
+        assert master.supervisor_pid == supervisor_pid
+
+        # Once the supervisor exits, the master starts another
+        os.kill(supervisor_pid, signal.SIGKILL)
+        os.waitpid(supervisor_pid, 0)
+        master.check_supervisor()
+        assert master.supervisor_pid == restarted
+    finally:
+        for pid in (supervisor_pid, restarted):
+            stop_supervisor(pid)
+
+
+def test_pool_server_recycles_and_drains():
+    app = Flask(__name__)
+    started = threading.Event()
+
+    @app.route("/slow")
+    def slow():
+        started.set()
+        time.sleep(0.5)
+        return "done"
+
+    @app.route("/")
+    def fast():
+        return "ok"
+
+    sock = listen("127.0.0.1", 0, 16)
+    url = f"http://127.0.0.1:{sock.getsockname()[1]}"
+    try:
+        # Stops accepting after max_requests
+        server = PoolWSGIServer(app, sock.fileno(), threads=4, max_requests=3)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        with ThreadPoolExecutor(3) as pool:
+            results = list(pool.map(lambda _: requests.get(url, timeout=5), range(3)))
+
+        assert [res.text for res in results] == ["ok"] * 3
+        thread.join(5)
+        assert not thread.is_alive()
+
+        # Requests in flight when it is drained are finished
+        server = PoolWSGIServer(app, sock.fileno(), threads=4)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        with ThreadPoolExecutor(1) as pool:
+            future = pool.submit(requests.get, f"{url}/slow", timeout=5)
+            assert started.wait(5)
+            server.drain()
+            assert future.result().text == "done"
+
+        thread.join(5)
+        assert not thread.is_alive()
+    finally:
+        sock.close()
+
+
+def test_upgrade_schema(tmp_path):
+    # A database from before the added columns, indexes and versioning
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with engine.begin() as conn:
+        conn.execute(text('CREATE TABLE "user" (id INTEGER PRIMARY KEY)'))
+        conn.execute(
+            text("CREATE TABLE image (id INTEGER PRIMARY KEY, user_id INTEGER)")
+        )
+        conn.execute(
+            text(
+                "CREATE TABLE sample (id INTEGER PRIMARY KEY, user_id INTEGER, "
+                "image_id INTEGER, timestamp DATETIME, name TEXT, fingerprint TEXT)"
+            )
+        )
+        conn.execute(
+            text(
+                "INSERT INTO sample (user_id, name, fingerprint) "
+                "VALUES (1, 'Ada', '[1, 2]'), (1, 'Ada', '[3, 4]'), (1, 'Ada', '[5, 6]')"
+            )
+        )
+
+    db = SimpleNamespace(engine=engine)
+    assert upgrade_schema(db) == len(MIGRATIONS)
+    assert upgrade_schema(db) == len(MIGRATIONS)
+
+    inspector = inspect(engine)
+    columns = {column["name"] for column in inspector.get_columns("sample")}
+    assert {"fingerprint_blob", "fingerprint_dim", "fingerprint_dtype"} <= columns
+    indexes = {index["name"] for index in inspector.get_indexes("sample")}
+    assert {"ix_sample_user_timestamp", "ix_sample_user_id"} <= indexes
+    assert "ix_image_user_id" in {i["name"] for i in inspector.get_indexes("image")}
+
+    with engine.connect() as conn:
+        assert conn.execute(text("PRAGMA user_version")).scalar() == len(MIGRATIONS)
+        assert conn.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        plan = conn.execute(
+            text(
+                "EXPLAIN QUERY PLAN SELECT id FROM sample WHERE user_id = 1 "
+                "ORDER BY timestamp DESC, id DESC LIMIT 50"
+            )
+        ).fetchall()
+        assert "ix_sample_user_timestamp" in str(plan)
+        assert "TEMP B-TREE" not in str(plan)
+
+        # Authors are summarized from the samples that were already there
+        (count, blob, sum_sq) = conn.execute(
+            text("SELECT count, centroid_blob, sum_sq FROM author_summary")
+        ).one()
+        assert count == 3
+        assert np.frombuffer(blob, dtype="<f8").tolist() == [3.0, 4.0]
+        assert sum_sq == 16.0
+
+        # Existing fingerprints are taken to be from the configured model
+        versions = conn.execute(text("SELECT DISTINCT model_version FROM sample"))
+        assert [version for (version,) in versions] == [get_model_version()]
+
+    engine.dispose()
+
+
+def test_json_api(manager, client, stub_model):
+    assert client.post("/api/v1/query").status_code == 400
+    assert manager.app.test_client().get("/api/v1/samples").status_code == 401
+
+    # Without the header, as a cross-site form post would be
+    res = client.post("/api/v1/samples", headers={"X-Requested-With": ""})
+    assert res.status_code == 403
+
+    created = []
+    for (name, path) in (("Ada", "author1.png"), ("Grace", "author3.png")):
+        with open(f"test_data/{path}", "rb") as image_fp:
+            res = client.post(
+                "/api/v1/samples",
+                data={"name": name, "attachment": (image_fp, path)},
+            )
+
+        assert res.status_code == 201
+        created.append(res.get_json())
+
+    with open("test_data/author1.png", "rb") as image_fp:
+        res = client.post(
+            "/api/v1/query?k=2&authors=1",
+            data={"attachment": (image_fp, "query.png")},
+        )
+
+    assert res.status_code == 200
+    assert b", " not in res.data and b": " not in res.data
+    data = res.get_json()
+    assert data["k"] == 2
+    assert len(data["candidates"]) == 2
+    best = data["candidates"][0]
+    assert (best["id"], best["name"], best["distance"]) == (created[0]["id"], "Ada", 0)
+    assert data["candidates"][1]["distance"] >= best["distance"]
+    assert data["authors"][0] == {
+        "name": "Ada",
+        "distance": 0,
+        "mean_distance": 0,
+        "samples": 1,
+    }
+
+    res = client.get("/api/v1/samples?limit=1")
+    assert res.get_json()["samples"][0]["id"] == created[1]["id"]
+    after = res.get_json()["next"]
+    res = client.get(f"/api/v1/samples?limit=1&after={after}")
+    assert res.get_json()["samples"][0]["id"] == created[0]["id"]
+
+    for sample in created:
+        res = client.delete(f"/api/v1/samples/{sample['id']}")
+        assert res.status_code == 204
+        assert client.get(f"/api/v1/samples/{sample['id']}").status_code == 404
+
+    res = client.post("/api/v1/query?k=0")
+    assert res.status_code == 400
+
+
+@real_model
+def test_real_model_identifies_authors(manager, client):
+    if model_supervisor.state != "ready":
+        pytest.skip("The model server didn't start")
+
+    created = []
+    for path in ("author1.png", "author3.png", "author4.png", "author5a.png"):
+        with open(f"test_data/{path}", "rb") as image_fp:
+            res = client.post(
+                "/api/v1/samples",
+                data={"name": f"Real {path[:7]}", "attachment": (image_fp, path)},
+            )
+
+        assert res.status_code == 201
+        created.append(res.get_json()["id"])
+
+    # Another page by the fifth author is closest to their first one
+    with open("test_data/author5b.png", "rb") as image_fp:
+        res = client.post(
+            "/api/v1/query?k=10&authors=1",
+            data={"attachment": (image_fp, "query.png")},
+        )
+
+    assert res.status_code == 200
+    assert res.get_json()["authors"][0]["name"] == "Real author5"
+
+    for sample_id in created:
+        assert client.delete(f"/api/v1/samples/{sample_id}").status_code == 204
+
+
+def test_batch_query(manager, client, stub_model):
+    # Small as a file, but with more pixels than max_pixels allows
+    huge = io.BytesIO()
+    Image.new("1", (8000, 8000)).save(huge, format="PNG")
+    huge.seek(0)
+
+    with open("test_data/author1.png", "rb") as image_fp:
+        res = client.post(
+            "/api/v1/samples",
+            data={"name": "Ada", "attachment": (image_fp, "ada.png")},
+        )
+        sample_id = res.get_json()["id"]
+
+    # The job queue isn't started in the tests, so the job runs before the
+    # redirect to the batch's page
+    with open("test_data/author1.png", "rb") as one, open(
+        "test_data/author3.png", "rb"
+    ) as two:
+        res = client.post(
+            "/eval/batch",
+            data={
+                "k": 1,
+                "attachments": [
+                    (one, "one.png"),
+                    (two, "two.png"),
+                    (io.BytesIO(b"not an image"), "notes.txt"),
+                    (huge, "huge.png"),
+                ],
+            },
+        )
+
+    assert res.status_code == 302
+    batch_url = res.headers["Location"]
+    batch_id = int(batch_url.rstrip("/").rsplit("/", 1)[1])
+
+    # Through the API, for any number of images
+    for count in (1, 5):
+        with open("test_data/author1.png", "rb") as image_fp:
+            data = image_fp.read()
+
+        res = client.post(
+            "/api/v1/batch?k=1",
+            data={
+                "attachments": [(io.BytesIO(data), f"{i}.png") for i in range(count)]
+            },
+        )
+        assert res.status_code == 202
+        url = res.get_json()["url"]
+        deadline = time.monotonic() + 10
+        while client.get(url).get_json()["status"] != "done":
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+
+    res = client.get(f"/api/v1/batch/{batch_id}")
+    progress = res.get_json()
+    assert progress["status"] == "done"
+    assert (progress["processed"], progress["total"]) == (4, 4)
+
+    res = client.get(progress["results"]["csv"])
+    assert res.status_code == 200
+    rows = list(csv.DictReader(io.StringIO(res.get_data(as_text=True))))
+    filenames = [row["filename"] for row in rows]
+    assert filenames == ["one.png", "two.png", "notes.txt", "huge.png"]
+    assert rows[0]["sample_id"] == str(sample_id)
+    assert float(rows[0]["distance"]) == 0
+    assert rows[2]["error"]
+    assert "pixels" in rows[3]["error"]
+
+    res = client.get(progress["results"]["json"])
+    results = res.get_json()["results"]
+    assert results[0]["candidates"][0]["name"] == "Ada"
+    assert len(results[1]["candidates"]) == 1
+
+    assert client.get(batch_url).status_code == 200
+    with manager.app.app_context():
+        batch = BatchQuery.query.get(batch_id)
+        assert all(item.spool_path is None for item in batch.items)
+
+    client.get(f"/eval/del/{sample_id}")
+
+
+def test_author_summaries_and_ranking(manager, client, monkeypatch, stub_model):
+    def scan(shade: int) -> io.BytesIO:
+        out = io.BytesIO()
+        Image.new("L", (32, 32), shade).save(out, format="PNG")
+        out.seek(0)
+        return out
+
+    monkeypatch.setitem(authors.DEFAULT_CONFIG, "enabled", True)
+    monkeypatch.setitem(authors.DEFAULT_CONFIG, "min_gallery_size", 1)
+    monkeypatch.setitem(authors.DEFAULT_CONFIG, "candidates", 1)
+    ids = {}
+    for (i, name) in enumerate(["Ada", "Ada", "Ada", "Grace", "Grace"]):
+        res = client.post(
+            "/api/v1/samples",
+            data={"name": name, "attachment": (scan(10 + 40 * i), f"{i}.png")},
+        )
+        assert res.status_code == 201
+        ids.setdefault(name, []).append(res.get_json()["id"])
+
+    res = client.delete(f"/api/v1/samples/{ids['Ada'].pop()}")
+    assert res.status_code == 204
+
+    # The running summaries match ones computed from the remaining samples
+    with manager.app.app_context():
+        for (name, sample_ids) in ids.items():
+            samples = SampleEval.query.filter(SampleEval.id.in_(sample_ids)).all()
+            summary = AuthorSummary.query.filter_by(name=name).one()
+            count, centroid, sum_sq = summarize(
+                np.stack([sample.fingerprint for sample in samples])
+            )
+            assert summary.count == count == 2
+            assert np.allclose(summary.centroid, centroid)
+            assert np.isclose(summary.sum_sq, sum_sq)
+
+    # Only the samples of the closest author are ranked
+    res = client.post("/api/v1/query?k=2", data={"attachment": (scan(10), "query.png")})
+    candidates = res.get_json()["candidates"]
+    assert [c["id"] for c in candidates][0] == ids["Ada"][0]
+    assert {c["name"] for c in candidates} == {"Ada"}
+
+    # Unless they have fewer samples than were asked for, when the next closest
+    # author's are ranked too
+    res = client.post("/api/v1/query?k=4", data={"attachment": (scan(10), "query.png")})
+    candidates = res.get_json()["candidates"]
+    assert [c["id"] for c in candidates][0] == ids["Ada"][0]
+    assert len(candidates) == 4
+
+    for sample_ids in ids.values():
+        for sample_id in sample_ids:
+            client.delete(f"/api/v1/samples/{sample_id}")
+
+    with manager.app.app_context():
+        assert AuthorSummary.query.filter(AuthorSummary.name.in_(ids)).count() == 0
+
+
+def test_author_ranking_at_query_page_k(monkeypatch):
+    # The number of results the query page asks for by default
+    k = pagination.get_pagination_config()["query_max_results"]
+
+    # 100 authors with 30 samples each, so 20 authors can't fill k on their own
+    rng = np.random.default_rng(0)
+    centres = rng.normal(size=(100, 8))
+    labels = np.repeat(np.arange(100), 30)
+    matrix = centres[labels] + 0.1 * rng.normal(size=(len(labels), 8))
+    engine = RankingEngine.from_arrays(np.arange(len(labels)), matrix)
+    query = centres[7]
+    best = engine.top_k(query, 1)[0][0]
+
+    summaries = []
+    for (i, centre) in enumerate(centres):
+        summary = AuthorSummary(name=str(i), count=30, sum_sq=0.0)
+        summary.centroid = centre
+        summaries.append(summary)
+
+    gallery = authors.AuthorGallery.from_summaries(summaries, engine.metric)
+    monkeypatch.setattr(authors.author_ranking, "get_authors", lambda *_: gallery)
+    monkeypatch.setattr(
+        authors,
+        "sample_ids_for",
+        lambda _, names: np.flatnonzero(np.isin(labels, [int(n) for n in names])),
+    )
+
+    # The closest authors are widened until they cover k, rather than falling back
+    # to the exact scan
+    def exact_scan(*_):
+        raise AssertionError("The whole gallery was scanned")
+
+    monkeypatch.setattr(engine, "top_k", exact_scan)
+    ranked = authors.author_ranking.top_k(1, 0, engine, query, k)
+    assert len(ranked) == k and ranked[0][0] == best
+    assert len(gallery.closest(query, 20, k)) == -(-k // 30)
+
+
+def test_upload_spooling(manager, client, monkeypatch, tmp_path, stub_model):
+    # Hashed as it is written, and removed once it goes over the limit
+    spool = uploads.SpoolFile(str(tmp_path), max_bytes=10)
+    spool.write(b"scan ")
+    spool.write(b"data")
+    assert spool.digest == hashlib.sha1(b"scan data").hexdigest()
+    with pytest.raises(RequestEntityTooLarge):
+        spool.write(b"too much")
+    assert not os.path.exists(spool.path)
+
+    upload = io.BytesIO()
+    Image.new("L", (48, 40), color=91).save(upload, format="PNG")
+    data = upload.getvalue()
+    digest = hashlib.sha1(data).hexdigest()
+
+    def post(path: str = "/api/v1/samples"):
+        return client.post(
+            path, data={"name": "Spooled", "attachment": (io.BytesIO(data), "a.png")}
+        )
+
+    def spooled_files() -> set:
+        return {name for name in os.listdir(TEMP_PATH) if name.endswith(".upload")}
+
+    os.makedirs(TEMP_PATH, exist_ok=True)
+    before = spooled_files()
+
+    # The limits only apply inside this block
+    with monkeypatch.context() as limited:
+        limits = {**uploads.DEFAULT_CONFIG, "max_pixels": 48 * 40 - 1}
+        limited.setattr(uploads, "DEFAULT_CONFIG", limits)
+        res = post()
+        assert res.status_code == 413 and "pixels" in res.get_json()["error"]
+        assert post("/api/v1/query").status_code == 413
+
+        limits = {**uploads.DEFAULT_CONFIG, "max_image_bytes": len(data) - 1}
+        limited.setattr(uploads, "DEFAULT_CONFIG", limits)
+        assert post().status_code == 413
+
+        # The limit goes by the form field, not by what the client called the file
+        res = client.post(
+            "/api/v1/samples",
+            data={"name": "Spooled", "attachment": (io.BytesIO(data), "a.zip")},
+        )
+        assert res.status_code == 413
+        res = client.post(
+            "/api/v1/batch", data={"archive": (io.BytesIO(data), "a.png")}
+        )
+        assert res.status_code == 400 and "zip" in res.get_json()["error"]
+
+        limited.setitem(manager.app.config, "MAX_CONTENT_LENGTH", len(data))
+        assert post().status_code == 413
+
+    res = post()
+    assert res.status_code == 201
+    sample_id = res.get_json()["id"]
+
+    # The spooled upload became the stored original, and nothing was left behind.
+    # The original is stored by a background job.
+    deadline = time.monotonic() + 10
+    while not os.path.exists(image_store.object_path(digest)):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+    with open(image_store.object_path(digest), "rb") as stored_fp:
+        assert stored_fp.read() == data
+    assert spooled_files() == before
+
+    assert client.delete(f"/api/v1/samples/{sample_id}").status_code == 204
+
+
+def test_backfill_model_versions(manager, monkeypatch, stub_model):
+    def scan(shade: int) -> io.BytesIO:
+        upload = io.BytesIO()
+        Image.new("L", (40, 56), color=shade).save(upload, format="PNG")
+        upload.seek(0)
+        return upload
+
+    class Interrupted(StubBackend):
+        calls = 0
+
+        def fingerprint(self, image_fp):
+            Interrupted.calls += 1
+            if Interrupted.calls > 1:
+                raise ModelUnavailable("The model server is down")
+
+            return super().fingerprint(image_fp)
+
+    # A user of their own, so their whole gallery is known
+    other = api_client(manager)
+    other.post(
+        "/users/new",
+        data={
+            "email": "backfill@example.com",
+            "name": "Backfill",
+            "password": "abc",
+            "passconf": "abc",
+        },
+    )
+
+    old_version = get_model_version()
+    ids = []
+    for shade in (31, 32):
+        res = other.post(
+            "/api/v1/samples",
+            data={"name": "Backfilled", "attachment": (scan(shade), "a.png")},
+        )
+        ids.append(res.get_json()["id"])
+
+    # One sample's image goes missing, which would keep the user on the old model
+    res = other.post(
+        "/api/v1/samples",
+        data={"name": "Backfilled", "attachment": (scan(33), "a.png")},
+    )
+    lost = res.get_json()["id"]
+    with manager.app.app_context():
+        user_id = SampleEval.query.get(ids[0]).user_id
+        # The image is written by a background job
+        deadline = time.monotonic() + 10
+        while not os.path.exists(SampleEval.query.get(lost).image.image_path):
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+            db.session.remove()
+
+        os.remove(SampleEval.query.get(lost).image.image_path)
+
+    # A new model is deployed, and the old one kept running for the backfill
+    monkeypatch.setattr(evaluation, "fingerprint_backend", StubBackend(dim=16))
+    monkeypatch.setattr(backfill, "_previous_backends", {})
+    monkeypatch.setitem(settings, "model_version", "next")
+    monkeypatch.setitem(
+        settings,
+        "backfill",
+        {"previous_model_version": old_version, "previous_model_url": stub_model.url},
+    )
+
+    # Not backfilled yet, so queries still go to the old model, here through an
+    # IVF index of the old fingerprints
+    monkeypatch.setitem(settings, "ann", {"enabled": True, "min_gallery_size": 1})
+    with manager.app.app_context():
+        ann_manager._build(user_id, load_engine(user_id), old_version)
+        assert os.path.exists(ann_manager.index_path(user_id))
+
+    res = other.post("/api/v1/query?k=1", data={"attachment": (scan(31), "q.png")})
+    best = res.get_json()["candidates"][0]
+    assert (best["id"], best["distance"]) == (ids[0], 0)
+
+    with manager.app.app_context():
+        assert user_id in backfill.users_to_backfill("next")
+
+        # Interrupted after the first batch, which is kept
+        with pytest.raises(ModelUnavailable):
+            backfill.Backfill(Interrupted(dim=16), batch_size=1).run([user_id])
+        assert PendingFingerprint.query.filter_by(user_id=user_id).count() == 1
+        assert User.query.get(user_id).model_version == old_version
+
+        # Resumed from there, but held back by the missing image until it is dropped
+        (report,) = backfill.Backfill(StubBackend(dim=16), batch_size=1).run([user_id])
+        assert (report["computed"], report["failed"], report["swapped"]) == (
+            1,
+            0,
+            False,
+        )
+        assert report["missing"] == [lost]
+        assert User.query.get(user_id).model_version == old_version
+
+        (report,) = backfill.Backfill(
+            StubBackend(dim=16), batch_size=1, drop_missing=True
+        ).run([user_id])
+        assert (report["missing"], report["swapped"]) == ([lost], True)
+        assert SampleEval.query.get(lost) is None
+        assert PendingFingerprint.query.filter_by(user_id=user_id).count() == 0
+        assert User.query.get(user_id).model_version == "next"
+        assert user_id not in ann_manager.indexes
+        assert not os.path.exists(ann_manager.index_path(user_id))
+        for sample_id in ids:
+            sample = SampleEval.query.get(sample_id)
+            assert sample.model_version == "next" and len(sample.fingerprint) == 16
+
+        summary = AuthorSummary.query.get((user_id, "Backfilled"))
+        assert (summary.count, summary.dim) == (2, 16)
+        db.session.remove()
+
+    # Now on the new model
+    res = other.post("/api/v1/query?k=1", data={"attachment": (scan(32), "q.png")})
+    best = res.get_json()["candidates"][0]
+    assert (best["id"], best["distance"]) == (ids[1], 0)
+
+    for sample_id in ids:
+        assert other.delete(f"/api/v1/samples/{sample_id}").status_code == 204
+
+
+def test_sample_added_during_swap(manager, monkeypatch):
+    other = api_client(manager)
+    other.post(
+        "/users/new",
+        data={
+            "email": "swap@example.com",
+            "name": "Swap",
+            "password": "abc",
+            "passconf": "abc",
+        },
+    )
+    with manager.app.app_context():
+        user = User.query.filter_by(email="swap@example.com").one()
+        user_id = user.id
+        user.model_version = "old"
+        db.session.commit()
+
+    monkeypatch.setattr(backfill, "_previous_backends", {"old": StubBackend(dim=8)})
+    monkeypatch.setitem(
+        settings,
+        "backfill",
+        {"previous_model_version": "old", "previous_model_url": "http://unused"},
+    )
+
+    # The backfill moves the user to the current model while their upload is being
+    # fingerprinted with the old one
+    versions = []
+    fingerprint_upload = evaluation.fingerprint_upload
+
+    def racing_upload(image_fp, model_version=None):
+        versions.append(model_version)
+        result = fingerprint_upload(image_fp, model_version)
+        if len(versions) == 1:
+            with db.engine.begin() as conn:
+                conn.execute(
+                    User.__table__.update()
+                    .where(User.id == user_id)
+                    .values(model_version=get_model_version())
+                )
+
+        return result
+
+    monkeypatch.setattr(evaluation, "fingerprint_upload", racing_upload)
+
+    # Fingerprinting twice takes more queries than the view's budget allows for
+    monkeypatch.setitem(manager.app.config, "QUERY_BUDGET_STRICT", False)
+    upload = io.BytesIO()
+    Image.new("L", (40, 56), color=77).save(upload, format="PNG")
+    upload.seek(0)
+    res = other.post(
+        "/api/v1/samples",
+        data={"name": "Swapped", "attachment": (upload, "a.png")},
+    )
+    assert res.status_code == 201
+    assert versions == ["old", get_model_version()]
+
+    # Fingerprinted again by the model the gallery moved to
+    with manager.app.app_context():
+        sample = db.session.get(SampleEval, res.get_json()["id"])
+        assert sample.model_version == get_model_version()
+        assert len(sample.fingerprint) != 8
+
+    assert other.delete(f"/api/v1/samples/{sample.id}").status_code == 204
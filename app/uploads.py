@@ -0,0 +1,218 @@
+"""
+    This module contains the ingestion stage for uploaded files. Werkzeug is given a
+    multipart parser that writes each uploaded file straight into the configured temp
+    directory, hashing it as it is written, so the request body is read exactly once.
+    The spooled file is then what the fingerprint backend reads, and, when the image
+    store doesn't have the image yet, it is renamed into place as the stored original
+    rather than copied. Requests larger than max_content_length and files larger
+    than max_image_bytes are refused with a 413 while they are being read; only the
+    zip archive fields are exempt from the second limit. Images whose header
+    declares more than max_pixels pixels are refused before anything decodes them.
+"""
+
+import hashlib
+import os
+from typing import BinaryIO, NamedTuple, Optional
+import uuid
+
+from flask import Flask, Request
+from PIL import Image, UnidentifiedImageError
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.formparser import FormDataParser, MultiPartParser, exhaust_stream
+from werkzeug.sansio.multipart import File
+
+from .main import settings
+from .models import TEMP_PATH, image_digest
+
+
+DEFAULT_CONFIG = {
+    "max_content_length": 256 * 1024 * 1024,
+    "max_image_bytes": 32 * 1024 * 1024,
+    "max_pixels": 50_000_000,
+}
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+# Form fields that take a zip archive. Their files are only bounded by the size of
+# the whole request; files in any other field are held to max_image_bytes.
+ARCHIVE_FIELDS = ("archive",)
+
+
+def get_upload_config() -> dict:
+    return {**DEFAULT_CONFIG, **settings.get("uploads", {})}
+
+
+class ImageTooLarge(ValueError):
+    pass
+
+
+class SpoolFile:
+    """
+    An uploaded file written to the temp directory, hashed as it is written. The
+    file is removed when it is closed, unless detach() has handed it on.
+    """
+
+    def __init__(self, directory: str, max_bytes: Optional[int] = None):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"{uuid.uuid4().hex}.upload")
+        self.fp = open(self.path, "w+b")
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.sha1 = hashlib.sha1()
+        self.owned = True
+
+    def write(self, data: bytes) -> int:
+        if self.fp.tell() != self.size:
+            raise ValueError("Spooled uploads can only be appended to")
+
+        self.size += len(data)
+        if self.max_bytes is not None and self.size > self.max_bytes:
+            # Nothing refers to a file that was never finished, so tidy it up here
+            self.close()
+            raise RequestEntityTooLarge(
+                f"Images can be at most {self.max_bytes // (1024 * 1024)} MB"
+            )
+
+        self.sha1.update(data)
+        return self.fp.write(data)
+
+    # SHA-1 of everything written, without reading the file back
+    @property
+    def digest(self) -> str:
+        return self.sha1.hexdigest()
+
+    # Hand the file on to whoever takes care of it next (e.g. a store_image job).
+    # It stays open for reading, but is no longer removed when closed.
+    def detach(self) -> str:
+        self.fp.flush()
+        self.owned = False
+        return self.path
+
+    def close(self) -> None:
+        if not self.fp.closed:
+            self.fp.close()
+
+        if self.owned and os.path.exists(self.path):
+            os.remove(self.path)
+            self.owned = False
+
+    def __getattr__(self, name: str):
+        if name == "fp":
+            # open() failed in __init__
+            raise AttributeError(name)
+
+        return getattr(self.fp, name)
+
+    def __iter__(self):
+        return iter(self.fp)
+
+
+class SpoolingMultiPartParser(MultiPartParser):
+    """
+    A multipart parser that spools each file to the temp directory, with the size
+    limit of the form field it was uploaded in. The filename is up to the client,
+    so it isn't trusted for this.
+    """
+
+    def start_file_streaming(
+        self, event: File, total_content_length: Optional[int]
+    ) -> SpoolFile:
+        max_bytes = None
+        if event.name not in ARCHIVE_FIELDS:
+            max_bytes = get_upload_config()["max_image_bytes"]
+
+        return SpoolFile(TEMP_PATH, max_bytes)
+
+
+class SpoolingFormDataParser(FormDataParser):
+    """
+    Parses multipart bodies with SpoolingMultiPartParser.
+    """
+
+    def get_parse_func(self, mimetype: str, options: dict):
+        if mimetype == "multipart/form-data":
+            return SpoolingFormDataParser._parse_spooled
+
+        return super().get_parse_func(mimetype, options)
+
+    # Same as FormDataParser._parse_multipart, but with our multipart parser
+    @exhaust_stream
+    def _parse_spooled(
+        self,
+        stream: BinaryIO,
+        mimetype: str,
+        content_length: Optional[int],
+        options: dict,
+    ):
+        parser = SpoolingMultiPartParser(
+            self.stream_factory,
+            self.charset,
+            self.errors,
+            max_form_memory_size=self.max_form_memory_size,
+            cls=self.cls,
+        )
+        boundary = options.get("boundary", "").encode("ascii")
+        if not boundary:
+            raise ValueError("Missing boundary")
+
+        form, files = parser.parse(stream, boundary, content_length)
+        return stream, form, files
+
+
+class SpoolingRequest(Request):
+    """
+    A request that spools file uploads to the temp directory (see SpoolFile).
+    """
+
+    form_data_parser_class = SpoolingFormDataParser
+
+
+def install_upload_limits(app: Flask, conf: Optional[dict] = None) -> None:
+    conf = conf or get_upload_config()
+    app.request_class = SpoolingRequest
+    app.config["MAX_CONTENT_LENGTH"] = conf["max_content_length"]
+
+
+# The spooled file behind an upload, if it has one
+def spooled(image_fp: BinaryIO) -> Optional[SpoolFile]:
+    if isinstance(image_fp, SpoolFile):
+        return image_fp
+
+    stream = getattr(image_fp, "stream", None)
+    return stream if isinstance(stream, SpoolFile) else None
+
+
+class UploadInfo(NamedTuple):
+    digest: str
+    mimetype: Optional[str]
+
+
+# Check an image's header against the pixel limit, without decoding it. Returns
+# its MIME type, or None if PIL doesn't recognise it (the model decides about
+# those). The file is rewound afterwards.
+def check_image(image_fp: BinaryIO, max_pixels: Optional[int] = None) -> Optional[str]:
+    max_pixels = max_pixels or get_upload_config()["max_pixels"]
+    image_fp.seek(0)
+    try:
+        with Image.open(image_fp) as image:
+            (width, height) = image.size
+            mimetype = image.get_format_mimetype()
+    except Image.DecompressionBombError:
+        raise ImageTooLarge(f"Images can have at most {max_pixels} pixels")
+    except UnidentifiedImageError:
+        return None
+    finally:
+        image_fp.seek(0)
+
+    if width * height > max_pixels:
+        raise ImageTooLarge(f"Images can have at most {max_pixels} pixels")
+
+    return mimetype
+
+
+# Digest and MIME type of an upload. Spooled uploads were hashed as they arrived,
+# so only other files are read through here.
+def inspect_upload(image_fp: BinaryIO) -> UploadInfo:
+    spool = spooled(image_fp)
+    digest = spool.digest if spool is not None else image_digest(image_fp)
+    return UploadInfo(digest, check_image(image_fp))
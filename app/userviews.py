@@ -8,6 +8,7 @@ from flask import Blueprint, Response, make_response, render_template, redirect,
 from flask_login import LoginManager, login_user, logout_user, current_user
 
 from .forms import NewUserForm, LoginForm
+from .identity import forget_identity, load_identity, remember_identity
 from .models import db, User
 
 
@@ -15,9 +16,10 @@ login_manager = LoginManager()
 userviews = Blueprint("userviews", __name__, template_folder="templates/")
 
 
+# Uses the identity cached in the session when it is fresh enough (see identity.py)
 @login_manager.user_loader
 def load_user(user_id: str) -> User:
-    return User.query.get(int(user_id))
+    return load_identity(int(user_id))
 
 
 @userviews.route("/new", methods=["GET", "POST"])
@@ -40,6 +42,7 @@ def createuser() -> Response:
             db.session.commit()
 
             login_user(newuser, remember=True)
+            remember_identity(newuser)
             return redirect(url_for("mainviews.index"))
 
         # There was an error
@@ -58,6 +61,7 @@ def userlogin() -> Response:
         else:
             if check_password_hash(req_user.pw_hash, form.password.data):
                 login_user(req_user, remember=True)
+                remember_identity(req_user)
                 return redirect(url_for("mainviews.index"))
             else:
                 form.password.errors.append("Incorrect password!")
@@ -72,5 +76,6 @@ def userlogin() -> Response:
 def userlogout() -> Response:
     if current_user.is_authenticated:
         logout_user()
+        forget_identity()
 
     return redirect(url_for("mainviews.index"))
@@ -0,0 +1,126 @@
+"""
+    This module measures the recall and latency of the approximate nearest-neighbour
+    index against an exact scan, for a grid of nlist/nprobe values.
+    It runs on a synthetic clustered gallery by default, or on a real user's gallery
+    with --user. Usage:
+
+        python -m bench.ann_recall --size 100000 --nlist 256 1024 --nprobe 1 4 8 16
+"""
+
+import argparse
+import json
+import time
+import numpy as np
+
+from app.ann import IVFIndex, default_nlist
+from app.ranking import RankingEngine
+
+
+# Gallery of `authors` clusters, each with the same number of noisy samples
+def synthetic_gallery(
+    size: int, dim: int, authors: int, seed: int = 0
+) -> RankingEngine:
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(size=(authors, dim)).astype(np.float32)
+    labels = rng.integers(0, authors, size=size)
+    matrix = centres[labels] + 0.35 * rng.normal(size=(size, dim)).astype(np.float32)
+    return RankingEngine.from_arrays(np.arange(size), matrix)
+
+
+# Queries drawn near random gallery rows, like a new scan by a known author
+def synthetic_queries(engine: RankingEngine, count: int, seed: int = 1) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    rows = engine.matrix[rng.choice(len(engine), count, replace=False)]
+    return rows + 0.2 * rng.normal(size=rows.shape).astype(np.float32)
+
+
+def load_user_gallery(user_id: int) -> RankingEngine:
+    from app.main import create_app
+    from app.gallery import load_engine
+
+    create_app()
+    return load_engine(user_id)
+
+
+def run_report(
+    engine: RankingEngine, queries: np.ndarray, k: int, nlists: list, nprobes: list
+) -> dict:
+    exact = []
+    start = time.perf_counter()
+    for query in queries:
+        exact.append({i for (i, _) in engine.top_k(query, k)})
+    exact_ms = 1000 * (time.perf_counter() - start) / len(queries)
+
+    report = {"size": len(engine), "k": k, "exact_ms": exact_ms, "runs": []}
+    for nlist in nlists:
+        start = time.perf_counter()
+        index = IVFIndex.build(engine, nlist)
+        build_s = time.perf_counter() - start
+        rows = index.rows_in(engine)
+
+        for nprobe in nprobes:
+            if nprobe > index.nlist:
+                continue
+
+            hits = 0
+            start = time.perf_counter()
+            for (query, truth) in zip(queries, exact):
+                ids, dists = index.search(engine, query, nprobe, rows)
+                order = np.argsort(dists)[:k]
+                hits += len(truth.intersection(ids[order].tolist()))
+            ann_ms = 1000 * (time.perf_counter() - start) / len(queries)
+
+            report["runs"].append(
+                {
+                    "nlist": index.nlist,
+                    "nprobe": nprobe,
+                    "build_s": build_s,
+                    "recall": hits / (k * len(queries)),
+                    "ann_ms": ann_ms,
+                    "speedup": exact_ms / ann_ms if ann_ms > 0 else None,
+                }
+            )
+
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ANN recall versus latency report.")
+    parser.add_argument(
+        "--user", type=int, help="Use this user's gallery from the database"
+    )
+    parser.add_argument("--size", type=int, default=100000)
+    parser.add_argument("--dim", type=int, default=128)
+    parser.add_argument("--authors", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--nlist", type=int, nargs="*")
+    parser.add_argument("--nprobe", type=int, nargs="*", default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args()
+
+    if args.user is not None:
+        engine = load_user_gallery(args.user)
+    else:
+        engine = synthetic_gallery(args.size, args.dim, args.authors)
+
+    queries = synthetic_queries(engine, min(args.queries, len(engine)))
+    report = run_report(
+        engine, queries, args.k, args.nlist or [default_nlist(len(engine))], args.nprobe
+    )
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(
+            f"{report['size']} samples, recall@{report['k']}, "
+            f"exact scan {report['exact_ms']:.2f} ms/query"
+        )
+        print(
+            f"{'nlist':>6} {'nprobe':>6} {'recall':>7} {'ms/query':>9} {'speedup':>8}"
+        )
+        for run in report["runs"]:
+            print(
+                f"{run['nlist']:>6} {run['nprobe']:>6} {run['recall']:>7.3f} "
+                f"{run['ann_ms']:>9.3f} {run['speedup']:>7.1f}x"
+            )
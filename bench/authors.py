@@ -0,0 +1,168 @@
+"""
+    This module compares the two-stage author ranking with the exact scan of every
+    sample. The gallery is synthetic: each author has a centre and their own spread,
+    and the queries are new samples by known authors. For each number of candidate
+    authors it reports how often the top match names the right author, how often it
+    agrees with the exact scan, and the time per query. The author summaries are
+    built one sample at a time with the same Welford updates the app uses, and their
+    drift from the exact centroids is reported too. Usage:
+
+        python -m bench.authors --authors 500 --per-author 200 --candidates 5 10 20 50
+"""
+
+import argparse
+import json
+import time
+import numpy as np
+
+from app.authors import AuthorGallery, summarize, welford_add, welford_remove
+from app.models import AuthorSummary
+from app.ranking import RankingEngine, select_top_k
+
+
+# `per_author` samples for each author, spread around the author's centre by a
+# random amount. Returns the gallery, each sample's author and the centres/spreads.
+def synthetic_gallery(authors: int, per_author: int, dim: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(size=(authors, dim)).astype(np.float32)
+    spreads = rng.uniform(0.3, 0.7, size=authors).astype(np.float32)
+    labels = np.repeat(np.arange(authors), per_author)
+    rng.shuffle(labels)
+    noise = rng.normal(size=(len(labels), dim)).astype(np.float32)
+    matrix = centres[labels] + spreads[labels, None] * noise
+    engine = RankingEngine.from_arrays(np.arange(len(labels)), matrix)
+    return engine, labels, centres, spreads
+
+
+def synthetic_queries(centres, spreads, count: int, seed: int = 1):
+    rng = np.random.default_rng(seed)
+    truth = rng.integers(0, len(centres), size=count)
+    noise = rng.normal(size=(count, centres.shape[1])).astype(np.float32)
+    return centres[truth] + spreads[truth, None] * noise, truth
+
+
+# Build every author's summary one sample at a time, as the app does when samples
+# are uploaded, taking a tenth of them out and adding them back as deletes would
+def incremental_summaries(
+    engine: RankingEngine, labels: np.ndarray, seed: int = 2
+) -> tuple[list[AuthorSummary], float]:
+    rng = np.random.default_rng(seed)
+    state: dict[int, tuple] = {}
+    start = time.perf_counter()
+    updates = 0
+    for (row, label) in enumerate(labels):
+        x = engine.matrix[row].astype(np.float64)
+        if label not in state:
+            state[label] = (1, x, 0.0)
+        else:
+            state[label] = welford_add(*state[label], x)
+
+        updates += 1
+        if rng.random() < 0.1 and state[label][0] > 1:
+            state[label] = welford_remove(*state[label], x)
+            state[label] = welford_add(*state[label], x)
+            updates += 2
+
+    update_us = 1e6 * (time.perf_counter() - start) / updates
+    summaries = []
+    for label in sorted(state):
+        count, centroid, sum_sq = state[label]
+        summary = AuthorSummary(name=str(label), count=count, sum_sq=sum_sq)
+        summary.centroid = centroid
+        summaries.append(summary)
+
+    return summaries, update_us
+
+
+def run_report(args) -> dict:
+    engine, labels, centres, spreads = synthetic_gallery(
+        args.authors, args.per_author, args.dim
+    )
+    queries, truth = synthetic_queries(centres, spreads, args.queries)
+    summaries, update_us = incremental_summaries(engine, labels)
+
+    # How far the running summaries are from ones computed in one go
+    drift = 0.0
+    for summary in summaries:
+        _, centroid, _ = summarize(engine.matrix[labels == int(summary.name)])
+        drift = max(drift, float(np.abs(summary.centroid - centroid).max()))
+
+    # Rows of each author's samples, standing in for the query by name
+    rows_by_author = [np.flatnonzero(labels == i) for i in range(args.authors)]
+
+    start = time.perf_counter()
+    exact = [labels[engine.top_k(query, 1)[0][0]] for query in queries]
+    exact_ms = 1000 * (time.perf_counter() - start) / len(queries)
+
+    report = {
+        "size": len(engine),
+        "authors": args.authors,
+        "dim": args.dim,
+        "queries": len(queries),
+        "summary_update_us": update_us,
+        "max_centroid_drift": drift,
+        "exact": {
+            "accuracy": float(np.mean(np.array(exact) == truth)),
+            "ms_per_query": exact_ms,
+        },
+        "two_stage": [],
+    }
+
+    start = time.perf_counter()
+    authors = AuthorGallery.from_summaries(summaries, engine.metric)
+    report["load_authors_ms"] = 1000 * (time.perf_counter() - start)
+    for candidates in args.candidates:
+        found = []
+        start = time.perf_counter()
+        for query in queries:
+            names = authors.closest(query, candidates)
+            rows = np.concatenate([rows_by_author[int(name)] for name in names])
+            top = select_top_k(engine.ids[rows], engine.distances(query, rows), 1)
+            found.append(labels[top[0][0]])
+
+        two_stage_ms = 1000 * (time.perf_counter() - start) / len(queries)
+        report["two_stage"].append(
+            {
+                "candidates": candidates,
+                "accuracy": float(np.mean(np.array(found) == truth)),
+                "agreement": float(np.mean(np.array(found) == np.array(exact))),
+                "ms_per_query": two_stage_ms,
+                "speedup": exact_ms / two_stage_ms if two_stage_ms > 0 else None,
+            }
+        )
+
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Author ranking versus exact scan.")
+    parser.add_argument("--authors", type=int, default=500)
+    parser.add_argument("--per-author", type=int, default=200)
+    parser.add_argument("--dim", type=int, default=128)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--candidates", type=int, nargs="*", default=[1, 5, 10, 20, 50])
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args()
+
+    report = run_report(args)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(
+            f"{report['size']} samples by {report['authors']} authors, "
+            f"exact scan {report['exact']['ms_per_query']:.2f} ms/query, "
+            f"accuracy {report['exact']['accuracy']:.3f}"
+        )
+        print(
+            f"Summary updates {report['summary_update_us']:.1f} us each, "
+            f"max centroid drift {report['max_centroid_drift']:.2e}"
+        )
+        print(
+            f"{'authors':>7} {'accuracy':>8} {'agree':>6} {'ms/query':>9} {'speedup':>8}"
+        )
+        for run in report["two_stage"]:
+            print(
+                f"{run['candidates']:>7} {run['accuracy']:>8.3f} "
+                f"{run['agreement']:>6.3f} {run['ms_per_query']:>9.3f} "
+                f"{run['speedup']:>7.1f}x"
+            )
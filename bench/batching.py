@@ -0,0 +1,62 @@
+"""
+    This module compares sending one model call per image with micro-batching the
+    same requests, against the stub model server with artificial latency. Usage:
+
+        python -m bench.batching --threads 32 --requests 512 --latency 0.02
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import io
+import json
+import time
+import numpy as np
+
+from app.batching import FingerprintBatcher
+from app.modelclient import ModelClient
+from app.stubserver import StubServer
+
+
+def drive(fingerprint, images: list, threads: int) -> dict:
+    latencies = []
+
+    def one(data: bytes) -> None:
+        start = time.perf_counter()
+        fingerprint(io.BytesIO(data))
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        list(pool.map(one, images))
+    elapsed = time.perf_counter() - start
+
+    ms = 1000 * np.array(latencies)
+    return {
+        "requests_per_s": len(images) / elapsed,
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "p99_ms": float(np.percentile(ms, 99)),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-batching benchmark.")
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=512)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--per-image", type=float, default=0.001)
+    parser.add_argument("--window-ms", type=float, default=5)
+    parser.add_argument("--max-batch", type=int, default=32)
+    args = parser.parse_args()
+
+    images = [f"image {i}".encode() * 256 for i in range(args.requests)]
+    report = {}
+    with StubServer(latency=args.latency, per_image=args.per_image) as stub:
+        client = ModelClient(stub.url, pool_size=args.threads)
+        report["unbatched"] = drive(client.fingerprint, images, args.threads)
+
+        batcher = FingerprintBatcher(client, args.window_ms / 1000, args.max_batch)
+        report["batched"] = drive(batcher.fingerprint, images, args.threads)
+        report["batched"].update(batcher.stats())
+
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,387 @@
+"""
+    This module load-tests the whole app over HTTP. For each gallery size it starts
+    the stub model server with artificial latency, seeds a user with that many
+    labelled samples, serves the app on a local port and drives /eval/new, /eval/query
+    and the image endpoints from concurrent clients. It prints p50/p95/p99 latency and
+    requests per second for each endpoint as JSON, to be compared between runs.
+    The app runs in its own process with a fresh database and data directory for each
+    size, so the clients don't compete with it for the GIL. Usage:
+
+        python -m bench.load --sizes 1000 10000 100000 --threads 16 --requests 2000
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import io
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import numpy as np
+import requests
+
+from bench.thumbnails import synthetic_scan
+
+EMAIL = "bench@example.com"
+PASSWORD = "bench"
+
+# Relative weight of each kind of request in the mix
+DEFAULT_MIX = {"new": 1, "query": 2, "image": 3, "thumbnail": 4}
+
+# Rows per INSERT when seeding the gallery
+SEED_CHUNK = 5000
+
+
+# Settings for a run under root, with the model server at the stub's port
+def bench_settings(root: str, stub_port: int, args) -> dict:
+    from app.main import CONFIG, get_config
+
+    conf = get_config(CONFIG)
+    conf.update(
+        {
+            "db_uri": f"sqlite:///{os.path.join(root, 'bench.db')}",
+            "datadir": os.path.join(root, "data/"),
+            "tempdir": os.path.join(root, "tmp/"),
+            "modelServerIP": "localhost",
+            "modelServerPort": stub_port,
+            "image_store": {**conf.get("image_store", {}), "root": None},
+            "batching": {**conf.get("batching", {}), "enabled": args.batching},
+            "debug": False,
+            "doStart": False,
+        }
+    )
+    return conf
+
+
+# Add a user with `size` labelled samples, spread over `authors` names and sharing
+# `distinct` stored images. The rows are inserted in bulk rather than through the
+# views, so seeding 100k samples takes seconds. Returns the image ids.
+def seed_gallery(db, size: int, dim: int, authors: int, distinct: int) -> list[int]:
+    from werkzeug.security import generate_password_hash
+
+    from app.fingerprints import pack_fingerprint
+    from app.imagestore import image_store
+    from app.models import SampleEval, StoredImage, User, UserImage
+
+    user = User(email=EMAIL, name="Bench", pw_hash=generate_password_hash(PASSWORD))
+    db.session.add(user)
+    db.session.commit()
+
+    digests = []
+    for i in range(min(distinct, size)):
+        scan = io.BytesIO(synthetic_scan(640, 480, i))
+        digests.append(image_store.write(scan))
+
+    rng = np.random.default_rng(0)
+    centres = rng.normal(size=(authors, dim)).astype(np.float32)
+    labels = rng.integers(0, authors, size=size)
+    refcounts = dict.fromkeys(digests, 0)
+    for start in range(0, size, SEED_CHUNK):
+        ids = range(start + 1, min(start + SEED_CHUNK, size) + 1)
+        images = []
+        samples = []
+        for image_id in ids:
+            digest = digests[image_id % len(digests)]
+            refcounts[digest] += 1
+            image_path, thumbnail_path = image_store.paths(digest)
+            images.append(
+                {
+                    "id": image_id,
+                    "user_id": user.id,
+                    "digest": digest,
+                    "image_path": image_path,
+                    "thumbnail_path": thumbnail_path,
+                    "ready": True,
+                }
+            )
+
+            label = labels[image_id - 1]
+            vector = centres[label] + 0.35 * rng.normal(size=dim)
+            blob, fp_dim, dtype = pack_fingerprint(vector / np.linalg.norm(vector))
+            samples.append(
+                {
+                    "id": image_id,
+                    "image_id": image_id,
+                    "user_id": user.id,
+                    "name": f"Author {label}",
+                    "fingerprint_json": "",
+                    "fingerprint_blob": blob,
+                    "fingerprint_dim": fp_dim,
+                    "fingerprint_dtype": dtype,
+                }
+            )
+
+        db.session.execute(UserImage.__table__.insert(), images)
+        db.session.execute(SampleEval.__table__.insert(), samples)
+        db.session.commit()
+
+    for (digest, refcount) in refcounts.items():
+        db.session.add(
+            StoredImage(digest=digest, refcount=refcount, mimetype="image/jpeg")
+        )
+
+    user.samples_version = 1
+    db.session.commit()
+    return list(range(1, size + 1))
+
+
+# Run the stub model server and the app, seeded with `size` samples, until told to
+# stop. Reports the app's URL and the seeded image ids through `info` first.
+def serve(size: int, args, info, stop) -> None:
+    from werkzeug.serving import make_server
+
+    from app.main import update_settings
+    from app.stubserver import QuietRequestHandler, StubServer
+
+    stub = StubServer(
+        dim=args.dim, latency=args.latency, per_image=args.per_image
+    ).start()
+    with tempfile.TemporaryDirectory() as root:
+        conf = bench_settings(root, stub.port, args)
+        update_settings(conf)
+        os.makedirs(conf["tempdir"], exist_ok=True)
+        os.makedirs(conf["datadir"], exist_ok=True)
+
+        from app.jobs import job_queue
+        from app.main import create_app
+        from app.migrate import upgrade_schema
+
+        app, db = create_app()
+        app.config.update({"WTF_CSRF_ENABLED": False, "QUERY_BUDGET_LOG": False})
+        app.secret_key = "bench"
+        db.create_all()
+        upgrade_schema(db)
+
+        start = time.perf_counter()
+        image_ids = seed_gallery(db, size, args.dim, args.authors, args.distinct)
+        seed_s = time.perf_counter() - start
+        db.session.remove()
+
+        job_queue.start(app)
+        server = make_server(
+            "localhost", 0, app, threaded=True, request_handler=QuietRequestHandler
+        )
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+
+        info.put(
+            {
+                "url": f"http://localhost:{server.server_port}",
+                "image_ids": image_ids,
+                "seed_s": seed_s,
+            }
+        )
+        stop.wait()
+
+        server.shutdown()
+        thread.join()
+        job_queue.stop()
+        info.put({"model_calls": stub.stats["calls"]})
+
+    stub.stop()
+
+
+def summarize(latencies: list[float], errors: int, elapsed: float) -> dict:
+    summary = {
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "requests_per_s": (len(latencies) + errors) / elapsed,
+    }
+    if latencies:
+        ms = 1000 * np.array(latencies)
+        summary.update(
+            {
+                "p50_ms": float(np.percentile(ms, 50)),
+                "p95_ms": float(np.percentile(ms, 95)),
+                "p99_ms": float(np.percentile(ms, 99)),
+            }
+        )
+
+    return summary
+
+
+class LoadDriver:
+    """
+    Sends a fixed, seeded mix of requests to the app from a pool of threads, each
+    with its own logged-in session, and records the latency of each request.
+    """
+
+    def __init__(self, url: str, image_ids: list[int], uploads: list[bytes], args):
+        self.url = url
+        self.image_ids = image_ids
+        self.uploads = uploads
+        self.threads = args.threads
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.latencies: dict[str, list[float]] = {kind: [] for kind in args.mix}
+        self.errors = dict.fromkeys(args.mix, 0)
+
+        rng = np.random.default_rng(args.seed)
+        kinds = list(args.mix)
+        weights = np.array([args.mix[kind] for kind in kinds], dtype=float)
+        self.plan = [
+            (kinds[k], i)
+            for (i, k) in enumerate(
+                rng.choice(len(kinds), args.requests, p=weights / weights.sum())
+            )
+        ]
+        self.targets = rng.choice(image_ids, args.requests).tolist()
+
+    def session(self) -> requests.Session:
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = requests.Session()
+            res = session.post(
+                f"{self.url}/users/login",
+                data={"email": EMAIL, "password": PASSWORD},
+            )
+            res.raise_for_status()
+            self.local.session = session
+
+        return session
+
+    def send(self, kind: str, i: int) -> requests.Response:
+        session = self.session()
+        upload = self.uploads[i % len(self.uploads)]
+        if kind == "new":
+            return session.post(
+                f"{self.url}/eval/new",
+                data={"name": f"Author {i % 50}"},
+                files={"attachment": (f"new{i}.jpg", upload, "image/jpeg")},
+            )
+
+        if kind == "query":
+            return session.post(
+                f"{self.url}/eval/query",
+                files={"attachment": (f"query{i}.jpg", upload, "image/jpeg")},
+            )
+
+        if kind == "image":
+            return session.get(f"{self.url}/image/{self.targets[i]}")
+
+        return session.get(f"{self.url}/image/{self.targets[i]}/thumbnail")
+
+    def one(self, step: tuple[str, int]) -> None:
+        kind, i = step
+        self.session()
+        start = time.perf_counter()
+        try:
+            ok = self.send(kind, i).status_code == 200
+        except requests.RequestException:
+            ok = False
+
+        latency = time.perf_counter() - start
+        with self.lock:
+            if ok:
+                self.latencies[kind].append(latency)
+            else:
+                self.errors[kind] += 1
+
+    def run(self) -> dict:
+        # Log every thread in before the clock starts
+        with ThreadPoolExecutor(self.threads) as pool:
+            list(pool.map(lambda _: self.session(), range(self.threads)))
+
+            start = time.perf_counter()
+            list(pool.map(self.one, self.plan))
+            elapsed = time.perf_counter() - start
+
+        report = {
+            "elapsed_s": elapsed,
+            "total": summarize(
+                [x for kind in self.latencies.values() for x in kind],
+                sum(self.errors.values()),
+                elapsed,
+            ),
+            "endpoints": {},
+        }
+        for kind in self.latencies:
+            report["endpoints"][kind] = summarize(
+                self.latencies[kind], self.errors[kind], elapsed
+            )
+
+        return report
+
+
+# Seed, serve and load-test one gallery size
+def run_size(size: int, uploads: list[bytes], args) -> dict:
+    context = multiprocessing.get_context("spawn")
+    info = context.Queue()
+    stop = context.Event()
+    process = context.Process(target=serve, args=(size, args, info, stop))
+    process.start()
+    try:
+        setup = info.get()
+        driver = LoadDriver(setup["url"], setup["image_ids"], uploads, args)
+        report = {"size": size, "seed_s": setup["seed_s"], **driver.run()}
+    finally:
+        stop.set()
+
+    report.update(info.get())
+    process.join()
+    return report
+
+
+def parse_mix(text: str) -> dict[str, float]:
+    mix = {}
+    for part in text.split(","):
+        kind, weight = part.split("=")
+        if kind not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f"Unknown request kind: {kind}")
+
+        mix[kind] = float(weight)
+
+    return mix
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end load test.")
+    parser.add_argument("--sizes", type=int, nargs="*", default=[1000, 10000, 100000])
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument(
+        "--mix",
+        type=parse_mix,
+        default=DEFAULT_MIX,
+        help="Weights of each request kind, e.g. new=1,query=2,image=3,thumbnail=4",
+    )
+    parser.add_argument("--latency", type=float, default=0.02, help="Seconds per call")
+    parser.add_argument(
+        "--per-image", type=float, default=0.001, help="Seconds per image"
+    )
+    parser.add_argument("--batching", action="store_true", help="Batch model calls")
+    parser.add_argument("--dim", type=int, default=128)
+    parser.add_argument("--authors", type=int, default=500)
+    parser.add_argument(
+        "--distinct", type=int, default=64, help="Distinct images in the gallery"
+    )
+    parser.add_argument(
+        "--uploads", type=int, default=256, help="Distinct images to upload"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Also write the report to this file")
+    args = parser.parse_args()
+
+    # Uploaded images are cycled, so past the first `uploads` requests the
+    # fingerprint cache and image store start to see repeats
+    uploads = [
+        synthetic_scan(640, 480, 1000000 + i) for i in range(max(args.uploads, 1))
+    ]
+    report = {
+        "threads": args.threads,
+        "requests": args.requests,
+        "mix": args.mix,
+        "model_latency": args.latency,
+        "model_per_image": args.per_image,
+        "batching": args.batching,
+        "runs": [run_size(size, uploads, args) for size in args.sizes],
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as out:
+            out.write(output + "\n")
+
+    print(output)
@@ -0,0 +1,243 @@
+"""
+    This module measures the labelled-list and query read paths on a database made by
+    db.create_all() alone, then again after app.migrate.upgrade_schema has added the
+    indexes and switched to WAL with pooled connections. The samples of many users are
+    interleaved, as they are in a real database. Each read is timed alone and while
+    another thread keeps committing new samples. Each phase runs in its own process,
+    so it gets the engine settings it is measuring. Usage:
+
+        python -m bench.schema --size 100000 --users 20 --repeat 50
+"""
+
+import argparse
+from datetime import datetime, timedelta
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import numpy as np
+
+DIM = 128
+
+# Engine settings for the "before" phase, as they were before the migrations
+UNTUNED = {"journal_mode": None, "synchronous": None, "pool_size": 0}
+
+PLAN_QUERIES = {
+    "list": "SELECT id FROM sample WHERE user_id = 1 "
+    "ORDER BY timestamp DESC, id DESC LIMIT 51",
+    "gallery": "SELECT id, fingerprint_blob FROM sample WHERE user_id = 1 ORDER BY id",
+    "images": "SELECT count(*) FROM image WHERE user_id = 1",
+}
+
+
+def open_app(db_path: str, database: dict):
+    from app.main import CONFIG, get_config, update_settings
+
+    conf = get_config(CONFIG)
+    conf.update({"db_uri": f"sqlite:///{db_path}", "database": database})
+    update_settings(conf)
+
+    from app.main import create_app
+
+    return create_app()
+
+
+# Users with `size` samples between them, inserted round-robin
+def seed(db, size: int, users: int) -> None:
+    from app.fingerprints import pack_fingerprint
+    from app.models import SampleEval, User, UserImage
+
+    db.session.execute(
+        User.__table__.insert(),
+        [
+            {"id": i, "email": f"user{i}@example.com", "name": "", "pw_hash": ""}
+            for i in range(1, users + 1)
+        ],
+    )
+
+    rng = np.random.default_rng(0)
+    start = datetime(2022, 1, 1)
+    for offset in range(0, size, 5000):
+        ids = range(offset + 1, min(offset + 5000, size) + 1)
+        db.session.execute(
+            UserImage.__table__.insert(),
+            [
+                {"id": i, "user_id": i % users + 1, "image_path": "", "ready": True}
+                for i in ids
+            ],
+        )
+        rows = []
+        for i in ids:
+            blob, dim, dtype = pack_fingerprint(rng.normal(size=DIM))
+            rows.append(
+                {
+                    "id": i,
+                    "image_id": i,
+                    "user_id": i % users + 1,
+                    "timestamp": start + timedelta(seconds=i),
+                    "name": f"Author {i % 97}",
+                    "fingerprint_json": "",
+                    "fingerprint_blob": blob,
+                    "fingerprint_dim": dim,
+                    "fingerprint_dtype": dtype,
+                }
+            )
+
+        db.session.execute(SampleEval.__table__.insert(), rows)
+        db.session.commit()
+
+
+# Keep committing small batches of samples for one user until told to stop
+def write_load(engine, user_id: int, stop: threading.Event, errors: list) -> None:
+    from sqlalchemy import text
+
+    i = 0
+    while not stop.is_set():
+        try:
+            with engine.begin() as conn:
+                for _ in range(20):
+                    i += 1
+                    conn.execute(
+                        text(
+                            "INSERT INTO sample (user_id, name, fingerprint) "
+                            "VALUES (:user_id, :name, '')"
+                        ),
+                        {"user_id": user_id, "name": f"Written {i}"},
+                    )
+        except Exception as e:
+            errors.append(str(e))
+
+        time.sleep(0.001)
+
+
+def timed(calls: list) -> dict:
+    latencies = []
+    errors = 0
+    for call in calls:
+        start = time.perf_counter()
+        try:
+            call()
+        except Exception:
+            errors += 1
+            continue
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    ms = 1000 * np.array(latencies)
+    return {
+        "mean_ms": float(ms.mean()),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "max_ms": float(ms.max()),
+        "errors": errors,
+    }
+
+
+def measure(db, users: int, repeat: int) -> dict:
+    from app.gallery import load_engine
+    from app.models import User, UserImage
+    from app.pagination import page_samples
+
+    rng = np.random.default_rng(1)
+    user_ids = [int(i) for i in rng.integers(1, users + 1, size=repeat)]
+
+    def list_pages(user_id: int) -> None:
+        user = User.query.get(user_id)
+        cursor = None
+        for _ in range(3):
+            _, cursor = page_samples(user, cursor)
+            db.session.expunge_all()
+
+    report = {
+        "list_3_pages": timed([lambda u=u: list_pages(u) for u in user_ids]),
+        "load_gallery": timed([lambda u=u: load_engine(u) for u in user_ids]),
+        "count_images": timed(
+            [lambda u=u: UserImage.query.filter_by(user_id=u).count() for u in user_ids]
+        ),
+    }
+    db.session.remove()
+    return report
+
+
+def run_phase(phase: str, db_path: str, args, results) -> None:
+    from sqlalchemy import text
+
+    database = UNTUNED if phase == "before" else {}
+    app, db = open_app(db_path, database)
+    if phase == "before":
+        db.create_all()
+        seed(db, args.size, args.users)
+    else:
+        from app.migrate import upgrade_schema
+
+        start = time.perf_counter()
+        upgrade_schema(db)
+        migrate_s = time.perf_counter() - start
+
+    report = {"phase": phase}
+    if phase == "after":
+        report["migrate_s"] = migrate_s
+
+    with db.engine.connect() as conn:
+        report["journal_mode"] = conn.execute(text("PRAGMA journal_mode")).scalar()
+        report["plans"] = {
+            name: [row[-1] for row in conn.execute(text(f"EXPLAIN QUERY PLAN {sql}"))]
+            for (name, sql) in PLAN_QUERIES.items()
+        }
+
+    report["idle"] = measure(db, args.users, args.repeat)
+
+    # The same reads while another thread writes
+    stop = threading.Event()
+    write_errors: list = []
+    writer = threading.Thread(
+        target=write_load, args=(db.engine, args.users + 1, stop, write_errors)
+    )
+    db.session.execute(
+        text(
+            "INSERT INTO user (id, email, name, pw_hash) "
+            "VALUES (:id, 'writer@example.com', '', '')"
+        ),
+        {"id": args.users + 1},
+    )
+    db.session.commit()
+    writer.start()
+    try:
+        report["with_writer"] = measure(db, args.users, args.repeat)
+    finally:
+        stop.set()
+        writer.join()
+
+    # Leave the database as the next phase expects it
+    db.session.execute(
+        text("DELETE FROM sample WHERE user_id = :id"), {"id": args.users + 1}
+    )
+    db.session.execute(text("DELETE FROM user WHERE id = :id"), {"id": args.users + 1})
+    db.session.commit()
+    report["with_writer"]["write_errors"] = len(write_errors)
+    results.put(report)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Schema migration benchmark.")
+    parser.add_argument("--size", type=int, default=100000)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    report = {"size": args.size, "users": args.users, "repeat": args.repeat}
+    with tempfile.TemporaryDirectory() as root:
+        db_path = os.path.join(root, "bench.db")
+        context = multiprocessing.get_context("spawn")
+        for phase in ("before", "after"):
+            results = context.Queue()
+            process = context.Process(
+                target=run_phase, args=(phase, db_path, args, results)
+            )
+            process.start()
+            report[phase] = results.get()
+            process.join()
+
+    print(json.dumps(report, indent=2))
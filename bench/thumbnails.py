@@ -0,0 +1,135 @@
+"""
+    This module compares the old thumbnail code (full decode, resize, save as PNG) with
+    the reduced-size decoding pipeline in app.imagestore, on synthetic scans or on
+    images given with --images. Each method runs in its own process, so the peak RSS
+    reported for it isn't hidden by the other's high-water mark. Usage:
+
+        python -m bench.thumbnails --width 4000 --height 3000 --count 5
+"""
+
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+import numpy as np
+from PIL import Image
+
+from app.imagestore import DEFAULT_CONFIG, make_thumbnails, parse_thumbnail_specs
+
+
+# Greyish paper with dark strokes and sensor noise, saved as a camera-quality JPEG
+def synthetic_scan(width: int, height: int, seed: int) -> bytes:
+    rng = np.random.default_rng(seed)
+    page = np.full((height, width), 225, dtype=np.int16)
+    for _ in range(200):
+        row = rng.integers(0, height - 8)
+        col = rng.integers(0, width - 400)
+        page[row : row + 6, col : col + rng.integers(50, 400)] = 40
+
+    page += rng.normal(scale=6, size=page.shape).astype(np.int16)
+    rgb = np.repeat(np.clip(page, 0, 255).astype(np.uint8)[:, :, None], 3, axis=2)
+    out = io.BytesIO()
+    Image.fromarray(rgb).save(out, format="JPEG", quality=92)
+    return out.getvalue()
+
+
+# Peak resident memory of this process. VmHWM starts afresh in a new process, while
+# ru_maxrss carries over the parent's peak across exec.
+def peak_rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# The thumbnail code as it was before the image store
+def resize_thumbnail(image_fp, out_dir: str) -> None:
+    with Image.open(image_fp) as image:
+        image.save(os.path.join(out_dir, "full.png"))
+        factor = 400 / max(image.size)
+        thumbnail = image.resize(
+            (int(factor * image.size[0]), int(factor * image.size[1]))
+        )
+        thumbnail.save(os.path.join(out_dir, "thumbnail.png"))
+
+
+def pipeline_thumbnail(image_fp, out_dir: str) -> None:
+    specs = parse_thumbnail_specs(DEFAULT_CONFIG["thumbnails"])
+    targets = [
+        (spec, os.path.join(out_dir, f"{name}.{spec.extension}"))
+        for (name, spec) in specs.items()
+    ]
+    make_thumbnails(image_fp, targets)
+
+
+METHODS = {"resize": resize_thumbnail, "pipeline": pipeline_thumbnail}
+
+
+def run_method(method: str, paths: list[str], results) -> None:
+    baseline = peak_rss_mb()
+    times = []
+    with tempfile.TemporaryDirectory() as out_dir:
+        for path in paths:
+            with open(path, "rb") as image_fp:
+                start = time.perf_counter()
+                METHODS[method](image_fp, out_dir)
+                times.append(time.perf_counter() - start)
+
+        output_bytes = sum(
+            os.path.getsize(os.path.join(out_dir, name))
+            for name in os.listdir(out_dir)
+            if name != "full.png"
+        )
+
+    ms = 1000 * np.array(times)
+    results.put(
+        {
+            "method": method,
+            "mean_ms": float(ms.mean()),
+            "p95_ms": float(np.percentile(ms, 95)),
+            "peak_rss_mb": peak_rss_mb(),
+            "peak_rss_over_baseline_mb": peak_rss_mb() - baseline,
+            "last_thumbnail_bytes": output_bytes,
+        }
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Thumbnail pipeline benchmark.")
+    parser.add_argument("--width", type=int, default=4000)
+    parser.add_argument("--height", type=int, default=3000)
+    parser.add_argument("--count", type=int, default=5)
+    parser.add_argument("--images", nargs="*", help="Use these images instead")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as scan_dir:
+        paths = args.images
+        if not paths:
+            paths = []
+            for i in range(args.count):
+                path = os.path.join(scan_dir, f"scan{i}.jpg")
+                with open(path, "wb") as scan_fp:
+                    scan_fp.write(synthetic_scan(args.width, args.height, i))
+
+                paths.append(path)
+
+        report = {"images": len(paths)}
+        context = multiprocessing.get_context("spawn")
+        for method in METHODS:
+            results = context.Queue()
+            process = context.Process(target=run_method, args=(method, paths, results))
+            process.start()
+            report[method] = results.get()
+            process.join()
+
+    print(json.dumps(report, indent=2))
@@ -1,7 +1,7 @@
 #!/usr/bin/env bash
 
-bash -c "
-    cd author-id-model/ &&
-        source .env/bin/activate &&
-        python -m app.main
-" &
+# Runs in the foreground, so the supervisor in app/supervisor.py can tell when the
+# model server exits
+cd author-id-model/ &&
+    source .env/bin/activate &&
+    exec python -m app.main